@@ -0,0 +1,282 @@
+"""
+Local HTTP API over the lost items database.
+
+    python api.py [--host 127.0.0.1] [--port 8000]
+
+Every endpoint answers GET with JSON:
+
+    /version                                    data version of the database
+    /weekly?type_objet=                         lost items per week and type of object
+    /stations?year=2021&type_objet=             lost items per station and per million travellers
+    /temperature?by_type=0                      lost items per day with the temperature of the day
+    /seasons                                    median lost items per day for each season and type
+    /items?after=0&limit=100&type_objet=&nom_gare=&since=&until=
+                                                lost items in id order; pass the "next" id as `after`
+
+Answers carry an ETag derived from the data version, so clients can revalidate with If-None-Match, and
+are kept in an in-process cache until an import changes the data version. The database is read through a
+pool of read-only connections.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+import pandas as pd
+from sqlalchemy.engine import Connection, Engine
+from db import queries
+from db.engine import create_db_engine
+
+MAX_PAGE_SIZE = 1000
+
+
+def _int(params: Dict[str, str], name: str, default: int) -> int:
+    try:
+        return int(params.get(name, default))
+    except ValueError:
+        raise ValueError(f"{name} doit être un entier")
+
+
+def _records(df: pd.DataFrame) -> Any:
+    # to_json writes NaN as null
+    return json.loads(df.to_json(orient="records"))
+
+
+def weekly(conn: Connection, params: Dict[str, str]) -> Dict[str, Any]:
+    return {"data": _records(queries.weekly_counts_by_type(conn, params.get("type_objet")))}
+
+
+def stations(conn: Connection, params: Dict[str, str]) -> Dict[str, Any]:
+    year = str(_int(params, "year", 2021))
+    return {"year": year, "data": _records(queries.station_rates(conn, year, params.get("type_objet")))}
+
+
+def temperature(conn: Connection, params: Dict[str, str]) -> Dict[str, Any]:
+    by_type = params.get("by_type", "0") not in ("0", "false", "")
+    return {"data": _records(queries.daily_counts_with_temperature(conn, by_type=by_type))}
+
+
+def seasons(conn: Connection, params: Dict[str, str]) -> Dict[str, Any]:
+    return {"data": _records(queries.season_type_medians(conn))}
+
+
+def items(conn: Connection, params: Dict[str, str]) -> Dict[str, Any]:
+    limit = _int(params, "limit", 100)
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit doit être entre 1 et {MAX_PAGE_SIZE}")
+    page = queries.lost_items_page(
+        conn,
+        after_id=_int(params, "after", 0),
+        limit=limit,
+        type_objet=params.get("type_objet"),
+        nom_gare=params.get("nom_gare"),
+        since=params.get("since"),
+        until=params.get("until"),
+    )
+    next_id = int(page["id"].iloc[-1]) if len(page) == limit else None
+    return {"data": _records(page), "next": next_id}
+
+
+ENDPOINTS: Dict[str, Callable[[Connection, Dict[str, str]], Dict[str, Any]]] = {
+    "/weekly": weekly,
+    "/stations": stations,
+    "/temperature": temperature,
+    "/seasons": seasons,
+    "/items": items,
+}
+
+
+class QueryCache:
+    """
+    Least recently used cache of encoded answers, valid for one data version. Entries of an older
+    version are dropped as soon as a newer version is seen. Concurrent misses on the same key are
+    computed once, the other requests wait for that answer.
+
+    Attributes:
+    -----------
+    max_entries : int
+        Number of answers kept; 0 disables the cache.
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self.version = None
+        self.entries: "OrderedDict[Hashable, bytes]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.pending: Dict[Tuple, threading.Lock] = {}
+
+    def get(self, version: Tuple, key: Hashable) -> Optional[bytes]:
+        with self.lock:
+            if version != self.version or key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, version: Tuple, key: Hashable, body: bytes) -> None:
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            if version != self.version:
+                self.version = version
+                self.entries.clear()
+            self.entries[key] = body
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get_or_compute(self, version: Tuple, key: Hashable, compute: Callable[[], bytes]) -> bytes:
+        """
+        Returns the cached answer of a key, computing and storing it on a miss.
+
+        Args:
+            version (Tuple): The current data version.
+            key (Hashable): The request.
+            compute (Callable[[], bytes]): Builds the answer; its exceptions are raised to every waiting caller.
+
+        Returns:
+            bytes: The encoded answer.
+        """
+        body = self.get(version, key)
+        if body is not None or self.max_entries <= 0:
+            return body if body is not None else compute()
+        with self.lock:
+            key_lock = self.pending.setdefault((version, key), threading.Lock())
+        try:
+            with key_lock:
+                body = self.get(version, key)
+                if body is None:
+                    body = compute()
+                    self.put(version, key, body)
+                return body
+        finally:
+            with self.lock:
+                self.pending.pop((version, key), None)
+
+
+class ApiServer(ThreadingHTTPServer):
+    """
+    HTTP server answering each connection in its own thread, with a shared engine and answer cache.
+
+    Attributes:
+    -----------
+    engine : sqlalchemy.engine.Engine
+        Read-only engine whose connection pool is shared by the request threads.
+    cache : QueryCache
+        The answers of the current data version.
+    version_ttl : float
+        Seconds during which the data version is reused before being read again from the database.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], engine: Engine, cache_entries: int = 256, version_ttl: float = 1.0):
+        super().__init__(address, ApiHandler)
+        self.engine = engine
+        self.cache = QueryCache(cache_entries)
+        self.version_ttl = version_ttl
+        self._version = None
+        self._version_time = 0.0
+        self._version_lock = threading.Lock()
+
+    def data_version(self) -> Tuple:
+        """
+        Returns the data version of the database, read at most once every `version_ttl` seconds.
+        """
+        with self._version_lock:
+            if self._version is None or time.monotonic() - self._version_time >= self.version_ttl:
+                with self.engine.connect() as conn:
+                    self._version = queries.data_version(conn)
+                self._version_time = time.monotonic()
+            return self._version
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"  # keep-alive
+    disable_nagle_algorithm = True  # headers and body are separate writes; Nagle would delay small answers by 40 ms
+    server: ApiServer
+
+    def do_GET(self):
+        # Any failure, e.g. "database is locked" during a shadow swap, still gets an answer instead of a dropped connection
+        try:
+            status, body, etag = self._answer(urlparse(self.path))
+        except ValueError as e:
+            status, body, etag = 400, json.dumps({"error": str(e)}).encode(), None
+        except Exception as e:
+            logging.exception(f"API: {self.path}")
+            status, body, etag = 500, json.dumps({"error": f"{type(e).__name__}: {e}"}).encode(), None
+        self._send(status, body, etag)
+
+    def _answer(self, url) -> Tuple[int, bytes, Optional[str]]:
+        version = self.server.data_version()
+        etag = '"' + hashlib.sha1(repr(version).encode()).hexdigest()[:20] + '"'
+        if url.path == "/version":
+            return 200, json.dumps({"version": list(version)}).encode(), etag
+        endpoint = ENDPOINTS.get(url.path)
+        if endpoint is None:
+            return 404, json.dumps({"error": f"{url.path} inconnu", "endpoints": ["/version"] + list(ENDPOINTS)}).encode(), None
+        if self.headers.get("If-None-Match") == etag:
+            return 304, b"", etag
+
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        key = (url.path, tuple(sorted(params.items())))
+
+        def compute() -> bytes:
+            with self.server.engine.connect() as conn:
+                return json.dumps(endpoint(conn, params)).encode()
+
+        return 200, self.server.cache.get_or_compute(version, key, compute), etag
+
+    def _send(self, status: int, body: bytes, etag: Optional[str] = None) -> None:
+        self.send_response(status)
+        if etag is not None:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+        if status != 304:
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("API: " + format % args)
+
+
+def make_server(host: str = "127.0.0.1", port: int = 8000, path: Optional[str] = None, cache_entries: int = 256) -> ApiServer:
+    """
+    Creates the API server on a database file, without starting it.
+
+    Args:
+        host (str): Interface to listen on.
+        port (int): Port to listen on, 0 for any free port.
+        path (str, optional): Path of the SQLite file. Defaults to `get_db_path()`.
+        cache_entries (int): Number of answers kept in the in-process cache.
+
+    Returns:
+        ApiServer: The server; call `serve_forever()` to start it.
+    """
+    return ApiServer((host, port), create_db_engine(path, read_only=True), cache_entries=cache_entries)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the lost items database as a JSON API.")
+    parser.add_argument("--host", default="127.0.0.1", help="interface to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on (default: 8000)")
+    parser.add_argument("--db", default=None, help="SQLite file (default: $LOST_ITEMS_DB or db.sqlite)")
+    parser.add_argument("--cache-entries", type=int, default=256, help="answers kept in memory, 0 to disable")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = make_server(args.host, args.port, args.db, args.cache_entries)
+    logging.info(f"API: http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.engine.dispose()
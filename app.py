@@ -1,50 +1,128 @@
 import streamlit as st
-import pandas as pd
-import plotly.express as px
-import seaborn as sns
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
-from db.model import Base, Gare, LostItem, Temperature
-import matplotlib.pyplot as plt
-from utils import last_update, update, histogramme, paris_map, scatter_par_type, scatter_tous_types, boxplot, heatmap
-
-# créer une connexion à la base de données
-engine = create_engine('sqlite:///db.sqlite')
-DBSession = sessionmaker(bind=engine)
-session = DBSession()
+from db.engine import get_db_path, get_engine as get_db_engine
+from db import metrics, queries, snapshot, worker
+from utils import RESTITUTION_AXES, check_figure_size, data_mb, last_update, update, histogramme, paris_map, scatter_par_type, scatter_tous_types, boxplot, heatmap, taux_restitution, delais_restitution
 
-# DOWNLOAD DATA FROM DB
-with engine.begin() as conn:
-    df_lostitem = pd.read_sql(session.query(LostItem).statement, conn)
+# créer une connexion à la base de données, partagée par toutes les sessions
+@st.cache_resource
+def get_engine():
+    return get_db_engine()
 
-with engine.begin() as conn:
-    df_gare = pd.read_sql(session.query(Gare).statement, conn)
 
-with engine.begin() as conn:
-    df_temp = pd.read_sql(session.query(Temperature).statement, conn)
+# DOWNLOAD DATA FROM DB
+# Each chart gets only the aggregate it needs, computed by SQLite from the LostItemDaily rollup.
+# The import publishes the same frames as a memory-mapped Arrow snapshot, read instead of SQLite when up to date.
+# The frames are read-only: they are cached as a resource under the data version, shared by every session of the
+# process, instead of being unpickled again on each rerun. Figures are built from them, never modify them.
+@st.cache_resource(max_entries=4)
+def load_data(version: tuple) -> dict:
+    with metrics.timer("chargement") as measure:
+        data = snapshot.load(get_db_path(), version)
+        measure["source"] = "snapshot" if data is not None else "sqlite"
+        if data is None:
+            with get_engine().begin() as conn:
+                data = queries.dashboard_data(conn)
+        if metrics.enabled():
+            measure["mb"] = round(data_mb(data), 2)
+        return data
+
+
+@st.cache_data(max_entries=4)
+def load_figures(version: tuple) -> dict:
+    data = load_data(version)
+    figures = {
+        "histogramme": histogramme(data["daily_type"]),
+        "scatter_par_type": scatter_par_type(data["temp_type"]),
+        "scatter_tous_types": scatter_tous_types(data["temp_all"]),
+        "boxplot": boxplot(data["daily"]),
+        "heatmap": heatmap(data["daily_type"]),
+    }
+    for name, fig in figures.items():
+        check_figure_size(name, fig)
+    return figures
+
+
+@st.cache_data(max_entries=256)
+def load_map(version: tuple, year: str, type_object: str):
+    data = load_data(version)
+    fig = paris_map(year, type_object, data["station_year"])
+    check_figure_size("paris_map", fig)
+    return fig
+
+
+@st.cache_data(max_entries=16)
+def load_restitution(version: tuple, by: str) -> tuple:
+    data = load_data(version)
+    figures = (taux_restitution(data["restitution"], by), delais_restitution(data["restitution"], by))
+    for name, fig in zip(("taux_restitution", "delais_restitution"), figures):
+        check_figure_size(name, fig)
+    return figures
+
+
+def clear_caches() -> None:
+    load_data.clear()
+    load_figures.clear()
+    load_map.clear()
+    load_restitution.clear()
+
+
+# An update commits window by window: while it runs, every page keeps drawing the version of before the update
+job = worker.status()
+if job is not None and job["state"] == worker.RUNNING:
+    version = job["version_before"]
+else:
+    with get_engine().connect() as conn:
+        version = queries.data_version(conn)
 
 
 st.title("Analyse des objets trouvés dans les gares SNCF à l'aide de l'API OpenData")
 
 
 # DOWNLOAD AND UPDATE DATA FROM API TO DB
-last_update_dates = last_update()
+# The update runs in db.worker's background thread; while it runs this panel polls its status every
+# POLL_SECONDS without rerunning the rest of the page, and reruns the page once the update has ended.
+POLL_SECONDS = 2
 
-if  last_update_dates[0] or last_update_dates[1] :
-    st.write("Dernière mise à jour réalisée le ", min(last_update()))
-else:
-    st.warning("Les tables sont vides!")
 
-if st.button('Mettre à jour les données'):
-    update()
-    st.experimental_rerun()
+def update_panel():
+    job = worker.status()
+    running = job is not None and job["state"] == worker.RUNNING
+    if st.session_state.get("mise_a_jour") is not None and not running:
+        del st.session_state["mise_a_jour"]
+        st.rerun()
+
+    last_update_dates = last_update()
+    if  last_update_dates[0] or last_update_dates[1] :
+        st.write("Dernière mise à jour réalisée le ", min(date for date in last_update_dates if date))
+    else:
+        st.warning("Les tables sont vides!")
+
+    if st.button('Mettre à jour les données', disabled=running):
+        job, _ = worker.start(update, version_before=version, on_success=clear_caches)
+        st.session_state["mise_a_jour"] = job["id"]
+        st.rerun()
+
+    if running:
+        st.session_state["mise_a_jour"] = job["id"]
+        st.info("Mise à jour en cours, les graphiques montrent les données d'avant la mise à jour.")
+        for name, (done, total) in sorted(job["progress"].items()):
+            st.progress(done / total if total else 1.0, text=f"{name} : {done}/{total}")
+    elif job is not None and job["state"] == worker.FAILED:
+        st.error(f"La dernière mise à jour a échoué : {job['error']}")
+
+
+st.fragment(update_panel, run_every=POLL_SECONDS if job is not None and job["state"] == worker.RUNNING else None)()
+
+# The header and the update panel are drawn first, so an empty database still shows the update button
+data = load_data(version)
+figures = load_figures(version)
 
 ####################################################################
 ###### Question 1 : Afficher sur un histogramme plotly la somme du nombre d’objets trouvés par semaine en fonction du type d'objet.
 ####################################################################
 st.subheader("1-Nombre d'objets trouvés par semaine et par type d'objet à partir de 2018")
 
-st.plotly_chart(histogramme(df_lostitem))
+st.plotly_chart(figures["histogramme"])
 
 ####################################################################
 ###### Question 2 : A l'aide de plotly, Affichez une carte de Paris avec le nombre d’objets trouvés en fonction de la fréquentation de voyageur de chaque gare. Possibilité de faire varier par année et par type d’objets
@@ -53,13 +131,12 @@ st.plotly_chart(histogramme(df_lostitem))
 st.subheader("2-Nombre d'objets trouvés pour 1 million d'usagers")
 
 ######### SELECT BOX [year,type_list ] #########
-year = st.selectbox("Choisir une année", ["2019", "2020", "2021","2022","2023"])
-type_list = list(set(df_lostitem['type_objet']))
-type_list.insert(0,"Tous les types")
+year = st.selectbox("Choisir une année", sorted(data["station_year"]["year"].unique()))
+type_list = [queries.TOUS_LES_TYPES] + data["types"]
 type_object = st.selectbox("Choisir un type d'objet",type_list)
 
 ######### FIGURE #########
-st.plotly_chart(paris_map(year,type_object, df_lostitem,df_gare ))
+st.plotly_chart(load_map(version, year, type_object))
 
 ####################################################################
 #### Question 3 : Afficher à l'aide de seaborn le nombre d’objets trouvés par jour en fonction de la température sur un scatterplot.
@@ -71,9 +148,9 @@ type_selector = st.selectbox("", ["Tous les types d'objet","Type par type"])
 
 ######### FIGURE #########
 if type_selector ==  "Type par type":
-    st.plotly_chart(scatter_par_type(df_lostitem,df_temp))
+    st.plotly_chart(figures["scatter_par_type"])
 else:
-    st.plotly_chart(scatter_tous_types(df_lostitem,df_temp))
+    st.plotly_chart(figures["scatter_tous_types"])
 
 
 ####################################################################
@@ -81,7 +158,7 @@ else:
 ####################################################################
 st.subheader("4-Nombre d'objets trouvés en fonction de la saison, tous types d'objet confondus")
 
-st.plotly_chart(boxplot(df_lostitem))
+st.plotly_chart(figures["boxplot"])
 
 ####################################################################
 ####### Question 5: Affichez le nombre d'objets trouvés médian par jour en fonction du type d'objet et de la saison sur une heatmap.
@@ -89,4 +166,23 @@ st.plotly_chart(boxplot(df_lostitem))
 
 st.subheader("5-Nombre d'objets trouvés en fonction de la saison et du type d'objet")
 
-st.plotly_chart(heatmap(df_lostitem))
\ No newline at end of file
+st.plotly_chart(figures["heatmap"])
+
+####################################################################
+####### Question 6: Part des objets restitués et délai de restitution, par gare, type d'objet ou saison.
+####################################################################
+
+st.subheader("6-Restitution des objets trouvés")
+
+restitution_by = st.radio("Regrouper par", list(RESTITUTION_AXES), format_func=RESTITUTION_AXES.get, horizontal=True)
+fig_taux, fig_delais = load_restitution(version, restitution_by)
+st.plotly_chart(fig_taux)
+st.plotly_chart(fig_delais)
+
+
+####################################################################
+####### Mesures des chemins critiques, quand LOST_ITEMS_METRICS est défini (voir db/metrics.py)
+####################################################################
+if metrics.enabled():
+    with st.expander("Mesures de performance"):
+        st.dataframe(metrics.recent()[::-1])
@@ -0,0 +1,125 @@
+"""
+Load test of the HTTP API (api.py) on a synthetic database.
+
+    python -m benchmarks.load_test --items 100000 --clients 8 --requests 2000
+    python -m benchmarks.load_test --url http://127.0.0.1:8000
+
+Each client sends a mix of aggregate and item listing requests over a keep-alive connection. The run
+reports the latency percentiles of every endpoint and the overall requests per second. Without --url,
+a server is started in process on a fresh synthetic database.
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+import numpy as np
+import requests
+
+from api import make_server
+from db.engine import create_db_engine
+from .synthetic import generate
+
+
+def request_mix(n_requests: int, max_id: int, seed: int = 42) -> List[Tuple[str, Dict[str, str]]]:
+    """
+    Draws the requests of a run: mostly aggregates, which the server caches, and item pages at random positions.
+
+    Args:
+        n_requests (int): Number of requests.
+        max_id (int): Highest LostItem id, for the `after` cursor of item pages.
+        seed (int): Seed of the random draws.
+
+    Returns:
+        List[Tuple[str, Dict[str, str]]]: The path and query parameters of each request.
+    """
+    rng = random.Random(seed)
+    choices = [
+        ("/weekly", lambda: {}),
+        ("/stations", lambda: {"year": str(rng.choice([2019, 2020, 2021]))}),
+        ("/temperature", lambda: {}),
+        ("/seasons", lambda: {}),
+        ("/items", lambda: {"after": str(rng.randrange(max_id)), "limit": "100"}),
+    ]
+    mix = []
+    for _ in range(n_requests):
+        path, params = rng.choice(choices)
+        mix.append((path, params()))
+    return mix
+
+
+def run(url: str, mix: List[Tuple[str, Dict[str, str]]], clients: int) -> Tuple[Dict[str, List[float]], float]:
+    """
+    Sends the requests with `clients` concurrent keep-alive sessions.
+
+    Args:
+        url (str): Base URL of the API.
+        mix (List): The requests, as returned by `request_mix`.
+        clients (int): Number of concurrent clients.
+
+    Returns:
+        Tuple[Dict[str, List[float]], float]: The latencies in seconds by endpoint, and the wall time of the run.
+    """
+    local = threading.local()
+
+    def send(request: Tuple[str, Dict[str, str]]) -> Tuple[str, float]:
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        path, params = request
+        start = time.perf_counter()
+        answer = local.session.get(url + path, params=params)
+        answer.raise_for_status()
+        return path, time.perf_counter() - start
+
+    latencies: Dict[str, List[float]] = {}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        for path, latency in executor.map(send, mix):
+            latencies.setdefault(path, []).append(latency)
+    return latencies, time.perf_counter() - start
+
+
+def report(latencies: Dict[str, List[float]], elapsed: float) -> None:
+    every = [latency for values in latencies.values() for latency in values]
+    for path, values in sorted(latencies.items()) + [("total", every)]:
+        p50, p99 = np.percentile(values, [50, 99]) * 1000
+        print(f"{path:<14} {len(values):>7} requêtes  p50 {p50:>8.2f} ms  p99 {p99:>8.2f} ms")
+    print(f"{len(every) / elapsed:.0f} requêtes/s")
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Load test the lost items API.")
+    parser.add_argument("--url", default=None, help="API to test (default: start one on a synthetic database)")
+    parser.add_argument("--items", type=int, default=100_000, help="lost items of the synthetic database")
+    parser.add_argument("--max-id", type=int, default=None, help="highest item id, for item pages (default: --items)")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent clients")
+    parser.add_argument("--requests", type=int, default=2000, help="total number of requests")
+    parser.add_argument("--cache-entries", type=int, default=256, help="answer cache of the in-process server, 0 to disable")
+    args = parser.parse_args(argv)
+    mix = request_mix(args.requests, args.max_id or args.items)
+
+    if args.url:
+        report(*run(args.url.rstrip("/"), mix, args.clients))
+        return 0
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "bench.sqlite")
+        engine = create_db_engine(path)
+        generate(engine, args.items)
+        engine.dispose()
+        server = make_server(port=0, path=path, cache_entries=args.cache_entries)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            report(*run(f"http://127.0.0.1:{server.server_address[1]}", mix, args.clients))
+        finally:
+            server.shutdown()
+            server.server_close()
+            server.engine.dispose()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
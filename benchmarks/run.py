@@ -0,0 +1,175 @@
+"""
+Times the dashboard data load and every chart of utils.py on synthetic databases.
+
+    python -m benchmarks.run --sizes 10000 100000
+    python -m benchmarks.run --sizes 10000 100000 --save-baseline
+
+Each step reports its best wall time over --repeat runs and its peak Python memory (tracemalloc);
+charts also report the size of their JSON payload, which must stay under utils.MAX_FIGURE_KB, and the
+load step the memory held by the frames it returns (utils.data_mb).
+The cold start of the dashboard (benchmarks/startup.py) is reported as the "startup" size.
+When a baseline file exists, the run fails (exit code 1) if a step is slower or uses more memory than
+the baseline by more than --tolerance.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+from db import queries, snapshot
+from db.engine import create_db_engine
+from utils import MAX_FIGURE_KB, data_mb, figure_kb, histogramme, paris_map, scatter_par_type, scatter_tous_types, boxplot, heatmap, taux_restitution, delais_restitution
+from .startup import measure_startup
+from .synthetic import generate
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+MIN_SECONDS = 0.1  # differences under this are noise
+MIN_MB = 1.0
+MIN_KB = 10.0
+
+CHARTS: Dict[str, Callable[[Dict[str, Any]], Any]] = {
+    "histogramme": lambda data: histogramme(data["daily_type"]),
+    "paris_map": lambda data: paris_map("2021", queries.TOUS_LES_TYPES, data["station_year"]),
+    "scatter_par_type": lambda data: scatter_par_type(data["temp_type"]),
+    "scatter_tous_types": lambda data: scatter_tous_types(data["temp_all"]),
+    "boxplot": lambda data: boxplot(data["daily"]),
+    "heatmap": lambda data: heatmap(data["daily_type"]),
+    "taux_restitution": lambda data: taux_restitution(data["restitution"], "nom_gare"),
+    "delais_restitution": lambda data: delais_restitution(data["restitution"], "type_objet"),
+}
+
+
+def measure(step: Callable[[], Any], repeat: int) -> Dict[str, float]:
+    """
+    Runs a step `repeat` times for timing, then once more under tracemalloc for its peak memory.
+
+    Args:
+        step (Callable): The step to measure.
+        repeat (int): Number of timed runs.
+
+    Returns:
+        Dict[str, float]: The best time in seconds and the peak memory in MB.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        step()
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    step()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": round(min(timings), 4), "peak_mb": round(peak / 2**20, 2)}
+
+
+def run_size(n_items: int, repeat: int, **generator_options) -> Dict[str, Dict[str, float]]:
+    """
+    Generates a database of `n_items` lost items and measures the load step and every chart.
+
+    Args:
+        n_items (int): Number of LostItem rows.
+        repeat (int): Number of timed runs per step.
+
+    Returns:
+        Dict[str, Dict[str, float]]: The measures of each step.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        engine = create_db_engine(os.path.join(tmpdir, "bench.sqlite"))
+        generate(engine, n_items, **generator_options)
+
+        def load():
+            with engine.connect() as conn:
+                return queries.dashboard_data(conn)
+
+        results = {"load": measure(load, repeat)}
+        path = os.path.join(tmpdir, "bench.sqlite")
+        version = snapshot.publish(engine, path)
+        if version is not None:
+            results["load_snapshot"] = measure(lambda: snapshot.load(path, version), repeat)
+        data = load()
+        results["load"]["data_mb"] = round(data_mb(data), 2)
+        for name, chart in CHARTS.items():
+            results[name] = measure(lambda: chart(data), repeat)
+            results[name]["payload_kb"] = round(figure_kb(chart(data)), 1)
+        engine.dispose()
+    return results
+
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict], tolerance: float) -> List[str]:
+    """
+    Lists the steps that regressed past the baseline, and the charts heavier than utils.MAX_FIGURE_KB.
+
+    Args:
+        results (Dict[str, Dict]): Measures by size, then by step.
+        baseline (Dict[str, Dict]): Stored measures, same layout.
+        tolerance (float): Allowed relative increase (0.5 = +50 %).
+
+    Returns:
+        List[str]: One message per regression.
+    """
+    regressions = []
+    for size, steps in results.items():
+        for step, measures in steps.items():
+            if measures.get("payload_kb", 0) > MAX_FIGURE_KB:
+                regressions.append(f"{size} {step} payload_kb: {measures['payload_kb']} > {MAX_FIGURE_KB} (limite)")
+            reference = baseline.get(size, {}).get(step)
+            if reference is None:
+                continue
+            for key, minimum in (("seconds", MIN_SECONDS), ("peak_mb", MIN_MB), ("data_mb", MIN_MB), ("payload_kb", MIN_KB)):
+                if key not in measures or key not in reference:
+                    continue
+                limit = reference[key] * (1 + tolerance)
+                if measures[key] > limit and measures[key] - reference[key] > minimum:
+                    regressions.append(f"{size} {step} {key}: {measures[key]} > {reference[key]} (+{tolerance:.0%})")
+    return regressions
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the dashboard pipeline on synthetic data.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000], help="numbers of lost items (10k to 10M)")
+    parser.add_argument("--years", type=int, default=6, help="years of data")
+    parser.add_argument("--stations", type=int, default=7, help="number of stations")
+    parser.add_argument("--types", type=int, default=15, help="number of types of object")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per step")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline JSON file")
+    parser.add_argument("--no-startup", action="store_true", help="do not measure the import time of the dashboard")
+    parser.add_argument("--save-baseline", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=1.0, help="allowed relative regression (1.0 = twice the baseline)")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for size in args.sizes:
+        results[str(size)] = run_size(size, args.repeat, n_years=args.years, n_stations=args.stations, n_types=args.types)
+        for step, measures in results[str(size)].items():
+            payload = f" {measures['payload_kb']:>9.1f} KB" if "payload_kb" in measures else ""
+            payload += f" {measures['data_mb']:>9.2f} MB de données" if "data_mb" in measures else ""
+            print(f"{size:>10} {step:<20} {measures['seconds']:>9.4f}s {measures['peak_mb']:>9.2f} MB{payload}")
+    if not args.no_startup:
+        results["startup"] = {"imports": measure_startup(args.repeat)}
+        print(f"{'startup':>10} {'imports':<20} {results['startup']['imports']['seconds']:>9.4f}s {results['startup']['imports']['peak_mb']:>9.2f} MB")
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        return 0
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION: {regression}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
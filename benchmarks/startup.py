@@ -0,0 +1,114 @@
+"""
+Measures the cold start of the dashboard: the time and memory a fresh Python process needs to import
+everything app.py imports at the top level.
+
+    python -m benchmarks.startup
+
+The imports are read from app.py itself, so the measure follows the dashboard as it changes. The run also
+checks that the ingestion stack stays out of the dashboard's import graph (see LAZY_MODULES).
+"""
+import argparse
+import ast
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP = os.path.join(ROOT, "app.py")
+
+# Only used by an update of the data, or not at all: the dashboard must not import them at startup
+LAZY_MODULES = ["db.import_classes", "dateparser", "requests", "urllib3", "seaborn", "matplotlib"]
+
+
+def app_imports(path: str = APP) -> List[str]:
+    """
+    Lists the top-level import statements of a script.
+
+    Args:
+        path (str): The script.
+
+    Returns:
+        List[str]: The import statements, as source code.
+    """
+    with open(path) as f:
+        tree = ast.parse(f.read())
+    return [ast.unparse(node) for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom))]
+
+
+def _run(code: str) -> str:
+    result = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return result.stdout
+
+
+def loaded_lazy_modules(imports: List[str]) -> List[str]:
+    """
+    Imports the statements in a fresh process and lists the LAZY_MODULES it loaded.
+
+    Args:
+        imports (List[str]): Import statements.
+
+    Returns:
+        List[str]: The lazy modules that were imported anyway.
+    """
+    code = "\n".join(imports + ["import json, sys", f"print(json.dumps([m for m in {LAZY_MODULES!r} if m in sys.modules]))"])
+    return json.loads(_run(code))
+
+
+# Printed by the measured process: its peak resident memory in KB. VmHWM belongs to the process image,
+# while ru_maxrss would also count the pages of the benchmark process it was forked from.
+_PEAK_KB = """
+import resource
+try:
+    with open("/proc/self/status") as f:
+        print(next(int(line.split()[1]) for line in f if line.startswith("VmHWM")))
+except OSError:
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def measure_startup(repeat: int, imports: List[str] = None) -> Dict[str, float]:
+    """
+    Times the import statements in fresh processes, minus the start of an empty interpreter.
+
+    Args:
+        repeat (int): Number of timed processes.
+        imports (List[str], optional): Import statements. Defaults to those of app.py.
+
+    Returns:
+        Dict[str, float]: The best time in seconds and the peak resident memory of the processes in MB.
+    """
+    code = "\n".join((imports or app_imports()) + [_PEAK_KB])
+
+    def best(source: str) -> Tuple[float, int]:
+        timings, peaks = [], []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            peaks.append(int(_run(source).split()[-1]))
+            timings.append(time.perf_counter() - start)
+        return min(timings), max(peaks)
+
+    seconds, peak_kb = best(code)
+    seconds_empty, _ = best(_PEAK_KB)
+    return {"seconds": round(seconds - seconds_empty, 4), "peak_mb": round(peak_kb / 1024, 2)}
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Measure the import time of the dashboard.")
+    parser.add_argument("--repeat", type=int, default=5, help="timed processes")
+    args = parser.parse_args(argv)
+
+    imports = app_imports()
+    measures = measure_startup(args.repeat, imports)
+    print(f"imports de app.py {measures['seconds']:>9.4f}s {measures['peak_mb']:>9.2f} MB")
+    loaded = loaded_lazy_modules(imports)
+    if loaded:
+        print(f"REGRESSION: app.py importe {', '.join(loaded)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
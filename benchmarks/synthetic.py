@@ -0,0 +1,78 @@
+"""
+Deterministic synthetic LostItem / Gare / Temperature data for the benchmarks.
+"""
+import numpy as np
+import pandas as pd
+from sqlalchemy import insert
+from sqlalchemy.engine import Engine
+from db.model import Frequentation, Gare, Temperature, TypeObjet, create_tables
+from db.import_classes import rebuild_rollups
+
+CHUNK_SIZE = 200_000
+
+
+def generate(engine: Engine, n_items: int, start_year: int = 2018, n_years: int = 6, n_stations: int = 7, n_types: int = 15, seed: int = 42) -> None:
+    """
+    Fills an empty database with synthetic data. The same arguments always produce the same rows.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): Engine on the database to fill.
+        n_items (int): Number of LostItem rows.
+        start_year (int): First year of data.
+        n_years (int): Number of years of data.
+        n_stations (int): Number of stations.
+        n_types (int): Number of types of object.
+        seed (int): Seed of the random generator.
+    """
+    rng = np.random.default_rng(seed)
+    create_tables(engine)
+
+    days = pd.date_range(f"{start_year}-01-01", f"{start_year + n_years - 1}-12-31", freq="D")
+    day_labels = days.strftime("%Y-%m-%d").to_numpy()
+    stations = [f"Gare {i:03d}" for i in range(n_stations)]
+    types = [f"Type {i:02d}" for i in range(n_types)]
+
+    # Some stations and types are much busier than others, as in the real data
+    station_weights = rng.pareto(1.5, n_stations) + 1
+    station_weights /= station_weights.sum()
+    type_weights = 1 / np.arange(1, n_types + 1)
+    type_weights /= type_weights.sum()
+
+    with engine.begin() as conn:
+        conn.execute(insert(Gare), [
+            {
+                "nom_gare": station,
+                "longitude": 2.35 + rng.normal(0, 0.03),
+                "latitude": 48.86 + rng.normal(0, 0.02),
+            }
+            for station in stations
+        ])
+        # Frequentation is only published for a few years, like the SNCF dataset
+        conn.execute(insert(Frequentation), [
+            {"nom_gare": station, "annee": str(annee), "voyageurs": int(rng.integers(5_000_000, 250_000_000))}
+            for station in stations
+            for annee in (2019, 2020, 2021)
+        ])
+        seasonal = 12 - 8 * np.cos(2 * np.pi * days.dayofyear.to_numpy() / 365.25)
+        temperatures = seasonal + rng.normal(0, 3, len(days))
+        conn.execute(insert(Temperature), [
+            {"date": date, "temperature": float(temp), "temp_sum": float(temp), "temp_count": 1, "temp_min": float(temp), "temp_max": float(temp)}
+            for date, temp in zip(day_labels, temperatures)
+        ])
+        conn.execute(insert(TypeObjet), [{"id": i + 1, "libelle": libelle} for i, libelle in enumerate(types)])
+
+        for offset in range(0, n_items, CHUNK_SIZE):
+            size = min(CHUNK_SIZE, n_items - offset)
+            day_index = rng.integers(0, len(days), size)
+            type_id = rng.choice(n_types, size, p=type_weights) + 1
+            station_index = rng.choice(n_stations, size, p=station_weights)
+            restitue = rng.random(size) < 0.3
+            delay = pd.to_timedelta(rng.integers(3_600, 30 * 86_400, size), unit="s")
+            restitution = (days[day_index] + delay).strftime("%Y-%m-%d %H:%M:%S").to_numpy().astype(object)
+            restitution[~restitue] = None
+            conn.exec_driver_sql(
+                'INSERT INTO "LostItem" (date, type_id, nom_gare, date_restitution) VALUES (?, ?, ?, ?)',
+                list(zip(day_labels[day_index], type_id.tolist(), np.array(stations, dtype=object)[station_index], restitution)),
+            )
+
+        rebuild_rollups(conn)
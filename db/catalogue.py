@@ -0,0 +1,54 @@
+"""
+Catalogue of the stations whose lost items are imported, kept as data rather than in the importers.
+
+The catalogue is db/stations.json, or the JSON file named by the LOST_ITEMS_STATIONS environment variable:
+
+    {"stations": ["Paris Est", "Paris Bercy"], "alias": {"Paris Bercy": "Paris Bercy Bourgogne - Pays d'Auvergne"}}
+
+"stations": "*" tracks every station of the lost items dataset: LostItemImporter then fetches windows of
+the whole network instead of one station at a time, and GareImporter finds the stations in the facets of
+the dataset. "alias" gives the name of a station in the station reference and frequentation datasets
+when it differs from its name in the lost items.
+"""
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+ENV_VAR = "LOST_ITEMS_STATIONS"
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stations.json")
+
+# Station key of the windows covering the whole network
+ALL_STATIONS = "*"
+
+
+def load(path: Optional[str] = None) -> Tuple[List[str], Dict[str, str]]:
+    """
+    Reads the station catalogue.
+
+    Args:
+        path (str, optional): The JSON file. Defaults to $LOST_ITEMS_STATIONS, then db/stations.json.
+
+    Returns:
+        Tuple[List[str], Dict[str, str]]: The stations ([ALL_STATIONS] for the whole network) and the aliases.
+    """
+    path = path or os.environ.get(ENV_VAR) or DEFAULT_PATH
+    with open(path, encoding="utf-8") as f:
+        catalogue = json.load(f)
+    stations = catalogue["stations"]
+    return ([ALL_STATIONS] if stations == ALL_STATIONS else list(stations)), dict(catalogue.get("alias", {}))
+
+
+def restrict(station_list: List[str], stations: List[str]) -> List[str]:
+    """
+    Restricts a station list to some stations, e.g. the --stations of main.py.
+
+    Args:
+        station_list (List[str]): The stations of an importer, possibly [ALL_STATIONS].
+        stations (List[str]): The stations to keep.
+
+    Returns:
+        List[str]: The stations of `station_list` that are in `stations`, or `stations` for the whole network.
+    """
+    if station_list == [ALL_STATIONS]:
+        return list(stations)
+    return [station for station in station_list if station in stations]
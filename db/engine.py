@@ -0,0 +1,89 @@
+import os
+import threading
+from typing import Dict, Optional
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+
+DEFAULT_DB_PATH = "db.sqlite"
+
+# Applied to every new SQLite connection. WAL lets the dashboard read while an import writes.
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -64000,  # 64 MB
+    "mmap_size": 268435456,  # 256 MB
+    "temp_store": "MEMORY",
+}
+BUSY_TIMEOUT = 30  # seconds a writer waits for another writer before "database is locked"
+
+_engines: Dict[str, Engine] = {}
+_engines_lock = threading.Lock()
+
+
+def get_db_path() -> str:
+    """
+    Returns the path of the database file, taken from the LOST_ITEMS_DB environment variable if set.
+
+    Returns:
+        str: The path of the SQLite file.
+    """
+    return os.environ.get("LOST_ITEMS_DB", DEFAULT_DB_PATH)
+
+
+def _apply_pragmas(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    for name, value in PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+
+def _apply_query_only(dbapi_connection, connection_record) -> None:
+    dbapi_connection.execute("PRAGMA query_only = ON")
+
+
+def create_db_engine(path: Optional[str] = None, read_only: bool = False) -> Engine:
+    """
+    Creates a new engine on the SQLite file with the performance pragmas applied on connect.
+
+    Args:
+        path (str, optional): Path of the SQLite file. Defaults to `get_db_path()`.
+        read_only (bool): Reject every write on the engine's connections (PRAGMA query_only).
+
+    Returns:
+        sqlalchemy.engine.Engine: The engine.
+    """
+    engine = create_engine(f"sqlite:///{path or get_db_path()}", connect_args={"timeout": BUSY_TIMEOUT})
+    event.listen(engine, "connect", _apply_pragmas)
+    if read_only:
+        event.listen(engine, "connect", _apply_query_only)
+    return engine
+
+
+def get_engine(path: Optional[str] = None) -> Engine:
+    """
+    Returns the engine shared by the whole process for a database file, creating it on first use.
+
+    Args:
+        path (str, optional): Path of the SQLite file. Defaults to `get_db_path()`.
+
+    Returns:
+        sqlalchemy.engine.Engine: The shared engine.
+    """
+    path = path or get_db_path()
+    with _engines_lock:
+        if path not in _engines:
+            _engines[path] = create_db_engine(path)
+        return _engines[path]
+
+
+def dispose_engine(path: Optional[str] = None) -> None:
+    """
+    Closes and forgets the shared engine of a database file, e.g. before the file is deleted.
+
+    Args:
+        path (str, optional): Path of the SQLite file. Defaults to `get_db_path()`.
+    """
+    with _engines_lock:
+        engine = _engines.pop(path or get_db_path(), None)
+    if engine is not None:
+        engine.dispose()
@@ -0,0 +1,99 @@
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import time
+from typing import Any, Dict, Optional
+
+DEFAULT_CACHE_DIR = os.path.join(".cache", "http")
+
+
+class CacheMiss(LookupError):
+    """Raised in replay mode when a URL was never downloaded."""
+
+
+class CachedResponse:
+    """
+    A response read back from the cache. It offers the parts of requests.Response the importers use.
+    """
+
+    status_code = 200
+
+    def __init__(self, url: str, content: bytes, headers: Dict[str, str]):
+        self.url = url
+        self.content = content
+        self.headers = headers
+
+    def json(self) -> Any:
+        return json.loads(self.content)
+
+    def raise_for_status(self) -> None:
+        pass
+
+
+class ResponseCache:
+    """
+    On-disk cache of raw API responses, keyed by URL, or by a stable key for windows that are still open
+    (see `Importer._cache_key`).
+
+    Each body is stored gzip-compressed next to a small JSON file holding its URL, ETag and Last-Modified,
+    so open windows can be revalidated with a conditional request.
+
+    Attributes:
+    -----------
+    directory : str
+        Folder of the cache files.
+    replay : bool
+        If True, responses are only read from the cache and the network is never used.
+    """
+
+    def __init__(self, directory: Optional[str] = None, replay: bool = False):
+        self.directory = directory or os.environ.get("LOST_ITEMS_HTTP_CACHE", DEFAULT_CACHE_DIR)
+        self.replay = replay
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, url: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(url.encode()).hexdigest())
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        """
+        Reads a response from the cache.
+
+        Args:
+            key (str): The requested URL, or the key it was stored under.
+
+        Returns:
+            CachedResponse: The stored response, or None if the key is not cached.
+        """
+        path = self._path(key)
+        try:
+            with open(path + ".json") as f:
+                meta = json.load(f)
+            with gzip.open(path + ".gz", "rb") as f:
+                content = f.read()
+        except FileNotFoundError:
+            return None
+        return CachedResponse(meta.get("url", key), content, meta["headers"])
+
+    def put(self, key: str, content: bytes, headers: Dict[str, str], url: Optional[str] = None) -> None:
+        """
+        Stores a response, replacing the previous one of the key. Files are written under a temporary name
+        then renamed, so concurrent fetch threads and interrupted runs never leave a partial entry.
+
+        Args:
+            key (str): The requested URL, or the stable key of an open window.
+            content (bytes): The raw body.
+            headers (Dict[str, str]): The response headers; only the validators are kept.
+            url (str, optional): The requested URL, if different from the key.
+        """
+        path = self._path(key)
+        validators = {name: headers[name] for name in ("ETag", "Last-Modified") if name in headers}
+        meta = {"url": url or key, "fetched_at": time.time(), "headers": validators}
+
+        with tempfile.NamedTemporaryFile(dir=self.directory, delete=False) as f:
+            f.write(gzip.compress(content))
+        os.replace(f.name, path + ".gz")
+        with tempfile.NamedTemporaryFile("w", dir=self.directory, delete=False) as f:
+            json.dump(meta, f)
+        os.replace(f.name, path + ".json")
@@ -1,12 +1,23 @@
 import requests
 import logging
-from datetime import datetime
-from dateparser import parse
-from sqlalchemy import create_engine, func
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import func, insert, delete, select, case
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import sessionmaker
-from .model import LostItem, Temperature, Gare
-from typing import List, Tuple, Optional
-from sqlalchemy.engine import Engine
+from .model import Frequentation, LostItem, LostItemDaily, Temperature, Gare, ImportState, TypeObjet
+from .saisons import SAISONS, saisons
+from .restitution import TRANCHE_COLUMNS, delai_sql, delais, tranche_counts_sql, tranches
+from .engine import get_engine
+from .http_cache import CacheMiss, ResponseCache
+from . import catalogue, metrics
+from typing import Any, Callable, Dict, Iterator, List, Tuple, Optional
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import quote
+from sqlalchemy.engine import Connection, Engine
 from sqlalchemy.orm import Session
 from abc import ABCMeta, abstractmethod  # permet de définir des classes de base
 import pandas as pd
@@ -14,20 +25,402 @@ import pandas as pd
 
 logging.basicConfig(level=logging.INFO)
 
+
+def parse_date(value: str) -> datetime:
+    """
+    Parses a date given on the command line or stored as a watermark.
+
+    ISO 8601 dates and timestamps, and "now", are parsed directly; anything else ("1 january 2022",
+    "yesterday"...) goes through dateparser, which is slow to import and to run.
+
+    Args:
+        value (str): The date to parse.
+
+    Returns:
+        datetime: The parsed date, or None if dateparser does not understand it either.
+    """
+    value = str(value).strip()
+    if value.lower() == "now":
+        return datetime.now()
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        from dateparser import parse
+        return parse(value)
+
+
+def to_utc_timestamp(timestamp: Optional[str]) -> Optional[str]:
+    """
+    Converts an ISO timestamp with offset to the compact, sortable 'YYYY-MM-DD HH:MM:SS' UTC form
+    (the same result as SQLite's datetime()).
+
+    Args:
+        timestamp (str): An ISO 8601 timestamp such as '2019-01-13T17:44:44+01:00', or None.
+
+    Returns:
+        str: The UTC timestamp, or None.
+    """
+    if timestamp is None:
+        return None
+    parsed = datetime.fromisoformat(timestamp)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc)
+    return parsed.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def rebuild_rollups(conn: Connection) -> None:
+    """
+    Recomputes LostItemDaily from the whole LostItem table, without committing.
+
+    Args:
+        conn (sqlalchemy.engine.Connection): The connection (or session) to run the statements on.
+    """
+    conn.execute(delete(LostItemDaily))
+    mois_jour = func.strftime("%m-%d", LostItem.date)
+    saison_sql = case(
+        (mois_jour.between("03-20", "06-20"), SAISONS[1]),
+        (mois_jour.between("06-21", "09-21"), SAISONS[2]),
+        (mois_jour.between("09-22", "12-20"), SAISONS[3]),
+        else_=SAISONS[0],
+    )
+    delai = delai_sql(LostItem.date, LostItem.date_restitution)
+    daily_counts = (
+        select(
+            LostItem.date, TypeObjet.libelle, LostItem.nom_gare, saison_sql, func.count(),
+            func.count(LostItem.date_restitution), func.coalesce(func.sum(delai), 0), *tranche_counts_sql(delai),
+        )
+        .join(TypeObjet, TypeObjet.id == LostItem.type_id)
+        .group_by(LostItem.date, TypeObjet.libelle, LostItem.nom_gare)
+    )
+    columns = ["date", "type_objet", "nom_gare", "saison", "count", "restitues", "delai_jours"] + TRANCHE_COLUMNS
+    conn.execute(insert(LostItemDaily).from_select(columns, daily_counts))
+
+
+def _days(start: str, end: str) -> int:
+    return (datetime.fromisoformat(end) - datetime.fromisoformat(start)).days + 1
+
+
 class Importer(metaclass = ABCMeta):
+
+    derived_models = ()
+    chunk_size = 5000
+    row_limit = 10000
+    max_workers = 4
+    request_timeout = 60
+    retry_total = 5
+    retry_backoff = 0.5
+    retry_status = (429, 500, 502, 503, 504)
+    closed_after_days = 7  # windows ending before today - 7 days no longer change and are served from the cache
+    # Called with (table, key, windows stored, windows planned) as each window of an import is stored (see db/worker.py)
+    progress: Optional[Callable[[str, Tuple[str, ...], int, int], None]] = None
     
-    def __init__(self, engine: Engine):
+    def __init__(self, engine: Engine, chunk_size: Optional[int] = None, max_workers: Optional[int] = None, cache: Optional[ResponseCache] = None):
         """
             Initializes a new Importer instance.
 
             Args:
                 engine (sqlalchemy.engine.Engine): The SQLAlchemy database engine to use.
+                chunk_size (int, optional): Number of rows sent per executemany batch.
+                max_workers (int, optional): Number of API requests running at the same time.
+                cache (ResponseCache, optional): On-disk cache of the API responses. No cache if omitted.
         """
         self.engine = engine
+        self.cache = cache
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+        if max_workers is not None:
+            self.max_workers = max_workers
         self.Session = sessionmaker(bind=engine)
         self.session = self.Session()
+        self.http = self._create_http_session()
         self._init_attributes()
 
+    def _create_http_session(self) -> requests.Session:
+        """
+        Creates the keep-alive HTTP session shared by the fetch threads.
+
+        The connection pool holds one connection per worker, and 429/5xx answers are retried
+        with exponential backoff (honouring Retry-After).
+
+        Returns:
+            requests.Session: The configured session.
+        """
+        retry = Retry(
+            total=self.retry_total,
+            backoff_factor=self.retry_backoff,
+            status_forcelist=self.retry_status,
+            allowed_methods=["GET"],
+            respect_retry_after_header=True,
+        )
+        adapter = HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers, max_retries=retry)
+        http = requests.Session()
+        http.mount("https://", adapter)
+        http.mount("http://", adapter)
+        return http
+
+    def _fetch(self, endpoint: str, closed: bool = False, cache_key: Optional[str] = None) -> requests.Response:
+        """
+        Sends one GET request through the shared session, going through the response cache if there is one.
+
+        A closed window is served from the cache when present. An open one is revalidated with
+        If-None-Match / If-Modified-Since and the cached body is reused on a 304 answer.
+
+        The URL of an open window ends today, so it changes every day: the window is cached under
+        `cache_key` instead (see `_cache_key`), which keeps its newest answer. In replay mode, a window
+        that was still open when it was cached is read from that key.
+
+        Args:
+            endpoint (str): The URL to request.
+            closed (bool): Whether the data behind the URL can no longer change.
+            cache_key (str, optional): The stable key of the window, the URL if omitted.
+
+        Returns:
+            requests.Response: The response, once retries are exhausted or it succeeded.
+
+        Raises:
+            requests.HTTPError: If the final answer is an error status.
+            CacheMiss: In replay mode, if the URL is not cached.
+        """
+        with metrics.timer("requete", source=self.TableModel.__tablename__, url=endpoint) as measure:
+            key = endpoint if closed or cache_key is None else cache_key
+            cached = self.cache.get(key) if self.cache is not None else None
+            if cached is None and self.cache is not None and self.cache.replay and cache_key is not None:
+                cached = self.cache.get(cache_key)
+            if cached is not None and (closed or self.cache.replay):
+                measure["cache"] = "hit"
+                measure["bytes"] = len(cached.content)
+                return cached
+            if self.cache is not None and self.cache.replay:
+                raise CacheMiss(endpoint)
+
+            headers = {}
+            if cached is not None:
+                if "ETag" in cached.headers:
+                    headers["If-None-Match"] = cached.headers["ETag"]
+                if "Last-Modified" in cached.headers:
+                    headers["If-Modified-Since"] = cached.headers["Last-Modified"]
+
+            my_request = self.http.get(endpoint, headers=headers, timeout=self.request_timeout)
+            measure["status"] = my_request.status_code
+            if my_request.status_code == 304 and cached is not None:
+                measure["cache"] = "revalidated"
+                measure["bytes"] = len(cached.content)
+                return cached
+            my_request.raise_for_status()
+            measure["cache"] = "miss"
+            measure["bytes"] = len(my_request.content)
+            if self.cache is not None:
+                self.cache.put(key, my_request.content, my_request.headers, url=endpoint)
+            return my_request
+
+    def _cache_key(self, window: Tuple[str, ...]) -> str:
+        """
+        Builds the cache key of a window that is still open: its endpoint with the end moved to the end of
+        its calendar year, marked so it never matches the URL of the closed window.
+
+        Args:
+            window (Tuple[str, ...]): The window, ending with its start and end dates.
+
+        Returns:
+            str: The same key on every day until the window is closed.
+        """
+        return self._create_endpoint(*window[:-1], window[-2][:4] + "-12-31") + "#ouverte"
+
+    def _is_closed(self, window: Tuple[str, ...]) -> bool:
+        """
+        Tells whether a window ended long enough ago for its data to be final.
+
+        Args:
+            window (Tuple[str, ...]): The window, ending with its start and end dates.
+
+        Returns:
+            bool: True if the window ends more than `closed_after_days` days ago.
+        """
+        return window[-1] < str((datetime.now() - timedelta(days=self.closed_after_days)).date())
+
+    def _fetch_pipeline(self, jobs: List[Tuple], executor: Optional[ThreadPoolExecutor] = None) -> Iterator[Tuple[Any, requests.Response]]:
+        """
+        Fetches endpoints concurrently and yields the responses in job order.
+
+        At most `max_workers` requests run at the same time and at most twice that many
+        responses are buffered, so the caller (the single DB writer) inserts one response
+        while the next ones are downloading.
+
+        Args:
+            jobs (List[Tuple]): (key, endpoint) tuples, optionally followed by the closed and cache_key arguments
+                of `_fetch`. The key is yielded back unchanged.
+            executor (ThreadPoolExecutor, optional): Pool to submit to. A new one is created if omitted.
+
+        Yields:
+            Tuple[Any, requests.Response]: The key and the response of each job.
+        """
+        if executor is None:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                yield from self._fetch_pipeline(jobs, executor)
+            return
+
+        pending = deque()
+        for key, endpoint, *options in jobs:
+            pending.append((key, executor.submit(self._fetch, endpoint, *options)))
+            if len(pending) >= 2 * self.max_workers:
+                key, future = pending.popleft()
+                yield key, future.result()
+        while pending:
+            key, future = pending.popleft()
+            yield key, future.result()
+
+    def _split_window(self, start: str, end: str) -> List[Tuple[str, str]]:
+        """
+        Splits a date window into smaller consecutive windows: months, then weeks, then days.
+
+        Args:
+            start (str): The first day of the window in the format 'YYYY-MM-DD'.
+            end (str): The last day of the window in the format 'YYYY-MM-DD'.
+
+        Returns:
+            List[Tuple[str, str]]: The sub-windows, or an empty list if the window is a single day.
+        """
+        start_day = datetime.fromisoformat(start).date()
+        end_day = datetime.fromisoformat(end).date()
+        n_days = (end_day - start_day).days + 1
+        windows = []
+        current = start_day
+
+        while current <= end_day:
+            if n_days > 31:
+                next_month = (current.replace(day=1) + timedelta(days=32)).replace(day=1)
+                window_end = next_month - timedelta(days=1)
+            elif n_days > 7:
+                window_end = current + timedelta(days=6)
+            elif n_days > 1:
+                window_end = current
+            else:
+                return []
+            window_end = min(window_end, end_day)
+            windows.append((str(current), str(window_end)))
+            current = window_end + timedelta(days=1)
+        return windows
+
+    def _import_windows(self, windows: List[Tuple[str, ...]], executor: Optional[ThreadPoolExecutor] = None) -> None:
+        """
+        Fetches and stores a list of windows, splitting every window whose answer was truncated.
+
+        A window is the tuple of `_create_endpoint` arguments, ending with its start and end dates.
+        Each response is parsed once; when `nhits` exceeds the records returned, the window is
+        re-fetched as smaller windows before moving on, so no window holds more than `row_limit`
+        records in memory.
+
+        Args:
+            windows (List[Tuple[str, ...]]): The windows to import, in order.
+            executor (ThreadPoolExecutor, optional): Pool shared with the sub-window fetches.
+        """
+        if executor is None:
+            self._top_windows = set(windows)
+            self._planned = Counter(window[:-2] for window in windows)
+            self._stored = Counter()
+            for key in self._planned:
+                self._report_progress(key)
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                return self._import_windows(windows, executor)
+
+        jobs = [(window, self._create_endpoint(*window), self._is_closed(window), self._cache_key(window)) for window in windows]
+        for window, my_request in self._fetch_pipeline(jobs, executor):
+            with metrics.timer("lecture", source=self.TableModel.__tablename__, window=", ".join(window)) as measure:
+                payload = my_request.json()
+                records = payload["records"]
+                nhits = payload.get("nhits", len(records))
+                measure["records"] = len(records)
+
+            if nhits > len(records):
+                sub_windows = self._split_window(window[-2], window[-1])
+                if sub_windows:
+                    logging.info(f"DECOUPAGE: {', '.join(window)}, {nhits} > {len(records)}")
+                    del payload, records
+                    self._import_windows([window[:-2] + sub_window for sub_window in sub_windows], executor)
+                    self._window_stored(window)
+                    continue
+                logging.warning(f"TRONQUE: {', '.join(window)}, {len(records)}/{nhits}")
+
+            logging.info(f"REQUETE: {', '.join(window)}, {len(records)}")
+            with metrics.timer("stockage", source=self.TableModel.__tablename__, window=", ".join(window), records=len(records)):
+                self._store_window(window, records)
+            self._window_stored(window)
+
+    def _window_stored(self, window: Tuple[str, ...]) -> None:
+        # A window split into sub-windows counts once, when the last of them is stored
+        if window in self._top_windows:
+            self._stored[window[:-2]] += 1
+            self._report_progress(window[:-2])
+
+    def _report_progress(self, key: Tuple[str, ...]) -> None:
+        if self.progress is not None:
+            self.progress(self.TableModel.__tablename__, key, self._stored[key], self._planned[key])
+
+    def _store_window(self, window: Tuple[str, ...], records: List[Dict[str, Any]]) -> None:
+        """
+        Stores the records of one complete window and checkpoints it in the same transaction.
+
+        Rows already stored for the window are replaced, so a window can be fetched again
+        (an update of the current day, a resumed run) without duplicating rows.
+
+        Args:
+            window (Tuple[str, ...]): The window the records belong to.
+            records (List[dict]): The "records" list of the response.
+        """
+        self._delete_window(window)
+        self._save_checkpoint(window[:-2], window[-1])
+        if records:
+            self._insert_records(records)
+        else:
+            self.session.commit()
+
+    def _delete_window(self, window: Tuple[str, ...]) -> None:
+        """
+        Deletes the rows of the TableModel that belong to a window, without committing.
+
+        Args:
+            window (Tuple[str, ...]): The window, ending with its start and end dates.
+        """
+        self.session.execute(delete(self.TableModel).where(self.TableModel.date.between(window[-2], window[-1])))
+
+    def _window_keys(self) -> List[Tuple[str, ...]]:
+        """
+        Lists the keys the source is fetched by (the `_create_endpoint` arguments before the dates).
+
+        Returns:
+            List[Tuple[str, ...]]: One tuple per key. The base source has a single empty key.
+        """
+        return [()]
+
+    def _get_watermark(self, key: Tuple[str, ...]) -> Optional[str]:
+        """
+        Retrieves the last fully ingested date recorded for a key.
+
+        Args:
+            key (Tuple[str, ...]): The key, as returned by `_window_keys`.
+
+        Returns:
+            str: The date in the format 'YYYY-MM-DD', or None if the key was never imported.
+        """
+        state = self.session.get(ImportState, (self.TableModel.__tablename__, ", ".join(key)))
+        return None if state is None else state.last_date
+
+    def _save_checkpoint(self, key: Tuple[str, ...], last_date: str) -> None:
+        """
+        Advances the watermark of a key and stamps its write time, without committing.
+
+        The write time changes even when a window is stored again with the same watermark, so
+        `queries.data_version` sees every commit.
+
+        Args:
+            key (Tuple[str, ...]): The key, as returned by `_window_keys`.
+            last_date (str): The last day of the window just stored, in the format 'YYYY-MM-DD'.
+        """
+        current = self._get_watermark(key)
+        if current is not None and current > last_date:
+            last_date = current
+        self.session.merge(ImportState(source=self.TableModel.__tablename__, station=", ".join(key), last_date=last_date, updated=time.time()))
+
 
     @abstractmethod
     def _init_attributes(self):
@@ -51,10 +444,16 @@ class Importer(metaclass = ABCMeta):
         Returns:
         Tuple[datetime, datetime]: A tuple containing the start and end dates as datetime objects.
         """
-        start_parse = parse(str(start_date))
-        end_parse = parse(str(end_date))
+        start_parse = parse_date(start_date)
+        end_parse = parse_date(end_date)
         return start_parse, end_parse
 
+    def _date_windows(self, key: Tuple[str, ...], start: str, end: str) -> List[Tuple[str, str]]:
+        """
+        Cuts the date range of one key into the windows requested first: years, unless an importer needs smaller ones.
+        """
+        return self._get_year_range(start, end)
+
     def _get_year_range(self, start_date: str, end_date: str) -> List[Tuple[str, str]]:
         """
         Gets a list of year ranges based on the start and end dates.
@@ -84,12 +483,24 @@ class Importer(metaclass = ABCMeta):
         return year_ranges
 
 
-    def clean(self) -> None:
+    def clean(self, stations: Optional[List[str]] = None) -> None:
         """
-        Cleans the database by deleting all records from the TableModel.
+        Cleans the database by deleting all records from the TableModel, its rollup tables and its import watermarks.
+
+        Args:
+            stations (List[str], optional): Only delete the rows and watermarks of these stations. Ignored by
+                sources without stations, which are always cleaned entirely.
         """
-        self.session.query(self.TableModel).delete()
-        # self.session.query(LostItem).delete()
+        by_station = stations is not None and hasattr(self.TableModel, "nom_gare")
+        for model in (self.TableModel,) + tuple(self.derived_models):
+            query = self.session.query(model)
+            if by_station:
+                query = query.filter(model.nom_gare.in_(stations))
+            query.delete(synchronize_session=False)
+        state = self.session.query(ImportState).filter(ImportState.source == self.TableModel.__tablename__)
+        if by_station:
+            state = state.filter(ImportState.station.in_(stations))
+        state.delete(synchronize_session=False)
         self.session.commit()
       
     @abstractmethod
@@ -107,7 +518,7 @@ class Importer(metaclass = ABCMeta):
         Returns:
             str: Last date as a string in the format 'YYYY-MM-DD'.
         """
-        date_string = self.session.query(func.max(LostItem.date)).scalar()
+        date_string = self.session.query(func.max(self.TableModel.date)).scalar()
         if date_string is None:
             return None
         else:
@@ -115,16 +526,54 @@ class Importer(metaclass = ABCMeta):
     
     def update(self)-> None:
         """
-        Public method that updates the database by importing new data. It retrieves the last date from the database
-        and imports data from that date up to the current date.
+        Public method that updates the database by importing new data. For each key (station) it reads the
+        import watermark and fetches only the windows from the first day of its month up to the current date.
+        Keys without a watermark fall back to the last date found in the table.
+
+        Starting from the month keeps the same open window, and so the same cache entry, for every update
+        of the month instead of one new window per day.
         
         Returns:
             None.
         """
-        last_date = self._get_last_date()
-        start_date,end_date = self._parse_date(last_date, 'now')
-        if start_date!=end_date:
-            self.import_data(self._get_last_date(),"now")
+        fallback_date = None
+        windows = []
+        for key in self._window_keys():
+            last_date = self._get_watermark(key)
+            if last_date is None:
+                fallback_date = fallback_date or self._get_last_date()
+                last_date = fallback_date
+            if last_date is None:
+                logging.warning(f"MISE A JOUR: aucune donnée pour {self.TableModel.__tablename__} {', '.join(key)}, lancer import_data")
+                continue
+            windows += [key + window for window in self._date_windows(key, last_date[:8] + "01", "now")]
+
+        self._import_windows(windows)
+
+    def resume(self, start_date: str, end_date: str) -> None:
+        """
+        Public method that imports a date range without cleaning, skipping for each key the windows that were
+        already checkpointed. It continues an interrupted import_data from the last committed window.
+
+        Args:
+            start_date (str): The start date of the range.
+            end_date (str): The end date of the range.
+
+        Returns:
+            None.
+        """
+        start_parse, end_parse = self._parse_date(start_date, end_date)
+        start_iso, end_iso = str(start_parse.date()), str(end_parse.date())
+        windows = []
+        for key in self._window_keys():
+            last_date = self._get_watermark(key)
+            key_start = start_iso if last_date is None or last_date < start_iso else last_date
+            if key_start > end_iso:
+                continue
+            windows += [key + window for window in self._date_windows(key, key_start, end_iso)]
+            logging.info(f"REPRISE: {self.TableModel.__tablename__} {', '.join(key)} à partir du {key_start}")
+
+        self._import_windows(windows)
 
     def _insert(self, my_request: requests.Response) -> None:
         """
@@ -136,17 +585,68 @@ class Importer(metaclass = ABCMeta):
         Returns:
             None.
         """
-        for row in my_request.json()["records"]:
-                row_data = {} 
-                for field in self.field_list:
-                    try: 
-                        row_data[field[0]] = row["fields"][field[1]]
-                    except KeyError:
-                        row_data[field[0]] = None
+        self._insert_records(my_request.json()["records"])
 
-                # self.session.add(LostItem(**temp_data))
-                self.session.add(self.TableModel(**row_data))
+    def _build_rows(self, records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Private method that maps API records to table rows using `field_list`.
+
+        Args:
+            records (List[dict]): The "records" list of an API response.
+
+        Returns:
+            List[dict]: One dict per record, keyed by column name. Missing API fields are set to None.
+        """
+        rows = []
+        for row in records:
+            fields = row["fields"]
+            rows.append({column: fields.get(api_field) for column, api_field in self.field_list})
+        return rows
+
+    def _insert_records(self, records: List[Dict[str, Any]]) -> int:
+        """
+        Private method that builds the rows of a response once and writes them with executemany inserts.
+
+        Args:
+            records (List[dict]): The "records" list of an API response.
+
+        Returns:
+            int: The number of inserted rows.
+        """
+        return self._bulk_insert(self._build_rows(records))
+
+    def _bulk_insert(self, rows: List[Dict[str, Any]]) -> int:
+        """
+        Private method that inserts rows in batches of `chunk_size`, updates the rollup
+        tables in the same transaction and commits once.
+
+        Args:
+            rows (List[dict]): The rows to insert, keyed by column name.
+
+        Returns:
+            int: The number of inserted rows.
+        """
+        if not rows:
+            return 0
+        start = time.perf_counter()
+        for offset in range(0, len(rows), self.chunk_size):
+            self.session.execute(insert(self.TableModel), rows[offset:offset + self.chunk_size])
+        self._update_rollups(rows)
+        commit_start = time.perf_counter()
         self.session.commit()
+        elapsed = time.perf_counter() - start
+        metrics.annotate(rows=len(rows), insert_seconds=round(commit_start - start, 6), commit_seconds=round(elapsed - (commit_start - start), 6))
+        logging.info(f"INSERTION: {self.TableModel.__tablename__}, {len(rows)} lignes en {elapsed:.3f}s ({len(rows) / max(elapsed, 1e-9):.0f} lignes/s)")
+        return len(rows)
+
+    def _update_rollups(self, rows: List[Dict[str, Any]]) -> None:
+        """
+        Adds freshly inserted rows to the rollup tables of the source, without committing.
+
+        Args:
+            rows (List[dict]): The rows just inserted into the TableModel.
+        """
+        pass
 
 class LostItemImporter(Importer):
     
@@ -156,7 +656,7 @@ class LostItemImporter(Importer):
     Attributes:
     -----------
     station_list : List[str]
-        A list of train stations to search for lost items.
+        The train stations to search for lost items, from the catalogue (db/catalogue.py); ["*"] for the whole network.
     TableModel : model class
         The database model class to be used for storing the imported data.
     field_list : List[List[str, str]]
@@ -172,7 +672,8 @@ class LostItemImporter(Importer):
         Imports lost item data from the SNCF API for a given date range and saves it to the database.
     """
 
-    station_list = ["Paris Austerlitz", "Paris Est", "Paris Gare de Lyon", "Paris Gare du Nord", "Paris Montparnasse", "Paris Saint-Lazare", "Paris Bercy"]
+    api_url = "https://ressources.data.sncf.com/api/records/1.0/search/"
+    derived_models = (LostItemDaily,)
 
     def _init_attributes(self):
         """
@@ -180,6 +681,8 @@ class LostItemImporter(Importer):
         """
 
         self.TableModel= LostItem
+        self.station_list, _ = catalogue.load()
+        self._type_ids = None
         self.field_list = [
         ["type_objet", "gc_obo_type_c"],
         ["nom_gare", "gc_obo_gare_origine_r_name"],
@@ -205,11 +708,11 @@ class LostItemImporter(Importer):
             The URL endpoint for the API query.
         """
                 
-        URL = "https://ressources.data.sncf.com/api/records/1.0/search/"
+        URL = self.api_url
         ressource = "?dataset=objets-trouves-restitution&q="
         date_fork = f"date%3A%5B{start}+TO+{end}%5D"
-        row_limit ="&rows=10000"
-        station = f"&refine.gc_obo_gare_origine_r_name={station}"
+        row_limit =f"&rows={self.row_limit}"
+        station = f"&refine.gc_obo_gare_origine_r_name={station}" if station != catalogue.ALL_STATIONS else ""
         endpoint = URL + ressource + date_fork + row_limit + station
         return endpoint.replace(" ", "+")
 
@@ -225,37 +728,88 @@ class LostItemImporter(Importer):
         end_date : str
             The end date for the data import in the format "YYYY-MM-DD".
         """
-        # Set up logging
-        
-        year_range  = self._get_year_range(start_date,end_date)
-
-        for station in self.station_list:
-            for start_date, end_date in year_range:
-                
-                my_request = requests.get(self._create_endpoint(station, start_date, end_date))
-
-                logging.info(f"REQUETE: {start_date}, {station},{len((my_request.json()['records']))}")
-
-                self._insert(my_request)
+        self._import_windows([(station,) + window for station in self.station_list for window in self._date_windows((station,), start_date, end_date)])
+
+
+    def _window_keys(self) -> List[Tuple[str, ...]]:
+        return [(station,) for station in self.station_list]
+
+    def _date_windows(self, key: Tuple[str, ...], start: str, end: str) -> List[Tuple[str, str]]:
+        # A window of the whole network holds about as many items per month as one station per year
+        years = self._get_year_range(start, end)
+        if key != (catalogue.ALL_STATIONS,):
+            return years
+        return [month for year in years for month in (self._split_window(*year) if _days(*year) > 31 else [year])]
+
+    def _delete_window(self, window: Tuple[str, ...]) -> None:
+        station, start, end = window
+        if station == catalogue.ALL_STATIONS:
+            self.session.execute(delete(LostItem).where(LostItem.date.between(start, end)))
+            self.session.execute(delete(LostItemDaily).where(LostItemDaily.date.between(start, end)))
+            return
+        self.session.execute(delete(LostItem).where(LostItem.nom_gare == station, LostItem.date.between(start, end)))
+        self.session.execute(delete(LostItemDaily).where(LostItemDaily.nom_gare == station, LostItemDaily.date.between(start, end)))
+
+    def _update_rollups(self, rows: List[Dict[str, Any]]) -> None:
+        # Delays and tranches are computed for the whole batch at once, then summed per day, type and station
+        if not rows:
+            return
+        df = pd.DataFrame(rows, columns=["date", "type_id", "nom_gare", "date_restitution"])
+        df["delai_jours"] = delais(df["date"], df["date_restitution"])
+        df["restitues"] = df["delai_jours"].notna().astype(int)
+        tranche = tranches(df["delai_jours"])
+        for code, column in enumerate(TRANCHE_COLUMNS):
+            df[column] = (tranche == code).astype(int)
+        columns = ["count", "restitues", "delai_jours"] + TRANCHE_COLUMNS
+        daily = df.assign(count=1).groupby(["date", "type_id", "nom_gare"], sort=False)[columns].sum().reset_index()
+        daily["delai_jours"] = daily["delai_jours"].astype(int)
+        daily["type_objet"] = daily.pop("type_id").map({id: libelle for libelle, id in self._type_ids.items()})
+        daily["saison"] = saisons(daily["date"]).astype(str)
+        daily_rows = daily.to_dict("records")
+
+        statement = sqlite_insert(LostItemDaily)
+        statement = statement.on_conflict_do_update(
+            index_elements=[LostItemDaily.date, LostItemDaily.type_objet, LostItemDaily.nom_gare],
+            set_={column: getattr(LostItemDaily, column) + statement.excluded[column] for column in columns},
+        )
+        for offset in range(0, len(daily_rows), self.chunk_size):
+            self.session.execute(statement, daily_rows[offset:offset + self.chunk_size])
+
+    def rebuild_rollups(self) -> None:
+        """
+        Recomputes LostItemDaily from the whole LostItem table, e.g. for a database filled before the rollup existed.
+        """
+        rebuild_rollups(self.session)
+        self.session.commit()
 
+    def _type_id(self, libelle: str) -> int:
+        """
+        Returns the TypeObjet id of a label, adding the label to the dictionary if it is new.
 
-    def _insert(self, my_request: requests.Response) -> None:
+        Args:
+            libelle (str): The type of object, as returned by the API.
 
-        for row in my_request.json()["records"]:
-            row_data = {} 
-            for field in self.field_list:
-                try: 
-                    row_data[field[0]] = row["fields"][field[1]]
-                except KeyError:
-                    row_data[field[0]] = None
-            row_data["date"] = row["fields"]["date"][:10]
-
-            # self.session.add(LostItem(**temp_data))
-            self.session.add(self.TableModel(**row_data))
-        self.session.commit()
+        Returns:
+            int: The id referenced by LostItem.type_id.
+        """
+        if self._type_ids is None:
+            self._type_ids = {libelle: id for id, libelle in self.session.execute(select(TypeObjet.id, TypeObjet.libelle))}
+        if libelle not in self._type_ids:
+            self.session.execute(sqlite_insert(TypeObjet).values(libelle=libelle).on_conflict_do_nothing())
+            self._type_ids[libelle] = self.session.execute(select(TypeObjet.id).where(TypeObjet.libelle == libelle)).scalar_one()
+        return self._type_ids[libelle]
+
+    def _build_rows(self, records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        rows = super()._build_rows(records)
+        for row, record in zip(rows, records):
+            row["date"] = record["fields"]["date"][:10]
+            row["type_id"] = self._type_id(row.pop("type_objet"))
+            row["date_restitution"] = to_utc_timestamp(row["date_restitution"])
+        return rows
                 
 class TemperatureImporter(Importer):
 
+    api_url = "https://public.opendatasoft.com/api/records/1.0/search/"
 
     def _init_attributes(self):
         self.TableModel= Temperature
@@ -265,137 +819,228 @@ class TemperatureImporter(Importer):
         ]
 
     def _create_endpoint(self, start: str, end: str) -> str:
-        URL = "https://public.opendatasoft.com/api/records/1.0/search/"
+        URL = self.api_url
         ressource = "?dataset=donnees-synop-essentielles-omm&q="
         date_fork = f"date%3A%5B{start}+TO+{end}%5D"
-        row_limit ="&rows=10000"
+        row_limit =f"&rows={self.row_limit}"
         station = f"&refine.nom=ORLY"
         endpoint = URL + ressource + date_fork + row_limit +station
         return endpoint.replace(" ", "+")
 
     def import_data(self, start_date: str, end_date: str) -> None:
-        # Set up logging
-        
         year_range  = self._get_year_range(start_date,end_date)
+        self._import_windows(year_range)
 
-        for start_date, end_date in year_range:
+    def _store_window(self, window: Tuple[str, ...], records: List[Dict[str, Any]]) -> None:
+        """
+        Merges the observations of a window that are newer than the watermark into their days.
 
-            my_request = requests.get(self._create_endpoint(start_date, end_date))
+        Days are never replaced: each one keeps the running sum, count, min and max of its observations,
+        so a window starting in the middle of a stored day (an update) only adds the observations the day
+        did not have yet. The watermark is the UTC timestamp of the last merged observation.
 
-            logging.info(f"REQUETE: {start_date},{len((my_request.json()['records']))}")
-            if len((my_request.json()['records']))>0:
-                self._insert(my_request)
+        Args:
+            window (Tuple[str, ...]): The window the records belong to.
+            records (List[dict]): The "records" list of the response.
+        """
+        watermark = self._get_watermark(window[:-2])
+        rows = self._observations(records)
+        if watermark is not None:
+            rows = [row for row in rows if row["date"] > watermark]
+        if rows:
+            self._save_checkpoint(window[:-2], max(row["date"] for row in rows))
+            self._merge_observations(rows)
+
+    def _observations(self, records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Builds the observation rows of a response, with their timestamp converted to UTC.
 
-    def _insert(self, my_request: requests.Response) -> None:
+        Args:
+            records (List[dict]): The "records" list of an API response.
+
+        Returns:
+            List[dict]: One row per dated observation, keyed by 'date' and 'temperature'.
         """
-        Private method that inserts data into the database from a given requests.Response object.
+        rows = self._build_rows(records)
+        for row in rows:
+            row["date"] = to_utc_timestamp(row["date"])
+        return [row for row in rows if row["date"] is not None]
+
+    def _insert_records(self, records: List[Dict[str, Any]]) -> int:
+        return self._merge_observations(self._observations(records))
+
+    def _merge_observations(self, rows: List[Dict[str, Any]]) -> int:
+        """
+        Aggregates observations by day and adds them to the stored days with an upsert, then commits.
 
         Args:
-            my_request (requests.Response): The Response object containing the data to be inserted.
+            rows (List[dict]): Observations keyed by 'date' (UTC timestamp) and 'temperature'.
 
         Returns:
-            None.
+            int: The number of days written.
         """
-        # df = pd.DataFrame(columns=['date', 'Temperature'])
-        row_record =[]
-        for row in my_request.json()["records"]:
-            row_data = {} 
-            for field in self.field_list:
-                try: 
-                    row_data[field[0]] = row["fields"][field[1]]
-                except KeyError:
-                    row_data[field[0]] = None
-            row_record.append(row_data)        
-            # df = df.append(row_data, ignore_index=True)
-        df = pd.DataFrame.from_records(row_record)
-
-        df = self.agregate_temp_by_day(df)
-        for row in df.to_dict(orient='records'):
-            logging.debug(row)
-            self.session.add(self.TableModel(**row))
-        
+        if not rows:
+            return 0
+        start = time.perf_counter()
+        df = self.agregate_temp_by_day(pd.DataFrame.from_records(rows, columns=[field[0] for field in self.field_list]))
+        days = df.astype(object).where(df.notna(), None).to_dict(orient='records')
+
+        statement = sqlite_insert(Temperature)
+        excluded = statement.excluded
+        temp_sum = func.coalesce(Temperature.temp_sum, 0) + excluded.temp_sum
+        temp_count = func.coalesce(Temperature.temp_count, 0) + excluded.temp_count
+        statement = statement.on_conflict_do_update(
+            index_elements=[Temperature.date],
+            set_={
+                "temp_sum": temp_sum,
+                "temp_count": temp_count,
+                # SQLite's two-argument min/max return NULL if either side is NULL
+                "temp_min": func.min(func.coalesce(Temperature.temp_min, excluded.temp_min), func.coalesce(excluded.temp_min, Temperature.temp_min)),
+                "temp_max": func.max(func.coalesce(Temperature.temp_max, excluded.temp_max), func.coalesce(excluded.temp_max, Temperature.temp_max)),
+                "temperature": temp_sum / func.nullif(temp_count, 0),
+            },
+        )
+        for offset in range(0, len(days), self.chunk_size):
+            self.session.execute(statement, days[offset:offset + self.chunk_size])
+        commit_start = time.perf_counter()
         self.session.commit()
+        elapsed = time.perf_counter() - start
+        metrics.annotate(rows=len(days), insert_seconds=round(commit_start - start, 6), commit_seconds=round(elapsed - (commit_start - start), 6))
+        logging.info(f"INSERTION: {self.TableModel.__tablename__}, {len(rows)} observations -> {len(days)} jours en {elapsed:.3f}s")
+        return len(days)
 
-    def agregate_temp_by_day(self,df):
-        df.index = pd.to_datetime(df.date,utc=True)
-        df = df.drop(columns=["date"])
+    def agregate_temp_by_day(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Aggregates observations into partial daily statistics that can be added to the stored ones.
 
-        # Group by departement and day
-        df_temp = df.resample('D').agg("mean")
+        Args:
+            df (pd.DataFrame): Observations with a UTC 'date' timestamp and a 'temperature'.
 
-        df_temp = df_temp.reset_index()
-        df_temp["date"] = pd.to_datetime(df_temp["date"]).dt.strftime('%Y-%m-%d')
-        # df_temp["date"] = pd.to_datetime(df_temp["date"]).dt.date
-        return df_temp
+        Returns:
+            pd.DataFrame: One row per UTC day with temp_sum, temp_count, temp_min, temp_max and their mean
+            'temperature' (NaN for a day without any measured temperature).
+        """
+        temperature = pd.to_numeric(df["temperature"], errors="coerce")
+        day = pd.to_datetime(df["date"], utc=True).dt.strftime('%Y-%m-%d').rename("date")
+        df_temp = temperature.groupby(day).agg(["sum", "count", "min", "max"])
+        df_temp.columns = ["temp_sum", "temp_count", "temp_min", "temp_max"]
+        df_temp["temperature"] = df_temp["temp_sum"] / df_temp["temp_count"].where(df_temp["temp_count"] > 0)
+        return df_temp.reset_index()
 
 
 
 class GareImporter(Importer):
+    """
+    Imports the coordinates and the frequentation of the stations of the catalogue (db/catalogue.py).
 
-    station_list = ["Paris Austerlitz", "Paris Est", "Paris Gare de Lyon", "Paris Gare du Nord", "Paris Montparnasse", "Paris Saint-Lazare", "Paris Bercy"]
+    Stations are resolved `batch_size` at a time: each batch costs one request to the station reference and
+    one to the frequentation dataset, whatever the number of stations in it.
+    """
+
+    api_url = "https://ressources.data.sncf.com/api/records/1.0/search/"
+    derived_models = (Frequentation,)
+    batch_size = 50
 
     def _init_attributes(self):
         self.TableModel= Gare
+        self.station_list, self.alias = catalogue.load()
         self.field_list = [
             ["latitude", "latitude_entreeprincipale_wgs84"],
             ["longitude", "longitude_entreeprincipale_wgs84"],
         ]
 
-    def _create_endpoint(self,station:str)->Tuple[str,str]:
-        URL_geo = "https://ressources.data.sncf.com/api/records/1.0/search/"
-        ressource_geo = "?dataset=referentiel-gares-voyageurs"
-        row_limit_geo ="&rows=1"
-        stationt_geo = f"&refine.gare_alias_libelle_noncontraint={station}"
-        endpoint_gare = URL_geo + ressource_geo + row_limit_geo + stationt_geo
-         
-    
-        URL_freq = "https://ressources.data.sncf.com/api/records/1.0/search/"
-        ressource_freq = "?dataset=frequentation-gares"
-        row_limit_freq ="&rows=1"
-        station_freq = f"&refine.nom_gare={station}"
-        endpoint_freq =  URL_freq + ressource_freq + row_limit_freq + station_freq
-        
-        return (endpoint_gare,endpoint_freq)
+    def _create_endpoint(self, dataset: str, field: str, names: List[str]) -> str:
+        """
+        Creates the endpoint returning the records of a dataset whose `field` is one of `names`.
 
+        The full-text query may also match longer names; `_by_name` keeps the exact ones.
+        """
+        query = " OR ".join(f'{field}:"{name}"' for name in names)
+        return f"{self.api_url}?dataset={dataset}&rows={self.row_limit}&q={quote(query)}"
 
-    def import_data(self):
-        
-        for station in self.station_list:
-            if station == "Paris Bercy":
-                station_lib = "Paris Bercy Bourgogne - Pays d'Auvergne"
-                
-            else:
-                station_lib = station
+    def _discover_stations(self) -> List[str]:
+        """
+        Lists every station of the lost items dataset, from the facet of its station field (a single request).
+        """
+        facet = "gc_obo_gare_origine_r_name"
+        payload = self._fetch(f"{self.api_url}?dataset=objets-trouves-restitution&rows=0&facet={facet}").json()
+        facets = next((group["facets"] for group in payload.get("facet_groups", []) if group["name"] == facet), [])
+        logging.info(f"REQUETE: {len(facets)} gares dans les objets trouvés")
+        return sorted(facet["name"] for facet in facets)
 
-            my_request_geo = requests.get(self._create_endpoint(station_lib)[0])
-            my_request_freq = requests.get(self._create_endpoint(station_lib)[1])
-            
-            logging.info(f"REQUETE: {station}")
-            
-            self._insert(my_request_geo, my_request_freq, station)
+    def _stations(self) -> List[str]:
+        if self.station_list == [catalogue.ALL_STATIONS]:
+            return self._discover_stations()
+        return self.station_list
+
+    def import_data(self):
+        self._import_stations(self._stations())
 
-    def _insert(self, my_request_geo: requests.Response, my_request_freq: requests.Response, station:str) -> None:
+    def resume(self, start_date: Optional[str] = None, end_date: Optional[str] = None) -> None:
+        """
+        Imports only the stations that are not in the Gare table yet. The dates are ignored.
+        """
+        existing = set(self.session.scalars(select(Gare.nom_gare)))
+        self._import_stations([station for station in self._stations() if station not in existing])
+
+    def _import_stations(self, station_list: List[str]) -> None:
+        batches = [station_list[offset:offset + self.batch_size] for offset in range(0, len(station_list), self.batch_size)]
+        jobs = []
+        for batch in batches:
+            names = [self.alias.get(station, station) for station in batch]
+            jobs.append((None, self._create_endpoint("referentiel-gares-voyageurs", "gare_alias_libelle_noncontraint", names)))
+            jobs.append((None, self._create_endpoint("frequentation-gares", "nom_gare", names)))
+
+        # The pipeline yields the two answers of each batch in job order
+        responses = (response for _, response in self._fetch_pipeline(jobs))
+        for batch, my_request_geo, my_request_freq in zip(batches, responses, responses):
+            logging.info(f"REQUETE: {len(batch)} gares, {batch[0]} à {batch[-1]}")
+            self._insert(my_request_geo, my_request_freq, batch)
+
+    @staticmethod
+    def _by_name(response: requests.Response, field: str) -> Dict[str, Dict[str, Any]]:
+        # The first record of each name, like the rows=1 lookups by station they replace
+        records = {}
+        for record in response.json()["records"]:
+            records.setdefault(record["fields"].get(field), record["fields"])
+        return records
+
+    def _insert(self, my_request_geo: requests.Response, my_request_freq: requests.Response, batch: List[str]) -> None:
+        geo_data = self._by_name(my_request_geo, "gare_alias_libelle_noncontraint")
+        freq_data = self._by_name(my_request_freq, "nom_gare")
+        for station in batch:
+            name = self.alias.get(station, station)
+            if name not in geo_data:
+                logging.warning(f"GARE: {name} absente du référentiel des gares")
+            fields = geo_data.get(name, {})
+            self.session.add(Gare(nom_gare=station, **{field: fields.get(api_field) for field, api_field in self.field_list}))
+            frequentation = self._frequentation(freq_data.get(name, {}))
+            self.session.add_all(Frequentation(nom_gare=station, annee=annee, voyageurs=voyageurs) for annee, voyageurs in frequentation.items())
+        self._save_checkpoint((), str(datetime.now().date()))
+        self.session.commit()
 
-        geo_data = my_request_geo.json()["records"][0] # Only one row is collected for each station       
-        row_data = {} 
-        for field in self.field_list:
-            try: 
-                row_data[field[0]] = geo_data["fields"][field[1]]
-            except KeyError:
-                row_data[field[0]] = None
+    @staticmethod
+    def _frequentation(fields: Dict[str, Any]) -> Dict[str, int]:
+        """
+        Reads the yearly frequentation of a station, for every year the dataset publishes.
 
-        freq_data = my_request_freq.json()["records"][0]
-        row_data["freq_2019"] = freq_data["fields"]["total_voyageurs_non_voyageurs_2019"]+freq_data["fields"]["total_voyageurs_2019"]
-        row_data["freq_2020"] = freq_data["fields"]["total_voyageurs_non_voyageurs_2020"]+freq_data["fields"]["total_voyageurs_2020"]
-        row_data["freq_2021"] = freq_data["fields"]["total_voyageurs_non_voyageurs_2021"]+freq_data["fields"]["total_voyageurs_2021"]
+        Args:
+            fields (dict): The "fields" of a frequentation-gares record, with total_voyageurs_YYYY and
+                total_voyageurs_non_voyageurs_YYYY columns.
 
-        # self.session.add(LostItem(**temp_data))
-        self.session.add(Gare(nom_gare=station,**row_data))
-        self.session.commit()
+        Returns:
+            Dict[str, int]: Travellers plus visitors, by year 'YYYY'.
+        """
+        frequentation = {}
+        for name, value in fields.items():
+            if name.startswith("total_voyageurs_") and name[-4:].isdigit() and "non_voyageurs" not in name and value is not None:
+                annee = name[-4:]
+                frequentation[annee] = value + (fields.get(f"total_voyageurs_non_voyageurs_{annee}") or 0)
+        return frequentation
 
 
 if __name__ == "__main__":
-    engine = create_engine('sqlite:///db.sqlite')
+    engine = get_engine()
     my_import = LostItemImporter(engine)
     my_import.clean()
     # my_import.import_by_date("01 january 2018", "now")
\ No newline at end of file
@@ -0,0 +1,135 @@
+"""
+Timing and metrics of the hot paths: API requests, response parsing, inserts and commits, chart building.
+
+Switched off unless the LOST_ITEMS_METRICS environment variable names a JSON lines file (or `configure` is
+called); every function then returns after a single test. When on, each measure is appended to the file as
+one JSON object and the last ones are kept in memory for the debug panel of app.py.
+
+    with metrics.timer("stockage", source="LostItem", window="Paris Est, 2022-01-01, 2022-01-31") as measure:
+        measure["records"] = len(records)
+        ...  # code called from here can add fields with metrics.annotate(rows=...)
+"""
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+ENV_VAR = "LOST_ITEMS_METRICS"
+RECENT = 1000  # measures kept in memory
+
+_path: Optional[str] = os.environ.get(ENV_VAR) or None
+_lock = threading.Lock()
+_recent: deque = deque(maxlen=RECENT)
+_local = threading.local()
+
+
+def configure(path: Optional[str]) -> None:
+    """
+    Switches the metrics on, written to `path`, or off with None.
+
+    Args:
+        path (str, optional): The JSON lines file the measures are appended to.
+    """
+    global _path
+    _path = path
+
+
+def enabled() -> bool:
+    return _path is not None
+
+
+def recent() -> List[Dict[str, Any]]:
+    """
+    Returns the last measures of this process, oldest first.
+    """
+    with _lock:
+        return list(_recent)
+
+
+def record(stage: str, **fields: Any) -> None:
+    """
+    Writes one measure.
+
+    Args:
+        stage (str): What was measured ("requete", "stockage", "figure"...).
+        **fields: The values of the measure.
+    """
+    if _path is None:
+        return
+    event = {"time": round(time.time(), 3), "stage": stage, **fields}
+    line = json.dumps(event, default=str, ensure_ascii=False) + "\n"
+    with _lock:
+        _recent.append(event)
+        with open(_path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+
+class _Timer(dict):
+    """A measure being taken: its fields can be set while it runs, it is recorded with its duration on exit."""
+
+    def __init__(self, stage: str, fields: Dict[str, Any]):
+        super().__init__(fields)
+        self.stage = stage
+
+    def __enter__(self) -> "_Timer":
+        if not hasattr(_local, "stack"):
+            _local.stack = []
+        _local.stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> bool:
+        self["seconds"] = round(time.perf_counter() - self.start, 6)
+        _local.stack.pop()
+        if exc_type is not None:
+            self["error"] = exc_type.__name__
+        record(self.stage, **self)
+        return False
+
+
+class _NullTimer:
+    """Stands for a timer when the metrics are off."""
+
+    def __enter__(self) -> "_NullTimer":
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> bool:
+        return False
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timer(stage: str, **fields: Any):
+    """
+    Measures the duration of a `with` block, recorded with `fields` and the fields set on the timer.
+
+    Args:
+        stage (str): What is measured.
+        **fields: Values known before the block starts.
+
+    Returns:
+        A context manager; the object it returns accepts `measure[key] = value`.
+    """
+    if _path is None:
+        return _NULL_TIMER
+    return _Timer(stage, fields)
+
+
+def annotate(**fields: Any) -> None:
+    """
+    Adds fields to the innermost timer running in this thread, if any.
+
+    Args:
+        **fields: The values to add.
+    """
+    if _path is None:
+        return
+    stack = getattr(_local, "stack", None)
+    if stack:
+        stack[-1].update(fields)
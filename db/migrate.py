@@ -0,0 +1,181 @@
+"""
+Upgrades an existing database in place to the current schema (db.model.SCHEMA_VERSION).
+
+    python -m db.migrate [db.sqlite]
+
+The whole upgrade runs in one transaction: an interrupted migration leaves the database untouched.
+"""
+import argparse
+import logging
+from typing import Optional
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.engine import Connection, Engine
+from .model import Base, Frequentation, ImportState, LostItem, LostItemDaily, Temperature, SCHEMA_VERSION
+from .import_classes import rebuild_rollups
+from .engine import create_db_engine, get_db_path
+
+
+def _transactional_engine(path: str) -> Engine:
+    """
+    Creates an engine whose transactions also cover DDL statements.
+
+    pysqlite only opens a transaction before DML, so BEGIN is emitted by hand.
+
+    Args:
+        path (str): Path of the SQLite file.
+
+    Returns:
+        sqlalchemy.engine.Engine: The engine.
+    """
+    engine = create_db_engine(path)
+
+    @event.listens_for(engine, "connect")
+    def _disable_pysqlite_transactions(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def _begin(conn):
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+    return engine
+
+
+def _columns(conn: Connection, table: str) -> set:
+    return {column["name"] for column in inspect(conn).get_columns(table)}
+
+
+def _migrate_lostitem(conn: Connection) -> None:
+    """
+    Moves LostItem.type_objet into the TypeObjet dictionary and normalizes date_restitution to UTC.
+    """
+    if "type_objet" not in _columns(conn, "LostItem"):
+        return
+    logging.info("MIGRATION: LostItem.type_objet -> TypeObjet")
+    conn.exec_driver_sql('ALTER TABLE "LostItem" RENAME TO "LostItem_old"')
+    Base.metadata.tables["TypeObjet"].create(conn, checkfirst=True)
+    LostItem.__table__.create(conn)
+    conn.exec_driver_sql('INSERT OR IGNORE INTO "TypeObjet" (libelle) SELECT DISTINCT type_objet FROM "LostItem_old"')
+    conn.exec_driver_sql(
+        'INSERT INTO "LostItem" (id, date, type_id, nom_gare, date_restitution) '
+        'SELECT old.id, substr(old.date, 1, 10), t.id, old.nom_gare, datetime(old.date_restitution) '
+        'FROM "LostItem_old" AS old JOIN "TypeObjet" AS t ON t.libelle = old.type_objet'
+    )
+    conn.exec_driver_sql('DROP TABLE "LostItem_old"')
+
+
+def _migrate_rollup(conn: Connection) -> None:
+    """
+    Drops a LostItemDaily table created before the saison or the restitution columns; it is rebuilt by `upgrade`.
+    """
+    if inspect(conn).has_table("LostItemDaily") and not {"saison", "restitues"} <= _columns(conn, "LostItemDaily"):
+        logging.info("MIGRATION: LostItemDaily + saison, restitutions")
+        conn.exec_driver_sql('DROP TABLE "LostItemDaily"')
+
+
+def _migrate_temperature(conn: Connection) -> None:
+    """
+    Adds the daily running statistics to Temperature. Stored days only kept their mean, so each one counts
+    as a single observation; the last day, possibly partial, is emptied and its watermark moved back so the
+    next update fetches it again in full.
+    """
+    if not inspect(conn).has_table("Temperature"):
+        return
+    missing = [column for column in ("temp_sum", "temp_count", "temp_min", "temp_max") if column not in _columns(conn, "Temperature")]
+    if not missing:
+        return
+    logging.info("MIGRATION: Temperature + " + ", ".join(missing))
+    for column in missing:
+        conn.exec_driver_sql(f'ALTER TABLE "Temperature" ADD COLUMN {column} {"INTEGER" if column == "temp_count" else "FLOAT"}')
+    conn.exec_driver_sql(
+        'UPDATE "Temperature" SET temp_sum = temperature, temp_count = 1, temp_min = temperature, temp_max = temperature '
+        'WHERE temperature IS NOT NULL'
+    )
+    conn.exec_driver_sql('UPDATE "Temperature" SET temp_sum = 0, temp_count = 0 WHERE temperature IS NULL')
+
+    last_day = conn.exec_driver_sql('SELECT max(date) FROM "Temperature"').scalar()
+    if last_day is None:
+        return
+    conn.exec_driver_sql('UPDATE "Temperature" SET temperature = NULL, temp_sum = 0, temp_count = 0, temp_min = NULL, temp_max = NULL WHERE date = ?', (last_day,))
+    if inspect(conn).has_table(ImportState.__tablename__):
+        conn.exec_driver_sql(
+            f'UPDATE "{ImportState.__tablename__}" SET last_date = datetime(?, \'-1 second\') WHERE source = ?',
+            (last_day, Temperature.__tablename__),
+        )
+
+
+def _migrate_gare(conn: Connection) -> None:
+    """
+    Moves the fixed Gare.freq_YYYY columns into the long-format Frequentation table.
+    """
+    if not inspect(conn).has_table("Gare"):
+        return
+    columns = sorted(column for column in _columns(conn, "Gare") if column.startswith("freq_"))
+    if not columns:
+        return
+    logging.info(f"MIGRATION: Gare.{', '.join(columns)} -> Frequentation")
+    Frequentation.__table__.create(conn, checkfirst=True)
+    for column in columns:
+        conn.exec_driver_sql(
+            f'INSERT OR REPLACE INTO "Frequentation" (nom_gare, annee, voyageurs) '
+            f'SELECT nom_gare, ?, {column} FROM "Gare" WHERE {column} IS NOT NULL',
+            (column[len("freq_"):],),
+        )
+        conn.exec_driver_sql(f'ALTER TABLE "Gare" DROP COLUMN {column}')
+
+
+def _migrate_import_state(conn: Connection) -> None:
+    """
+    Adds the write time of the checkpoints, read by queries.data_version. It stays NULL until the key is imported again.
+    """
+    if inspect(conn).has_table(ImportState.__tablename__) and "updated" not in _columns(conn, ImportState.__tablename__):
+        logging.info("MIGRATION: ImportState + updated")
+        conn.exec_driver_sql(f'ALTER TABLE "{ImportState.__tablename__}" ADD COLUMN updated FLOAT')
+
+
+def upgrade(path: Optional[str] = None) -> int:
+    """
+    Brings a database to the current schema, creating it if needed.
+
+    Args:
+        path (str, optional): Path of the SQLite file. Defaults to `get_db_path()`.
+
+    Returns:
+        int: The schema version of the database after the upgrade.
+    """
+    path = path or get_db_path()
+    engine = _transactional_engine(path)
+    try:
+        with engine.begin() as conn:
+            version = conn.exec_driver_sql("PRAGMA user_version").scalar()
+            if version >= SCHEMA_VERSION:
+                logging.info(f"MIGRATION: {path} déjà en version {version}")
+                return version
+
+            if inspect(conn).has_table("LostItem"):
+                _migrate_lostitem(conn)
+                _migrate_rollup(conn)
+            _migrate_temperature(conn)
+            _migrate_gare(conn)
+            _migrate_import_state(conn)
+
+            Base.metadata.create_all(conn)
+            for table in Base.metadata.sorted_tables:
+                for index in table.indexes:
+                    index.create(conn, checkfirst=True)
+
+            rollup_empty = conn.execute(select(func.count()).select_from(LostItemDaily)).scalar() == 0
+            if rollup_empty:
+                rebuild_rollups(conn)
+
+            conn.exec_driver_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            logging.info(f"MIGRATION: {path} version {version} -> {SCHEMA_VERSION}")
+            return SCHEMA_VERSION
+    finally:
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Upgrade the lost items database in place.")
+    parser.add_argument("path", nargs="?", default=None, help="SQLite file to upgrade (default: $LOST_ITEMS_DB or db.sqlite)")
+    args = parser.parse_args()
+    upgrade(args.path)
@@ -1,13 +1,19 @@
 from typing import List
-from sqlalchemy import create_engine
+from sqlalchemy import inspect
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
 from sqlalchemy import String
+from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.orm import Mapped
 from sqlalchemy.orm import mapped_column
 from sqlalchemy.orm import relationship
 
 
+# Stored in PRAGMA user_version, see db/migrate.py
+SCHEMA_VERSION = 5
+
+
 class Base(DeclarativeBase):
         pass
 
@@ -18,35 +24,104 @@ class Gare(Base):
     longitude: Mapped[float] = mapped_column(nullable=True)
     latitude: Mapped[float] = mapped_column( nullable=True)
     lostitems: Mapped[List["LostItem"]] = relationship(back_populates="gare")
-    freq_2019 : Mapped[int] = mapped_column(nullable=True)
-    freq_2020 : Mapped[int] = mapped_column(nullable=True)
-    freq_2021 : Mapped[int] = mapped_column(nullable=True)
+    frequentation: Mapped[List["Frequentation"]] = relationship(back_populates="gare")
+
+
+class Frequentation(Base):
+    """Number of people (travellers and visitors) going through a station in a year, one row per year published."""
+    __tablename__ = "Frequentation"
+
+    nom_gare: Mapped[str] = mapped_column(ForeignKey("Gare.nom_gare"), primary_key=True)
+    annee: Mapped[str] = mapped_column(String(4), primary_key=True)
+    voyageurs: Mapped[int] = mapped_column(nullable=False)
+    gare: Mapped["Gare"] = relationship(back_populates="frequentation")
+
 
 class Temperature(Base):
+    """Daily temperature at Orly. `temperature` is the mean temp_sum / temp_count, kept by TemperatureImporter."""
     __tablename__ = "Temperature"
     
     date: Mapped[str] = mapped_column(String(30),  primary_key=True)
     temperature: Mapped[float] = mapped_column(nullable=True)
+    temp_sum: Mapped[float] = mapped_column(nullable=True)
+    temp_count: Mapped[int] = mapped_column(nullable=True)
+    temp_min: Mapped[float] = mapped_column(nullable=True)
+    temp_max: Mapped[float] = mapped_column(nullable=True)
     lostitems: Mapped[List["LostItem"]] = relationship(back_populates="date_join")
 
 
+class TypeObjet(Base):
+    """Dictionary of the types of object, referenced by LostItem.type_id."""
+    __tablename__ = "TypeObjet"
+
+    id : Mapped[int] = mapped_column(primary_key=True)
+    libelle : Mapped[str] = mapped_column(String(60), unique=True, nullable=False)
+    lostitems: Mapped[List["LostItem"]] = relationship(back_populates="type")
+
+
 class LostItem(Base):
     __tablename__ = "LostItem"
+    __table_args__ = (
+        Index("ix_LostItem_date", "date", "type_id", "nom_gare"),
+        Index("ix_LostItem_nom_gare_date", "nom_gare", "date"),
+        Index("ix_LostItem_type_id_date", "type_id", "date"),
+    )
 
     id : Mapped[int] = mapped_column(primary_key=True)
-    date : Mapped[str] = mapped_column(ForeignKey(Temperature.date),  nullable=False)
-    type_objet : Mapped[str] = mapped_column(String(30),  nullable=False)
+    date : Mapped[str] = mapped_column(ForeignKey(Temperature.date),  nullable=False)  # 'YYYY-MM-DD'
+    type_id : Mapped[int] = mapped_column(ForeignKey(TypeObjet.id),  nullable=False)
     nom_gare : Mapped[str] = mapped_column(ForeignKey(Gare.nom_gare),  nullable=False)
-    date_restitution: Mapped[str] = mapped_column(String(30),  nullable=True)
+    date_restitution: Mapped[str] = mapped_column(String(19),  nullable=True)  # 'YYYY-MM-DD HH:MM:SS' UTC
     gare: Mapped["Gare"] = relationship(back_populates="lostitems")
     date_join: Mapped["Temperature"] = relationship(back_populates="lostitems")
+    type: Mapped["TypeObjet"] = relationship(back_populates="lostitems")
+    type_objet = association_proxy("type", "libelle")
+
+
+class LostItemDaily(Base):
+    """
+    Number of lost items per day, type and station, maintained by LostItemImporter, with how many were returned,
+    their total delay in days and their count in each tranche of delay (db/restitution.py).
+    """
+    __tablename__ = "LostItemDaily"
+    __table_args__ = (
+        Index("ix_LostItemDaily_nom_gare_date", "nom_gare", "date"),
+        Index("ix_LostItemDaily_type_objet_date", "type_objet", "date"),
+    )
+
+    date : Mapped[str] = mapped_column(String(30), primary_key=True)
+    type_objet : Mapped[str] = mapped_column(String(30), primary_key=True)
+    nom_gare : Mapped[str] = mapped_column(String(30), primary_key=True)
+    saison : Mapped[str] = mapped_column(String(10), nullable=False)
+    count : Mapped[int] = mapped_column(nullable=False, default=0)
+    restitues : Mapped[int] = mapped_column(nullable=False, default=0)
+    delai_jours : Mapped[int] = mapped_column(nullable=False, default=0)
+    delai_0 : Mapped[int] = mapped_column(nullable=False, default=0)
+    delai_1_7 : Mapped[int] = mapped_column(nullable=False, default=0)
+    delai_8_30 : Mapped[int] = mapped_column(nullable=False, default=0)
+    delai_31 : Mapped[int] = mapped_column(nullable=False, default=0)
+
+
+class ImportState(Base):
+    __tablename__ = "ImportState"
+
+    source : Mapped[str] = mapped_column(String(30), primary_key=True)
+    station : Mapped[str] = mapped_column(String(60), primary_key=True, default="")
+    last_date : Mapped[str] = mapped_column(String(30), nullable=False)
+    updated : Mapped[float] = mapped_column(nullable=True)  # time.time() of the last commit of the key, see queries.data_version
 
 
 def create_tables(engine):
 
+    # An existing database keeps its version until db/migrate.py upgrades it
+    fresh = not inspect(engine).has_table(LostItem.__tablename__)
     Base.metadata.create_all(engine)
+    if fresh:
+        with engine.begin() as conn:
+            conn.exec_driver_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
     
 
 if __name__ == "__main__":
-    engine = create_engine('sqlite:///db.sqlite')
+    from .engine import get_engine
+    engine = get_engine()
     create_tables(engine)
\ No newline at end of file
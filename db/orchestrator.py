@@ -0,0 +1,107 @@
+"""
+Runs the importers as a small dependency graph: Gare and Temperature are independent and run in parallel,
+LostItem waits for both because of its foreign keys.
+"""
+import logging
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Dict, List, Optional
+from sqlalchemy.engine import Engine
+from .import_classes import GareImporter, Importer, LostItemImporter, TemperatureImporter
+from .http_cache import ResponseCache
+from . import catalogue
+
+SOURCES = {
+    "gare": GareImporter,
+    "temperature": TemperatureImporter,
+    "lostitem": LostItemImporter,
+}
+# Tables filled by each source, replaced together by a shadow rebuild (see db/shadow.py)
+TABLES = {
+    "gare": ["Gare", "Frequentation"],
+    "temperature": ["Temperature"],
+    "lostitem": ["TypeObjet", "LostItem", "LostItemDaily"],
+}
+DEPENDENCIES = {
+    "gare": [],
+    "temperature": [],
+    "lostitem": ["gare", "temperature"],
+}
+
+
+def run_source(source: str, engine: Engine, since: str, until: str, resume: bool, stations: Optional[List[str]] = None, max_workers: Optional[int] = None, cache: Optional[ResponseCache] = None) -> None:
+    """
+    Imports one source. A fresh run cleans its table first (only the rows of `stations` if given); a resumed
+    run continues from the checkpoints.
+
+    Args:
+        source (str): A key of SOURCES.
+        engine (sqlalchemy.engine.Engine): The database engine.
+        since (str): Start of the date range.
+        until (str): End of the date range.
+        resume (bool): Continue from the checkpoints instead of cleaning and starting over.
+        stations (List[str], optional): Restrict the import to these stations.
+        max_workers (int, optional): Number of API requests running at the same time.
+        cache (ResponseCache, optional): On-disk cache of the API responses.
+    """
+    importer: Importer = SOURCES[source](engine, max_workers=max_workers, cache=cache)
+    restricted = None
+    if stations is not None and hasattr(importer, "station_list"):
+        importer.station_list = restricted = catalogue.restrict(importer.station_list, stations)
+
+    logging.info(f"ORCHESTRATION: début {source}")
+    if resume:
+        importer.resume(since, until)
+    else:
+        # With --stations only the rows of the stations imported again are deleted
+        importer.clean(restricted)
+        if isinstance(importer, GareImporter):
+            importer.import_data()
+        else:
+            importer.import_data(since, until)
+    logging.info(f"ORCHESTRATION: fin {source}")
+
+
+def run(engine: Engine, sources: List[str], since: str, until: str, resume: bool = False, jobs: int = 2, **options) -> Dict[str, str]:
+    """
+    Runs the selected sources, each one as soon as the selected sources it depends on succeeded.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): The database engine.
+        sources (List[str]): Keys of SOURCES to run.
+        since (str): Start of the date range.
+        until (str): End of the date range.
+        resume (bool): Continue from the checkpoints instead of cleaning and starting over.
+        jobs (int): Number of sources imported at the same time.
+        **options: Passed to `run_source` (stations, max_workers, cache).
+
+    Returns:
+        Dict[str, str]: The status of each source: "ok", "failed" or "skipped" (a dependency failed).
+    """
+    status: Dict[str, str] = {}
+    waiting = [source for source in SOURCES if source in sources]
+    running: Dict[Future, str] = {}
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while waiting or running:
+            for source in list(waiting):
+                dependencies = [dep for dep in DEPENDENCIES[source] if dep in sources]
+                if any(status.get(dep) in ("failed", "skipped") for dep in dependencies):
+                    status[source] = "skipped"
+                    waiting.remove(source)
+                    logging.error(f"ORCHESTRATION: {source} ignoré, une dépendance a échoué")
+                elif all(status.get(dep) == "ok" for dep in dependencies):
+                    running[executor.submit(run_source, source, engine, since, until, resume, **options)] = source
+                    waiting.remove(source)
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                source = running.pop(future)
+                try:
+                    future.result()
+                    status[source] = "ok"
+                except Exception:
+                    logging.exception(f"ORCHESTRATION: échec {source}")
+                    status[source] = "failed"
+    return status
@@ -0,0 +1,396 @@
+import pandas as pd
+from pandas.api.types import union_categoricals
+from sqlalchemy import func, select
+from sqlalchemy.engine import Connection
+from typing import Any, Dict, List, Optional, Tuple
+from .model import Frequentation, Gare, ImportState, LostItem, LostItemDaily, Temperature, TypeObjet
+from .restitution import TRANCHE_COLUMNS
+
+# type_objet of the station_year_cube rows that count every type of object
+TOUS_LES_TYPES = "Tous les types"
+
+# The dashboard frames are read CHUNK_ROWS rows at a time, each chunk converted to compact dtypes before the
+# next one is fetched: days as datetime64 and repeated labels as categoricals instead of Python strings.
+CHUNK_ROWS = 50_000
+DATE_COLUMNS = ["date"]
+CATEGORY_COLUMNS = ["type_objet", "nom_gare", "saison", "year"]
+
+
+def compact(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Converts the 'YYYY-MM-DD' columns of a frame to datetime64 and its label columns to categoricals, in place.
+
+    Args:
+        df (pd.DataFrame): A frame read from the database.
+
+    Returns:
+        pd.DataFrame: The same frame.
+    """
+    for column in df.columns:
+        if column in DATE_COLUMNS:
+            df[column] = pd.to_datetime(df[column], format="%Y-%m-%d")
+        elif column in CATEGORY_COLUMNS:
+            df[column] = df[column].astype("category")
+    return df
+
+
+def read_compact(query: Any, conn: Connection, chunksize: int = CHUNK_ROWS) -> pd.DataFrame:
+    """
+    Reads a query in chunks of compact dtypes (see `compact`), so the strings of the whole result are never
+    held at once.
+
+    Args:
+        query: A SQLAlchemy selectable.
+        conn (sqlalchemy.engine.Connection): An open connection to the database.
+        chunksize (int): Rows fetched at a time.
+
+    Returns:
+        pd.DataFrame: The result, with sorted categories like the frames of db.snapshot.
+    """
+    chunks = [compact(chunk) for chunk in pd.read_sql(query, conn, chunksize=chunksize)]
+    df = pd.concat(chunks, ignore_index=True)
+    for column in df.columns:
+        if column in CATEGORY_COLUMNS:
+            df[column] = union_categoricals([chunk[column] for chunk in chunks], sort_categories=True)
+    return df
+
+
+def _read(query: Any, conn: Connection, typed: bool) -> pd.DataFrame:
+    return read_compact(query, conn) if typed else pd.read_sql(query, conn)
+
+
+def data_version(conn: Connection) -> Tuple:
+    """
+    Computes a cheap stamp of the database content, used as a cache key by the dashboard.
+
+    Every import commit stamps its checkpoint with its write time, so the latest one changes even when a
+    window is stored again with the same row count and reuses the freed rowids. The content summaries still
+    catch changes made without a checkpoint. Only an indexed maximum and the small rollup, Temperature,
+    Gare and ImportState tables are read.
+
+    Args:
+        conn (sqlalchemy.engine.Connection): An open connection to the database.
+
+    Returns:
+        Tuple: A hashable version stamp.
+    """
+    query = select(
+        select(func.max(LostItem.id)).scalar_subquery(),
+        select(func.total(LostItemDaily.count)).scalar_subquery(),
+        select(func.max(Temperature.date)).scalar_subquery(),
+        select(func.count()).select_from(Temperature).scalar_subquery(),
+        select(func.count()).select_from(Gare).scalar_subquery(),
+        select(func.max(ImportState.updated)).scalar_subquery(),
+    )
+    return tuple(conn.execute(query).one())
+
+
+def last_dates(conn: Connection) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Finds the last day with a temperature and the last day with a lost item.
+
+    Args:
+        conn (sqlalchemy.engine.Connection): An open connection to the database.
+
+    Returns:
+        Tuple[str, str]: The two days 'YYYY-MM-DD', None for an empty table.
+    """
+    query = select(
+        select(func.substr(func.max(Temperature.date), 1, 10)).scalar_subquery(),
+        select(func.substr(func.max(LostItem.date), 1, 10)).scalar_subquery(),
+    )
+    return tuple(conn.execute(query).one())
+
+
+def daily_counts_by_type(conn: Connection, typed: bool = False) -> pd.DataFrame:
+    """
+    Counts lost items per day and type of object.
+
+    Args:
+        conn (sqlalchemy.engine.Connection): An open connection to the database.
+        typed (bool): Whether to read compact dtypes, in chunks (see `read_compact`).
+
+    Returns:
+        pd.DataFrame: Columns date, type_objet, saison, count.
+    """
+    query = (
+        select(LostItemDaily.date, LostItemDaily.type_objet, LostItemDaily.saison, func.sum(LostItemDaily.count).label("count"))
+        .group_by(LostItemDaily.date, LostItemDaily.type_objet)
+        .order_by(LostItemDaily.date, LostItemDaily.type_objet)
+    )
+    return _read(query, conn, typed)
+
+
+def daily_counts(conn: Connection, typed: bool = False) -> pd.DataFrame:
+    """
+    Counts lost items per day, all types of object together.
+
+    Args:
+        conn (sqlalchemy.engine.Connection): An open connection to the database.
+        typed (bool): Whether to read compact dtypes, in chunks (see `read_compact`).
+
+    Returns:
+        pd.DataFrame: Columns date, saison, count.
+    """
+    query = (
+        select(LostItemDaily.date, LostItemDaily.saison, func.sum(LostItemDaily.count).label("count"))
+        .group_by(LostItemDaily.date)
+        .order_by(LostItemDaily.date)
+    )
+    return _read(query, conn, typed)
+
+
+def daily_counts_with_temperature(conn: Connection, by_type: bool = False, typed: bool = False) -> pd.DataFrame:
+    """
+    Counts lost items per day (and optionally per type) joined with the temperature of the day.
+
+    Days without a temperature are left out, like the inner merge of the charts.
+
+    Args:
+        conn (sqlalchemy.engine.Connection): An open connection to the database.
+        by_type (bool): Whether to count each type of object separately.
+        typed (bool): Whether to read compact dtypes, in chunks (see `read_compact`).
+
+    Returns:
+        pd.DataFrame: Columns date, [type_objet,] count, temperature.
+    """
+    keys = [LostItemDaily.date, LostItemDaily.type_objet] if by_type else [LostItemDaily.date]
+    query = (
+        select(*keys, func.sum(LostItemDaily.count).label("count"), Temperature.temperature)
+        .join(Temperature, Temperature.date == LostItemDaily.date)
+        .group_by(*keys)
+        .order_by(*keys)
+    )
+    return _read(query, conn, typed)
+
+
+def station_year_type_counts(conn: Connection) -> pd.DataFrame:
+    """
+    Counts lost items per year, type of object and station.
+
+    Args:
+        conn (sqlalchemy.engine.Connection): An open connection to the database.
+
+    Returns:
+        pd.DataFrame: Columns year ('YYYY'), type_objet, nom_gare, count.
+    """
+    year = func.strftime("%Y", LostItemDaily.date).label("year")
+    query = (
+        select(year, LostItemDaily.type_objet, LostItemDaily.nom_gare, func.sum(LostItemDaily.count).label("count"))
+        .group_by(year, LostItemDaily.type_objet, LostItemDaily.nom_gare)
+        .order_by(year, LostItemDaily.type_objet, LostItemDaily.nom_gare)
+    )
+    return pd.read_sql(query, conn)
+
+
+def restitution_counts(conn: Connection, typed: bool = False) -> pd.DataFrame:
+    """
+    Sums the lost items, the returned ones, their delays and their tranches of delay per type of object,
+    station and season, over the whole history.
+
+    Args:
+        conn (sqlalchemy.engine.Connection): An open connection to the database.
+        typed (bool): Whether to read compact dtypes, in chunks (see `read_compact`).
+
+    Returns:
+        pd.DataFrame: Columns type_objet, nom_gare, saison, count, restitues, delai_jours and TRANCHE_COLUMNS.
+    """
+    keys = [LostItemDaily.type_objet, LostItemDaily.nom_gare, LostItemDaily.saison]
+    sums = [func.sum(getattr(LostItemDaily, column)).label(column) for column in ["count", "restitues", "delai_jours"] + TRANCHE_COLUMNS]
+    query = select(*keys, *sums).group_by(*keys).order_by(*keys)
+    return _read(query, conn, typed)
+
+
+def weekly_counts_by_type(conn: Connection, type_objet: Optional[str] = None) -> pd.DataFrame:
+    """
+    Counts lost items per week (starting on Monday) and type of object.
+
+    Args:
+        conn (sqlalchemy.engine.Connection): An open connection to the database.
+        type_objet (str, optional): Only count this type of object.
+
+    Returns:
+        pd.DataFrame: Columns week ('YYYY-MM-DD' of the Monday), type_objet, count.
+    """
+    week = func.date(LostItemDaily.date, "weekday 0", "-6 days").label("week")
+    query = (
+        select(week, LostItemDaily.type_objet, func.sum(LostItemDaily.count).label("count"))
+        .group_by(week, LostItemDaily.type_objet)
+        .order_by(week, LostItemDaily.type_objet)
+    )
+    if type_objet is not None:
+        query = query.where(LostItemDaily.type_objet == type_objet)
+    return pd.read_sql(query, conn)
+
+
+def station_rates(conn: Connection, year: str, type_objet: Optional[str] = None) -> pd.DataFrame:
+    """
+    Counts the lost items of a year per station and per million travellers, like the map of the dashboard.
+
+    Args:
+        conn (sqlalchemy.engine.Connection): An open connection to the database.
+        year (str): The year, 'YYYY'.
+        type_objet (str, optional): Only count this type of object.
+
+    Returns:
+        pd.DataFrame: Columns nom_gare, longitude, latitude, count, voyageurs, lost_pour_million.
+    """
+    cube = station_year_cube(conn)
+    cube = cube[(cube["year"] == year) & (cube["type_objet"] == (type_objet or TOUS_LES_TYPES))]
+    return cube.drop(columns=["year", "type_objet"]).reset_index(drop=True)
+
+
+def season_type_medians(conn: Connection) -> pd.DataFrame:
+    """
+    Computes the median number of lost items per day for each season and type of object, over the days
+    the type was found, like the heatmap of the dashboard.
+
+    Args:
+        conn (sqlalchemy.engine.Connection): An open connection to the database.
+
+    Returns:
+        pd.DataFrame: Columns saison, type_objet, median.
+    """
+    df = daily_counts_by_type(conn)
+    return (
+        df.groupby(["saison", "type_objet"])["count"].median()
+        .reset_index(name="median")
+        .sort_values(["saison", "type_objet"], ignore_index=True)
+    )
+
+
+def lost_items_page(conn: Connection, after_id: int = 0, limit: int = 100, type_objet: Optional[str] = None,
+                    nom_gare: Optional[str] = None, since: Optional[str] = None, until: Optional[str] = None) -> pd.DataFrame:
+    """
+    Lists lost items in id order, one page at a time. The page starts after the last id of the previous one
+    (keyset pagination), so every page is an index range scan whatever its position.
+
+    Args:
+        conn (sqlalchemy.engine.Connection): An open connection to the database.
+        after_id (int): The last id of the previous page, 0 for the first page.
+        limit (int): The maximal number of items.
+        type_objet (str, optional): Only list this type of object.
+        nom_gare (str, optional): Only list this station.
+        since (str, optional): Only list items found on or after this day, 'YYYY-MM-DD'.
+        until (str, optional): Only list items found on or before this day, 'YYYY-MM-DD'.
+
+    Returns:
+        pd.DataFrame: Columns id, date, type_objet, nom_gare, date_restitution.
+    """
+    query = (
+        select(LostItem.id, LostItem.date, TypeObjet.libelle.label("type_objet"), LostItem.nom_gare, LostItem.date_restitution)
+        .join(TypeObjet, TypeObjet.id == LostItem.type_id)
+        .where(LostItem.id > after_id)
+        .order_by(LostItem.id)
+        .limit(limit)
+    )
+    if type_objet is not None:
+        query = query.where(TypeObjet.libelle == type_objet)
+    if nom_gare is not None:
+        query = query.where(LostItem.nom_gare == nom_gare)
+    if since is not None:
+        query = query.where(LostItem.date >= since)
+    if until is not None:
+        query = query.where(LostItem.date <= until)
+    return pd.read_sql(query, conn)
+
+
+def frequentation(conn: Connection) -> pd.DataFrame:
+    """
+    Loads the yearly frequentation of the stations.
+
+    Args:
+        conn (sqlalchemy.engine.Connection): An open connection to the database.
+
+    Returns:
+        pd.DataFrame: Columns nom_gare, annee ('YYYY'), voyageurs.
+    """
+    return pd.read_sql(select(Frequentation).order_by(Frequentation.nom_gare, Frequentation.annee), conn)
+
+
+def station_year_cube(conn: Connection, typed: bool = False) -> pd.DataFrame:
+    """
+    Counts lost items per station, year and type of object, plus one row per station and year for all
+    types together (type_objet = TOUS_LES_TYPES), normalized by the frequentation of the station.
+
+    A year without published frequentation uses the closest year that has one (the later one on a tie).
+
+    Args:
+        conn (sqlalchemy.engine.Connection): An open connection to the database.
+        typed (bool): Whether to return compact dtypes (see `compact`).
+
+    Returns:
+        pd.DataFrame: Columns year, type_objet, nom_gare, longitude, latitude, count, voyageurs,
+        lost_pour_million (rounded to an integer), sorted by year, type_objet and nom_gare.
+    """
+    counts = station_year_type_counts(conn)
+    all_types = counts.groupby(["year", "nom_gare"], as_index=False)["count"].sum().assign(type_objet=TOUS_LES_TYPES)
+    counts = pd.concat([counts, all_types], ignore_index=True)
+
+    freq = frequentation(conn)
+    freq = freq[freq["voyageurs"] > 0]
+    station_years = counts[["nom_gare", "year"]].drop_duplicates().merge(freq, on="nom_gare")
+    station_years["distance"] = (station_years["year"].astype(int) - station_years["annee"].astype(int)).abs()
+    station_years = (
+        station_years.sort_values(["nom_gare", "year", "distance", "annee"], ascending=[True, True, True, False])
+        .drop_duplicates(["nom_gare", "year"])
+    )
+
+    cube = (
+        counts.merge(gares(conn)[["nom_gare", "longitude", "latitude"]], on="nom_gare")
+        .merge(station_years[["nom_gare", "year", "voyageurs"]], on=["nom_gare", "year"])
+    )
+    cube["lost_pour_million"] = (cube["count"] / (cube["voyageurs"] / 1000000)).round().astype(int)
+    columns = ["year", "type_objet", "nom_gare", "longitude", "latitude", "count", "voyageurs", "lost_pour_million"]
+    cube = cube[columns].sort_values(["year", "type_objet", "nom_gare"], ignore_index=True)
+    # The cube holds a few rows per station and year: it is built from strings and compacted at the end
+    return compact(cube) if typed else cube
+
+
+def gares(conn: Connection) -> pd.DataFrame:
+    """
+    Loads the station table (a handful of rows) with coordinates and frequentation.
+
+    Args:
+        conn (sqlalchemy.engine.Connection): An open connection to the database.
+
+    Returns:
+        pd.DataFrame: One row per station.
+    """
+    return pd.read_sql(select(Gare), conn)
+
+
+def dashboard_data(conn: Connection) -> Dict[str, Any]:
+    """
+    Loads every frame the dashboard draws from, with compact dtypes (see `read_compact`).
+
+    Args:
+        conn (sqlalchemy.engine.Connection): An open connection to the database.
+
+    Returns:
+        Dict[str, Any]: The frames by name, plus the list of types of object.
+    """
+    return {
+        "daily_type": daily_counts_by_type(conn, typed=True),
+        "daily": daily_counts(conn, typed=True),
+        "station_year": station_year_cube(conn, typed=True),
+        "temp_type": daily_counts_with_temperature(conn, by_type=True, typed=True),
+        "temp_all": daily_counts_with_temperature(conn, typed=True),
+        "restitution": restitution_counts(conn, typed=True),
+        "gare": gares(conn),
+        "types": type_list(conn),
+    }
+
+
+def type_list(conn: Connection) -> List[str]:
+    """
+    Lists the types of object found in the database.
+
+    Args:
+        conn (sqlalchemy.engine.Connection): An open connection to the database.
+
+    Returns:
+        List[str]: The distinct types, sorted.
+    """
+    query = select(LostItemDaily.type_objet).distinct().order_by(LostItemDaily.type_objet)
+    return list(conn.execute(query).scalars())
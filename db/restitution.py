@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+from sqlalchemy import Integer, case, cast, func
+
+# Tranches du délai de restitution en jours, avec la colonne de LostItemDaily qui les compte
+TRANCHES = ["Le jour même", "1 à 7 jours", "8 à 30 jours", "Plus de 30 jours"]
+TRANCHE_COLUMNS = ["delai_0", "delai_1_7", "delai_8_30", "delai_31"]
+
+# Dernier jour de chaque tranche sauf la dernière
+_FINS = np.array([0, 7, 30])
+
+
+def delais(dates: pd.Series, restitutions: pd.Series) -> pd.Series:
+    """
+    Computes the number of days between the day an item was found and the day it was returned.
+
+    The found day is local and the restitution is stored in UTC, so an item returned a few hours after it
+    was found around midnight can get -1 day: delays are counted from 0.
+
+    Args:
+        dates (pd.Series): The found days, 'YYYY-MM-DD' strings or datetime64 values.
+        restitutions (pd.Series): The restitution timestamps 'YYYY-MM-DD HH:MM:SS', None when not returned.
+
+    Returns:
+        pd.Series: The delays in days, NaN for items not returned.
+    """
+    found = pd.to_datetime(dates, format="%Y-%m-%d") if not pd.api.types.is_datetime64_any_dtype(dates) else dates
+    returned = pd.to_datetime(restitutions, format="%Y-%m-%d %H:%M:%S").dt.normalize()
+    return ((returned - found).dt.days).clip(lower=0).rename("delai")
+
+
+def tranches(delais: pd.Series) -> pd.Series:
+    """
+    Vectorized classification of delays into TRANCHES.
+
+    Args:
+        delais (pd.Series): Delays in days, as returned by `delais`.
+
+    Returns:
+        pd.Series: The index of the tranche of each delay in TRANCHES, -1 for items not returned.
+    """
+    codes = np.searchsorted(_FINS, delais.to_numpy(dtype=float, na_value=np.nan), side="left")
+    return pd.Series(np.where(delais.isna(), -1, codes), index=delais.index, name="tranche")
+
+
+def delai_sql(date, date_restitution):
+    """
+    Same as `delais` in SQL: days between the found day and the UTC day of the restitution, from 0, NULL if
+    the item was not returned.
+    """
+    return func.max(cast(func.julianday(func.substr(date_restitution, 1, 10)) - func.julianday(date), Integer), 0)
+
+
+def tranche_counts_sql(delai) -> list:
+    """
+    SQL aggregates counting the delays of each tranche, in the order of TRANCHE_COLUMNS.
+    """
+    bounds = zip([0] + [int(fin) + 1 for fin in _FINS], [int(fin) for fin in _FINS] + [None])
+    return [
+        func.count(case((delai >= low, 1))) if high is None else func.count(case((delai.between(low, high), 1)))
+        for low, high in bounds
+    ]
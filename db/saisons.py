@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+
+SAISONS = ["Hiver", "Printemps", "Été", "Automne"]
+
+# Premier jour (mois * 100 + jour) de Printemps, Été, Automne et de l'Hiver suivant
+_DEBUTS = np.array([320, 621, 922, 1221])
+
+
+def saison(date_str: str) -> str:
+    mois_jour = date_str[5:]  # extraire le mois et le jour de la date au format string
+
+    if mois_jour >= '03-20' and mois_jour <= '06-20':
+        return "Printemps"
+    elif mois_jour >= '06-21' and mois_jour <= '09-21':
+        return "Été"
+    elif mois_jour >= '09-22' and mois_jour <= '12-20':
+        return "Automne"
+    else:
+        return "Hiver"
+
+
+def saisons(dates: pd.Series) -> pd.Series:
+    """
+    Vectorized version of `saison`, returning the same labels as a categorical Series.
+
+    Args:
+        dates (pd.Series): 'YYYY-MM-DD' strings or datetime64 values.
+
+    Returns:
+        pd.Series: The season of each date, with categories in calendar order.
+    """
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        mois_jour = dates.dt.month.to_numpy() * 100 + dates.dt.day.to_numpy()
+    else:
+        dates = dates.astype(str)
+        mois_jour = dates.str.slice(5, 7).astype(int).to_numpy() * 100 + dates.str.slice(8, 10).astype(int).to_numpy()
+    codes = np.searchsorted(_DEBUTS, mois_jour, side="right") % 4
+    return pd.Series(pd.Categorical.from_codes(codes, categories=SAISONS), index=dates.index, name="saison")
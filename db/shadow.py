@@ -0,0 +1,88 @@
+"""
+Zero-downtime rebuild: the import fills a shadow database file, then its tables replace the live ones
+in a single transaction.
+
+With WAL journaling, dashboard readers keep seeing the complete old data until that transaction commits
+and the complete new data afterwards. If the import fails, the live tables are never touched and the
+shadow file is kept so the rebuild can resume into it.
+"""
+import logging
+import os
+import sqlite3
+from typing import List
+from .engine import BUSY_TIMEOUT, dispose_engine
+from .migrate import upgrade
+from .model import Base, ImportState
+
+
+def shadow_path(path: str) -> str:
+    return path + ".shadow"
+
+
+def discard(path: str) -> None:
+    """
+    Deletes the shadow database of `path` and its journal files, if any.
+
+    Args:
+        path (str): Path of the live SQLite file.
+    """
+    dispose_engine(shadow_path(path))
+    for suffix in ("", "-wal", "-shm", "-journal"):
+        if os.path.exists(shadow_path(path) + suffix):
+            os.remove(shadow_path(path) + suffix)
+
+
+def prepare(path: str, fresh: bool = True) -> str:
+    """
+    Creates the shadow database of `path` with the current schema.
+
+    Args:
+        path (str): Path of the live SQLite file.
+        fresh (bool): Start from an empty shadow. If False, an existing shadow (from an interrupted
+            rebuild) is kept so the import can resume into it.
+
+    Returns:
+        str: Path of the shadow file.
+    """
+    if fresh:
+        discard(path)
+    upgrade(shadow_path(path))
+    return shadow_path(path)
+
+
+def swap(path: str, tables: List[str]) -> None:
+    """
+    Replaces the content of `tables` in the live database by the shadow's, in one transaction,
+    with the matching ImportState checkpoints. The shadow is deleted afterwards.
+
+    Args:
+        path (str): Path of the live SQLite file.
+        tables (List[str]): Names of the tables to replace.
+    """
+    upgrade(path)
+    dispose_engine(shadow_path(path))
+    ordered = [table for table in Base.metadata.sorted_tables if table.name in tables]
+    placeholders = ", ".join("?" for _ in tables)
+    state_table = ImportState.__tablename__
+
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None)
+    try:
+        conn.execute("ATTACH DATABASE ? AS shadow", (shadow_path(path),))
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for table in reversed(ordered):
+                conn.execute(f'DELETE FROM main."{table.name}"')
+            for table in ordered:
+                columns = ", ".join(f'"{column.name}"' for column in table.columns)
+                conn.execute(f'INSERT INTO main."{table.name}" ({columns}) SELECT {columns} FROM shadow."{table.name}"')
+            conn.execute(f'DELETE FROM main."{state_table}" WHERE source IN ({placeholders})', tables)
+            conn.execute(f'INSERT INTO main."{state_table}" SELECT * FROM shadow."{state_table}" WHERE source IN ({placeholders})', tables)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("DETACH DATABASE shadow")
+    finally:
+        conn.close()
+    logging.info(f"SHADOW: {', '.join(tables)} remplacées dans {path}")
+    discard(path)
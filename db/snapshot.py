@@ -0,0 +1,126 @@
+"""
+Columnar snapshot of the dashboard frames, published after each successful import.
+
+Every frame of `queries.dashboard_data` is written as an uncompressed Arrow IPC (Feather v2) file with
+dictionary-encoded strings. The dashboard opens the files memory-mapped instead of querying SQLite, so a
+cold start skips the DB-API row conversion and reads the pages from the OS cache. The frames are converted
+to pandas once per process and shared read-only by its sessions (`st.cache_resource` in app.py).
+
+A manifest records the data version and schema the snapshot was built from; a snapshot that does not match
+the database (an import committed since, a schema upgrade, or no snapshot yet) is ignored and the dashboard
+queries SQLite.
+"""
+import json
+import logging
+import os
+import tempfile
+from typing import Any, Callable, Dict, Optional, Tuple
+import pandas as pd
+from sqlalchemy.engine import Engine
+from . import queries
+from .model import SCHEMA_VERSION
+
+try:
+    import pyarrow as pa
+    from pyarrow import feather
+except ImportError:  # pyarrow comes with streamlit; without it the dashboard reads SQLite directly
+    pa = None
+
+MANIFEST = "manifest.json"
+
+
+def snapshot_dir(path: str) -> str:
+    return path + ".snapshot"
+
+
+def _write_atomic(path: str, write: Callable[[str], None]) -> None:
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def _dump_json(obj: Any, path: str) -> None:
+    with open(path, "w") as f:
+        json.dump(obj, f)
+
+
+def _to_arrow(df: pd.DataFrame) -> "pa.Table":
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for i, field in enumerate(table.schema):
+        if pa.types.is_string(field.type) or pa.types.is_large_string(field.type):
+            table = table.set_column(i, field.name, table.column(i).dictionary_encode())
+    return table
+
+
+def publish(engine: Engine, path: str) -> Optional[Tuple]:
+    """
+    Writes the snapshot of the database at `path`. Each file is written under a temporary name then
+    renamed, and the manifest last, so readers never open a partial snapshot.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): An engine on the database.
+        path (str): Path of the SQLite file; the snapshot goes to `snapshot_dir(path)`.
+
+    Returns:
+        Tuple: The data version of the snapshot, or None if pyarrow is not installed.
+    """
+    if pa is None:
+        logging.warning("SNAPSHOT: pyarrow n'est pas installé, pas d'instantané")
+        return None
+    with engine.connect() as conn:
+        version = queries.data_version(conn)
+        data = queries.dashboard_data(conn)
+    data["types"] = pd.DataFrame({"type_objet": data["types"]})
+
+    directory = snapshot_dir(path)
+    os.makedirs(directory, exist_ok=True)
+    for name, df in data.items():
+        table = _to_arrow(df)
+        _write_atomic(os.path.join(directory, f"{name}.arrow"), lambda tmp: feather.write_feather(table, tmp, compression="uncompressed"))
+    manifest = {"version": list(version), "schema": SCHEMA_VERSION, "frames": sorted(data)}
+    _write_atomic(os.path.join(directory, MANIFEST), lambda tmp: _dump_json(manifest, tmp))
+    logging.info(f"SNAPSHOT: {directory} version {version}")
+    return version
+
+
+def _from_arrow(table: "pa.Table") -> pd.DataFrame:
+    df = table.to_pandas()
+    # Sorted categories keep the row order of groupbys the same as with the plain strings of SQLite
+    for column in df.columns:
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].cat.reorder_categories(sorted(df[column].cat.categories))
+    return df
+
+
+def load(path: str, version: Tuple) -> Optional[Dict[str, Any]]:
+    """
+    Opens the snapshot of the database at `path` memory-mapped, if it matches the data version.
+
+    Args:
+        path (str): Path of the SQLite file.
+        version (Tuple): The current `queries.data_version` of the database.
+
+    Returns:
+        Dict[str, Any]: The frames of `queries.dashboard_data`, with categorical string columns,
+        or None if there is no up-to-date snapshot.
+    """
+    if pa is None:
+        return None
+    directory = snapshot_dir(path)
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+    # A snapshot written before a schema upgrade may lack frames the dashboard now draws
+    if tuple(manifest["version"]) != tuple(version) or manifest.get("schema") != SCHEMA_VERSION:
+        return None
+
+    data = {name: _from_arrow(feather.read_table(os.path.join(directory, f"{name}.arrow"), memory_map=True)) for name in manifest["frames"]}
+    data["types"] = data["types"]["type_objet"].astype(str).tolist()
+    return data
@@ -0,0 +1,125 @@
+"""
+Background updates for the dashboard: one update at a time per process, run in a thread so the page keeps
+rendering while the API is queried.
+
+    job, started = worker.start(update, version_before=version, on_success=clear_caches)
+    worker.status()  # {"id": 1, "state": "en cours", "progress": {"LostItem, Paris Est": [3, 12], ...}, ...}
+
+Streamlit serves every session from the same process: a click while an update runs gets the running job
+back instead of starting a second import into the same tables.
+"""
+import itertools
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+RUNNING = "en cours"
+DONE = "terminée"
+FAILED = "échec"
+
+_lock = threading.Lock()
+_ids = itertools.count(1)
+_job: Optional["UpdateJob"] = None
+_thread: Optional[threading.Thread] = None
+
+
+class UpdateJob:
+    """The state of one update, written by the worker thread and read by the pages."""
+
+    def __init__(self, version_before: Optional[Tuple] = None):
+        self.id = next(_ids)
+        self.state = RUNNING
+        self.version_before = version_before
+        self.started = time.time()
+        self.finished: Optional[float] = None
+        self.error: Optional[str] = None
+        self.progress: Dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def report(self, table: str, key: Tuple[str, ...], done: int, total: int) -> None:
+        """
+        Records the progress of one importer key, with the signature of `Importer.progress`.
+        """
+        with self._lock:
+            self.progress[", ".join((table,) + tuple(key))] = [done, total]
+
+    def finish(self, error: Optional[str] = None) -> None:
+        with self._lock:
+            self.error = error
+            self.state = FAILED if error else DONE
+            self.finished = time.time()
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "id": self.id,
+                "state": self.state,
+                "version_before": self.version_before,
+                "started": self.started,
+                "finished": self.finished,
+                "error": self.error,
+                "progress": {name: list(counts) for name, counts in self.progress.items()},
+            }
+
+
+def _run(job: UpdateJob, update: Callable[[Callable], None], on_success: Optional[Callable[[], None]]) -> None:
+    try:
+        update(job.report)
+        # Caches are refreshed before the job shows as done, so pages polling the status reload new data
+        if on_success is not None:
+            on_success()
+    except Exception as exc:
+        logging.exception("MISE A JOUR: échec")
+        job.finish(f"{type(exc).__name__}: {exc}")
+        return
+    logging.info(f"MISE A JOUR: terminée en {time.time() - job.started:.0f}s")
+    job.finish()
+
+
+def start(update: Callable[[Callable], None], version_before: Optional[Tuple] = None,
+          on_success: Optional[Callable[[], None]] = None) -> Tuple[Dict[str, Any], bool]:
+    """
+    Starts an update in a background thread, unless one is already running.
+
+    Args:
+        update (Callable): Runs the update; it receives the progress callback to give the importers.
+        version_before (Tuple, optional): The data version before the update, kept in the status so pages
+            can go on drawing it until the update is complete.
+        on_success (Callable, optional): Called in the worker thread once the update has committed.
+
+    Returns:
+        Tuple[Dict[str, Any], bool]: The status of the running job, and whether this call started it.
+    """
+    global _job, _thread
+    with _lock:
+        if _job is not None and _job.state == RUNNING:
+            return _job.as_dict(), False
+        _job = UpdateJob(version_before)
+        _thread = threading.Thread(target=_run, args=(_job, update, on_success), name=f"mise-a-jour-{_job.id}", daemon=True)
+        _thread.start()
+        return _job.as_dict(), True
+
+
+def status() -> Optional[Dict[str, Any]]:
+    """
+    Returns the status of the running or last update of the process, None if there was none.
+    """
+    job = _job
+    return job.as_dict() if job is not None else None
+
+
+def wait(timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+    """
+    Waits for the running update to end.
+
+    Args:
+        timeout (float, optional): Maximum wait in seconds.
+
+    Returns:
+        Dict[str, Any]: The status of the last update.
+    """
+    thread = _thread
+    if thread is not None:
+        thread.join(timeout)
+    return status()
@@ -1,22 +1,61 @@
-from db.model import create_tables
-from db.import_classes import LostItemImporter, TemperatureImporter, GareImporter
-from sqlalchemy import create_engine
+import argparse
+import logging
+import os
+import sys
+from db import metrics, shadow, snapshot
+from db.migrate import upgrade
+from db.orchestrator import SOURCES, TABLES, run
+from db.engine import get_db_path, get_engine
+from db.http_cache import ResponseCache
 
+parser = argparse.ArgumentParser(description="Build the database from the SNCF and Opendatasoft APIs.")
+parser.add_argument("--since", default="2018-01-01", help="start of the date range (default: 2018-01-01)")
+parser.add_argument("--until", default="now", help="end of the date range (default: now)")
+parser.add_argument("--stations", nargs="+", help="only import these stations, replacing their rows and keeping the other stations (needs --in-place)")
+parser.add_argument("--sources", nargs="+", choices=list(SOURCES), default=list(SOURCES), help="only import these sources")
+parser.add_argument("--jobs", type=int, default=2, help="number of sources imported at the same time")
+parser.add_argument("--workers", type=int, default=None, help="number of API requests per source running at the same time")
+parser.add_argument("--resume", action="store_true", help="continue from the last committed window instead of cleaning and starting over")
+parser.add_argument("--in-place", action="store_true", help="write directly into the live tables instead of a shadow database swapped in at the end")
+parser.add_argument("--replay", action="store_true", help="read every response from the HTTP cache, without network")
+parser.add_argument("--no-cache", action="store_true", help="do not read or write the HTTP cache")
+parser.add_argument("--metrics", metavar="FILE", default=None, help="append the timing of requests, parsing and inserts to this JSON lines file")
+args = parser.parse_args()
+if args.stations and not args.in_place:
+    parser.error("--stations replaces the rows of these stations in the live tables and needs --in-place")
 
 
-engine = create_engine('sqlite:///db.sqlite')
+if args.metrics:
+    metrics.configure(args.metrics)
 
-create_tables(engine)
-gare_importer = GareImporter(engine)
-gare_importer.clean()
-gare_importer.import_data()
+path = get_db_path()
+upgrade(path)
 
-temperature_importer = TemperatureImporter(engine)
-temperature_importer.clean()
-temperature_importer.import_data("01-01-2018","now")
-# temperature_importer.update()
+# A rebuild goes to a shadow database so the dashboard never sees half-imported tables.
+# --resume continues an interrupted shadow rebuild, or updates the live tables if there is none.
+use_shadow = not args.in_place and not (args.resume and not os.path.exists(shadow.shadow_path(path)))
+target = shadow.prepare(path, fresh=not args.resume) if use_shadow else path
 
-lostitem_importer = LostItemImporter(engine)
-lostitem_importer.clean()
-lostitem_importer.import_data("01-01-2018","now")
-# lostitem_importer.update()
\ No newline at end of file
+cache = None if args.no_cache else ResponseCache(replay=args.replay)
+status = run(
+    get_engine(target),
+    args.sources,
+    args.since,
+    args.until,
+    resume=args.resume,
+    jobs=args.jobs,
+    stations=args.stations,
+    max_workers=args.workers,
+    cache=cache,
+)
+logging.info(f"ORCHESTRATION: {status}")
+success = all(value == "ok" for value in status.values())
+
+if use_shadow:
+    if success:
+        shadow.swap(path, [table for source in args.sources for table in TABLES[source]])
+    else:
+        logging.error(f"SHADOW: import incomplet, la base {path} est inchangée. Relancer avec --resume pour continuer dans {target}")
+if success:
+    snapshot.publish(get_engine(path), path)
+sys.exit(0 if success else 1)
@@ -0,0 +1,138 @@
+# add files to python path
+import sys
+import os
+import inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+import requests
+from sqlalchemy import func, select, text
+from sqlalchemy.exc import OperationalError
+from api import QueryCache, make_server
+from benchmarks.synthetic import generate
+from db import queries
+from db.engine import create_db_engine
+from db.model import LostItem
+
+
+class TestApi(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.path = os.path.join(cls.tmpdir.name, "db.sqlite")
+        cls.engine = create_db_engine(cls.path)
+        generate(cls.engine, 2000, n_years=2, n_stations=3, n_types=4)
+        cls.server = make_server(port=0, path=cls.path)
+        cls.url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.server.engine.dispose()
+        cls.engine.dispose()
+        cls.tmpdir.cleanup()
+
+    def test_aggregates_match_dashboard_frames(self):
+        with self.engine.connect() as conn:
+            daily = queries.daily_counts_by_type(conn)
+            types = queries.type_list(conn)
+        weekly = requests.get(f"{self.url}/weekly").json()["data"]
+        self.assertEqual(sum(row["count"] for row in weekly), daily["count"].sum())
+        self.assertTrue(all(row["type_objet"] == types[0] for row in requests.get(f"{self.url}/weekly", params={"type_objet": types[0]}).json()["data"]))
+
+        seasons = requests.get(f"{self.url}/seasons").json()["data"]
+        self.assertEqual(len(seasons), daily.groupby(["saison", "type_objet"]).ngroups)
+
+        stations = requests.get(f"{self.url}/stations", params={"year": 2018}).json()["data"]
+        self.assertEqual(sum(row["count"] for row in stations), daily[daily["date"].str.startswith("2018")]["count"].sum())
+        self.assertTrue(all(row["lost_pour_million"] > 0 for row in stations))
+
+        temperature = requests.get(f"{self.url}/temperature").json()["data"]
+        self.assertEqual(set(temperature[0]), {"date", "count", "temperature"})
+
+    def test_items_keyset_pagination(self):
+        ids, after = [], 0
+        while after is not None:
+            page = requests.get(f"{self.url}/items", params={"after": after, "limit": 300}).json()
+            ids += [item["id"] for item in page["data"]]
+            after = page["next"]
+        with self.engine.connect() as conn:
+            self.assertEqual(ids, list(conn.execute(select(LostItem.id).order_by(LostItem.id)).scalars()))
+
+        self.assertEqual(requests.get(f"{self.url}/items", params={"limit": 0}).status_code, 400)
+        self.assertEqual(requests.get(f"{self.url}/items", params={"after": "x"}).status_code, 400)
+
+    def test_etag_and_cache(self):
+        answer = requests.get(f"{self.url}/seasons")
+        etag = answer.headers["ETag"]
+        self.assertEqual(requests.get(f"{self.url}/seasons", headers={"If-None-Match": etag}).status_code, 304)
+        self.assertIn(("/seasons", ()), self.server.cache.entries)
+
+        # A new import changes the data version: the ETag no longer matches and the cache is refilled
+        with self.engine.begin() as conn:
+            conn.execute(text('UPDATE "LostItemDaily" SET count = count + 1 WHERE rowid = 1'))
+        self.server._version = None
+        answer = requests.get(f"{self.url}/seasons", headers={"If-None-Match": etag})
+        self.assertEqual(answer.status_code, 200)
+        self.assertNotEqual(answer.headers["ETag"], etag)
+
+    def test_unknown_endpoint(self):
+        answer = requests.get(f"{self.url}/nothing")
+        self.assertEqual(answer.status_code, 404)
+        self.assertIn("/items", answer.json()["endpoints"])
+
+    def test_database_error(self):
+        locked = OperationalError("SELECT", {}, Exception("database is locked"))
+        with self.assertLogs(level="ERROR"), patch.object(self.server, "data_version", side_effect=locked):
+            answer = requests.get(f"{self.url}/seasons")
+        self.assertEqual(answer.status_code, 500)
+        self.assertIn("database is locked", answer.json()["error"])
+
+        def failing(conn, params):
+            raise locked
+        with self.assertLogs(level="ERROR"), patch.dict("api.ENDPOINTS", {"/failing": failing}):
+            answer = requests.get(f"{self.url}/failing")
+        self.assertEqual(answer.status_code, 500)
+        # The connection is kept alive and answers the next request
+        self.assertEqual(requests.get(f"{self.url}/version").status_code, 200)
+
+    def test_read_only(self):
+        with self.assertRaises(OperationalError):
+            with self.server.engine.begin() as conn:
+                conn.execute(text('DELETE FROM "LostItem"'))
+        with self.engine.connect() as conn:
+            self.assertGreater(conn.execute(select(func.count()).select_from(LostItem)).scalar(), 0)
+
+
+class TestQueryCache(unittest.TestCase):
+
+    def test_concurrent_misses_compute_once(self):
+        cache, calls = QueryCache(), []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.05)
+            return b"answer"
+
+        threads = [threading.Thread(target=cache.get_or_compute, args=((1,), "/seasons", compute)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertIsNone(cache.get((2,), "/seasons"))
+
+    def test_lru(self):
+        cache = QueryCache(max_entries=2)
+        for key in "abc":
+            cache.put((1,), key, key.encode())
+        self.assertEqual(list(cache.entries), ["b", "c"])
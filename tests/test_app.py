@@ -6,14 +6,20 @@ currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentfram
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0, parentdir) 
 
+import tempfile
 import unittest
+from unittest.mock import patch
 import pandas as pd
 import plotly.express as px
 from db.import_classes import LostItemImporter, TemperatureImporter
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, select
 
 # Import the functions to be tested
-from utils import get_importers, histogramme
+from utils import RESTITUTION_AXES, check_figure_size, delais_restitution, taux_restitution, data_mb, figure_kb, get_importers, histogramme, paris_map, scatter_par_type, scatter_tous_types, boxplot, heatmap, saisons
+from db import metrics, queries, snapshot
+from db.restitution import TRANCHES, delais, tranches
+from db.saisons import saison
+from db.model import Frequentation, Gare, LostItem, LostItemDaily, Temperature, TypeObjet, create_tables
 
 
 class TestFunctions(unittest.TestCase):
@@ -45,5 +51,244 @@ class TestFunctions(unittest.TestCase):
         self.assertEqual(fig.layout.xaxis.title.text, "Date où l'objet a été trouvé")
         self.assertEqual(fig.layout.yaxis.title.text, "Nombre d'objets trouvés par semaine")
         self.assertEqual(len(fig.data), 2)
-        self.assertEqual(fig.data[0].x[0], '2022-01-01')
-        self.assertEqual(fig.data[1].x[0], '2022-01-02')
\ No newline at end of file
+        # Both days fall in the week starting on Monday 2021-12-27
+        self.assertEqual(list(fig.data[0].x), ['2021-12-27'])
+        self.assertEqual(list(fig.data[0].y), [2])
+        self.assertEqual(list(fig.data[1].x), ['2021-12-27'])
+        self.assertEqual(list(fig.data[1].y), [1])
+
+    def test_histogramme_one_bar_per_week(self):
+        dates = pd.date_range('2022-01-03', '2022-03-27').strftime('%Y-%m-%d')
+        df = pd.DataFrame({'type_objet': 'phone', 'date': dates, 'count': 1})
+        fig = histogramme(df)
+        self.assertEqual(len(fig.data[0].x), 12)
+        self.assertEqual(set(fig.data[0].y), {7})
+
+    def test_scatter_point_budget(self):
+        dates = pd.date_range('2000-01-01', periods=8000).strftime('%Y-%m-%d')
+        df = pd.DataFrame({'date': list(dates[:4000]) + list(dates), 'type_objet': ['SAC'] * 4000 + ['CLE'] * 8000, 'count': 1})
+        df_temp = pd.DataFrame({'date': dates, 'temperature': range(8000)})
+        with patch('utils.SCATTER_MAX_POINTS', 1200):
+            fig = scatter_par_type(df, df_temp)
+            fig_all = scatter_tous_types(df, df_temp)
+        sizes = {trace.name: len(trace.x) for trace in fig.data}
+        # Each type keeps the same share of its points
+        self.assertEqual(sizes, {'SAC': 400, 'CLE': 800})
+        self.assertEqual({trace.type for trace in fig.data}, {'scattergl'})
+        self.assertEqual(len(fig_all.data[0].x), 1200)
+
+        small = scatter_tous_types(df.head(100), df_temp)
+        self.assertEqual(small.data[0].type, 'scatter')
+
+    def test_figure_size(self):
+        fig = histogramme(self.df)
+        with self.assertLogs(level='WARNING'):
+            size = check_figure_size('histogramme', fig, max_kb=0.001)
+        self.assertAlmostEqual(size, len(fig.to_json().encode()) / 1024)
+
+    def test_figure_metrics(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            metrics.configure(os.path.join(tmpdir, "metrics.jsonl"))
+            try:
+                fig = boxplot(self.df)
+            finally:
+                metrics.configure(None)
+        event = metrics.recent()[-1]
+        self.assertEqual((event["stage"], event["chart"], event["rows"]), ("figure", "boxplot", len(self.df)))
+        self.assertAlmostEqual(event["kb"], figure_kb(fig), places=0)
+        self.assertEqual(boxplot.__name__, "boxplot")
+
+    def test_histogramme_from_daily_counts(self):
+        df_daily = self.df.groupby(['date', 'type_objet']).size().reset_index(name='count')
+        fig = histogramme(df_daily)
+        fig_raw = histogramme(self.df)
+        for trace, trace_raw in zip(fig.data, fig_raw.data):
+            self.assertEqual(list(trace.x), list(trace_raw.x))
+            self.assertEqual(list(trace.y), list(trace_raw.y))
+
+
+    def test_charts_of_empty_database(self):
+        df = pd.DataFrame({'date': pd.Series(dtype=str), 'type_objet': pd.Series(dtype=str), 'saison': pd.Series(dtype=str), 'count': pd.Series(dtype=int)})
+        self.assertEqual(len(heatmap(df).data), 1)
+        self.assertEqual(len(boxplot(df).data), 1)
+
+
+    def test_saisons_matches_saison(self):
+        dates = pd.Series(pd.date_range("2019-12-15", "2021-01-15").strftime("%Y-%m-%d"))
+        expected = [saison(date) for date in dates]
+        self.assertEqual(list(saisons(dates)), expected)
+        self.assertEqual(list(saisons(pd.to_datetime(dates))), expected)
+
+
+class TestQueries(unittest.TestCase):
+    """The pre-aggregated frames of db.queries must draw the same figures as the raw tables."""
+
+    def setUp(self):
+        self.engine = create_engine('sqlite:///:memory:')
+        create_tables(self.engine)
+        lostitem_importer = LostItemImporter(self.engine)
+        session = lostitem_importer.session
+        session.add_all([
+            Gare(nom_gare='Paris Est', longitude=2.35, latitude=48.87),
+            Gare(nom_gare='Paris Nord', longitude=2.36, latitude=48.88),
+        ])
+        session.add_all([
+            Frequentation(nom_gare=nom_gare, annee=annee, voyageurs=voyageurs)
+            for nom_gare, freqs in (('Paris Est', (30000000, 20000000, 25000000)), ('Paris Nord', (90000000, 50000000, 60000000)))
+            for annee, voyageurs in zip(('2019', '2020', '2021'), freqs)
+        ])
+        session.add_all([Temperature(date=f'2021-{month:02d}-{day:02d}', temperature=month + day / 10) for month in (1, 4, 7, 10) for day in range(1, 9)])
+        session.commit()
+        records = []
+        for i in range(300):
+            month, day = (1, 4, 7, 10)[i % 4], 1 + i % 11
+            fields = {
+                'date': f'{2020 + i % 2}-{month:02d}-{day:02d}T08:00:00+00:00',
+                'gc_obo_type_c': ['SAC', 'CLE', 'TELEPHONE'][i % 3],
+                'gc_obo_gare_origine_r_name': ['Paris Est', 'Paris Nord'][i % 5 % 2],
+                'gc_obo_date_heure_restitution_c': f'{2020 + i % 2}-{month + 1:02d}-{1 + i % 13:02d}T18:00:00+01:00' if i % 7 < 3 else None,
+            }
+            records.append({'fields': fields})
+        lostitem_importer._insert_records(records)
+
+        with self.engine.begin() as conn:
+            self.df_raw = pd.read_sql(select(LostItem.id, LostItem.date, TypeObjet.libelle.label('type_objet'), LostItem.nom_gare, LostItem.date_restitution).join(LostItem.type), conn)
+            self.df_temp = pd.read_sql(select(Temperature), conn)
+            self.df_gare = queries.gares(conn)
+            self.df_daily_type = queries.daily_counts_by_type(conn)
+            self.df_daily = queries.daily_counts(conn)
+            self.df_station_year = queries.station_year_cube(conn)
+            self.df_temp_type = queries.daily_counts_with_temperature(conn, by_type=True)
+            self.df_temp_all = queries.daily_counts_with_temperature(conn)
+            self.df_restitution = queries.restitution_counts(conn)
+            self.types = queries.type_list(conn)
+
+    def assertSameTraces(self, fig, fig_raw):
+        self.assertEqual(len(fig.data), len(fig_raw.data))
+        for trace, trace_raw in zip(fig.data, fig_raw.data):
+            for attribute in ('x', 'y', 'z', 'lat', 'lon', 'marker'):
+                if attribute in trace:
+                    self.assertEqual(str(trace[attribute]), str(trace_raw[attribute]))
+
+    def test_data_version_changes_on_import(self):
+        with self.engine.connect() as conn:
+            version = queries.data_version(conn)
+        self.assertEqual(version[1], 300)
+        importer = LostItemImporter(self.engine)
+        importer._store_window(('Paris Est', '2020-01-01', '2020-01-31'), [])
+        with self.engine.connect() as conn:
+            self.assertNotEqual(queries.data_version(conn), version)
+
+    def test_data_version_changes_on_window_replaced(self):
+        # The window is stored again with as many rows: they reuse the freed rowids and keep the rollup total
+        window = ('Paris Est', '2022-06-01', '2022-06-30')
+        records = [{'fields': {'date': '2022-06-10', 'gc_obo_type_c': 'SAC', 'gc_obo_gare_origine_r_name': 'Paris Est'}}]
+        importer = LostItemImporter(self.engine)
+        importer._store_window(window, records)
+        with self.engine.connect() as conn:
+            version = queries.data_version(conn)
+        records[0]['fields']['gc_obo_date_heure_restitution_c'] = '2022-06-12T10:00:00+02:00'
+        importer._store_window(window, records)
+        with self.engine.connect() as conn:
+            self.assertEqual(queries.data_version(conn)[:5], version[:5])
+            self.assertNotEqual(queries.data_version(conn), version)
+
+    def test_type_list(self):
+        self.assertEqual(self.types, ['CLE', 'SAC', 'TELEPHONE'])
+
+    def test_histogramme_parity(self):
+        self.assertSameTraces(histogramme(self.df_daily_type), histogramme(self.df_raw))
+
+    def test_station_year_cube(self):
+        raw = self.df_raw.assign(year=self.df_raw['date'].str[:4])
+        freq_2021 = {'Paris Est': 25000000, 'Paris Nord': 60000000}
+        for type_object in [queries.TOUS_LES_TYPES, 'SAC']:
+            rows = raw if type_object == queries.TOUS_LES_TYPES else raw[raw['type_objet'] == type_object]
+            counts = rows[rows['year'] == '2021'].groupby('nom_gare').size()
+            expected = {nom_gare: round(count / (freq_2021[nom_gare] / 1000000)) for nom_gare, count in counts.items()}
+            cube = self.df_station_year[(self.df_station_year['year'] == '2021') & (self.df_station_year['type_objet'] == type_object)]
+            self.assertEqual(dict(zip(cube['nom_gare'], cube['lost_pour_million'])), expected)
+
+            fig = paris_map('2021', type_object, self.df_station_year)
+            self.assertEqual(sorted(fig.data[0].hovertext), sorted(expected))
+
+    def test_station_year_cube_closest_frequentation(self):
+        # Without 2020, the closest years are 2019 and 2021: the later one is used
+        cube = self.df_station_year.set_index(['year', 'type_objet', 'nom_gare'])
+        self.assertEqual(cube.loc[('2020', queries.TOUS_LES_TYPES, 'Paris Est'), 'voyageurs'], 20000000)
+        with self.engine.begin() as conn:
+            conn.execute(Frequentation.__table__.delete().where(Frequentation.annee == '2020'))
+            cube = queries.station_year_cube(conn).set_index(['year', 'type_objet', 'nom_gare'])
+        self.assertEqual(cube.loc[('2020', queries.TOUS_LES_TYPES, 'Paris Est'), 'voyageurs'], 25000000)
+
+    def test_scatter_parity(self):
+        self.assertSameTraces(scatter_par_type(self.df_temp_type), scatter_par_type(self.df_raw, self.df_temp))
+        self.assertSameTraces(scatter_tous_types(self.df_temp_all), scatter_tous_types(self.df_raw, self.df_temp))
+
+    def test_boxplot_heatmap_parity(self):
+        self.assertSameTraces(boxplot(self.df_daily), boxplot(self.df_raw))
+        self.assertSameTraces(heatmap(self.df_daily_type), heatmap(self.df_raw))
+
+    def test_dashboard_data_compact_dtypes(self):
+        with self.engine.connect() as conn:
+            data = queries.dashboard_data(conn)
+        self.assertEqual(data["daily_type"]["date"].dtype, "datetime64[ns]")
+        for name, column in (("daily_type", "type_objet"), ("daily", "saison"), ("station_year", "year"), ("station_year", "nom_gare")):
+            self.assertIsInstance(data[name][column].dtype, pd.CategoricalDtype)
+        self.assertLess(data_mb(data), data_mb({"daily_type": self.df_daily_type, "daily": self.df_daily, "station_year": self.df_station_year,
+                                                "temp_type": self.df_temp_type, "temp_all": self.df_temp_all, "gare": self.df_gare}))
+        self.assertSameTraces(histogramme(data["daily_type"]), histogramme(self.df_daily_type))
+        self.assertSameTraces(paris_map('2021', 'SAC', data["station_year"]), paris_map('2021', 'SAC', self.df_station_year))
+        self.assertSameTraces(scatter_par_type(data["temp_type"]), scatter_par_type(self.df_temp_type))
+        self.assertSameTraces(boxplot(data["daily"]), boxplot(self.df_daily))
+        self.assertSameTraces(heatmap(data["daily_type"]), heatmap(self.df_daily_type))
+        self.assertSameTraces(delais_restitution(data["restitution"], "saison"), delais_restitution(self.df_restitution, "saison"))
+
+    def test_read_compact_chunks(self):
+        with self.engine.connect() as conn:
+            df = queries.daily_counts_by_type(conn, typed=True)
+            chunked = queries.read_compact(select(LostItemDaily.date, LostItemDaily.type_objet, LostItemDaily.saison, LostItemDaily.count)
+                                           .order_by(LostItemDaily.type_objet.desc()), conn, chunksize=7)
+        self.assertEqual(list(chunked["type_objet"].cat.categories), ['CLE', 'SAC', 'TELEPHONE'])
+        self.assertEqual(chunked["count"].sum(), df["count"].sum())
+        self.assertEqual(list(df["date"].dt.strftime("%Y-%m-%d")), list(self.df_daily_type["date"]))
+
+    def test_restitution_counts(self):
+        raw = self.df_raw.assign(delai=delais(self.df_raw['date'], self.df_raw['date_restitution']))
+        raw['tranche'] = tranches(raw['delai'])
+        for by in RESTITUTION_AXES:
+            keys = raw['nom_gare'] if by == 'nom_gare' else raw['type_objet'] if by == 'type_objet' else saisons(raw['date']).astype(str)
+            expected = raw.groupby(keys).agg(count=('date', 'size'), restitues=('delai', 'count'), delai=('delai', 'sum'))
+            fig = taux_restitution(self.df_restitution, by)
+            taux = dict(zip(fig.data[0].x, fig.data[0].y))
+            self.assertEqual(taux, {key: round(100 * row['restitues'] / row['count'], 1) for key, row in expected.iterrows()})
+
+            fig = delais_restitution(self.df_restitution, by)
+            self.assertEqual([trace.name for trace in fig.data], TRANCHES)
+            for code, trace in enumerate(fig.data):
+                parts = dict(zip(trace.y, trace.x))
+                for key, row in expected.iterrows():
+                    in_tranche = ((keys == key) & (raw['tranche'] == code)).sum()
+                    self.assertAlmostEqual(parts[key], round(100 * in_tranche / row['restitues'], 1))
+
+        self.assertEqual(self.df_restitution['count'].sum(), len(self.df_raw))
+        self.assertEqual(self.df_restitution['delai_jours'].sum(), raw['delai'].sum())
+
+    @unittest.skipIf(snapshot.pa is None, "pyarrow is not installed")
+    def test_snapshot_parity(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "db.sqlite")
+            version = snapshot.publish(self.engine, path)
+            self.assertIsNone(snapshot.load(path, (version[0] + 1,) + version[1:]))
+            data = snapshot.load(path, version)
+
+        self.assertEqual(data["types"], self.types)
+        self.assertIsInstance(data["daily_type"]["type_objet"].dtype, pd.CategoricalDtype)
+        self.assertSameTraces(histogramme(data["daily_type"]), histogramme(self.df_daily_type))
+        for type_object in [queries.TOUS_LES_TYPES, 'SAC']:
+            self.assertSameTraces(paris_map('2021', type_object, data["station_year"]), paris_map('2021', type_object, self.df_station_year))
+        self.assertSameTraces(scatter_par_type(data["temp_type"]), scatter_par_type(self.df_temp_type))
+        self.assertSameTraces(scatter_tous_types(data["temp_all"]), scatter_tous_types(self.df_temp_all))
+        self.assertSameTraces(boxplot(data["daily"]), boxplot(self.df_daily))
+        self.assertSameTraces(heatmap(data["daily_type"]), heatmap(self.df_daily_type))
+        self.assertSameTraces(delais_restitution(data["restitution"], "saison"), delais_restitution(self.df_restitution, "saison"))
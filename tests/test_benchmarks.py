@@ -0,0 +1,47 @@
+# add files to python path
+import sys
+import os
+import inspect    
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir) 
+
+import unittest
+from unittest.mock import patch
+import pandas as pd
+from sqlalchemy import create_engine, select
+from db.model import LostItem
+from benchmarks.synthetic import generate
+from benchmarks.run import compare
+from benchmarks.startup import app_imports, loaded_lazy_modules
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_generate_is_deterministic(self):
+        frames = []
+        for _ in range(2):
+            engine = create_engine('sqlite:///:memory:')
+            generate(engine, 1000, n_years=2, n_stations=3, n_types=4)
+            with engine.connect() as conn:
+                frames.append(pd.read_sql(select(LostItem).order_by(LostItem.id), conn))
+        self.assertEqual(len(frames[0]), 1000)
+        self.assertEqual(frames[0]['nom_gare'].nunique(), 3)
+        pd.testing.assert_frame_equal(frames[0], frames[1])
+
+    def test_compare(self):
+        baseline = {"1000": {"load": {"seconds": 1.0, "peak_mb": 10.0}}}
+        self.assertEqual(compare({"1000": {"load": {"seconds": 1.4, "peak_mb": 12.0}}}, baseline, 0.5), [])
+        regressions = compare({"1000": {"load": {"seconds": 2.0, "peak_mb": 10.0}}}, baseline, 0.5)
+        self.assertEqual(len(regressions), 1)
+        self.assertIn("load seconds", regressions[0])
+
+    def test_compare_payload_limit(self):
+        results = {"1000": {"histogramme": {"seconds": 0.1, "peak_mb": 1.0, "payload_kb": 5000.0}}}
+        with patch("benchmarks.run.MAX_FIGURE_KB", 1024):
+            self.assertEqual(len(compare(results, {}, 1.0)), 1)
+
+    def test_dashboard_does_not_import_ingestion_stack(self):
+        imports = app_imports()
+        self.assertIn("import streamlit as st", imports)
+        self.assertEqual(loaded_lazy_modules(imports), [])
@@ -6,12 +6,22 @@ currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentfram
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0, parentdir) 
 
+import json
+import sqlite3
+import tempfile
+import threading
 import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest.mock import MagicMock, patch
-from sqlalchemy import create_engine
+from urllib.parse import quote, urlparse, parse_qs
+from sqlalchemy import create_engine, func, select
 from sqlalchemy.orm import sessionmaker
-from db.model import LostItem, create_tables
-from db.import_classes import LostItemImporter
+from db.model import Frequentation, Gare, ImportState, LostItem, LostItemDaily, SCHEMA_VERSION, Temperature, TypeObjet, create_tables
+from db.migrate import upgrade
+from db.engine import create_db_engine
+from db.http_cache import CacheMiss, ResponseCache
+from db import catalogue, metrics, orchestrator, shadow, worker
+from db.import_classes import GareImporter, LostItemImporter, TemperatureImporter, parse_date
 from datetime import datetime
 
 
@@ -50,6 +60,16 @@ class TestLostItemImporter(unittest.TestCase):
         self.assertEqual(start_parse.date(), datetime(2022, 1, 1).date())
         self.assertEqual(end_parse.date(), datetime(2022, 12, 31).date())
 
+    def test_parse_date_fast_path(self):
+        self.assertEqual(parse_date("2021-03-01 06:00:00"), datetime(2021, 3, 1, 6))
+        self.assertEqual(parse_date("2021-03-01T06:00:00+00:00").utcoffset().total_seconds(), 0)
+        self.assertEqual(parse_date("NOW").date(), datetime.now().date())
+        with patch("dateparser.parse") as dateparser_parse:
+            parse_date("2022-01-31")
+            dateparser_parse.assert_not_called()
+            parse_date("31 december 2022")
+            dateparser_parse.assert_called_once_with("31 december 2022")
+
     def test__parse_date_now(self):
         start_date = "2022-01-01"
         end_date = "now"
@@ -102,4 +122,719 @@ class TestLostItemImporter(unittest.TestCase):
         my_request = MagicMock()
         my_request.json.return_value = data
         self.importer._insert(my_request)
-        self.assertEqual(self.session.query(LostItem).count(), 1)
\ No newline at end of file
+        self.assertEqual(self.session.query(LostItem).count(), 1)
+
+    def test__insert_chunked(self):
+        records = [{'fields': {'date': f'2022-01-{day:02d}T10:00:00+01:00', 'gc_obo_type_c': 'SAC', 'gc_obo_gare_origine_r_name': 'Paris Est'}} for day in range(1, 26)]
+        importer = LostItemImporter(self.engine, chunk_size=10)
+        inserted = importer._insert_records(records)
+        self.assertEqual(inserted, 25)
+        self.assertEqual(self.session.query(LostItem).count(), 25)
+        item = self.session.query(LostItem).filter(LostItem.date == '2022-01-25').one()
+        self.assertEqual(item.nom_gare, 'Paris Est')
+        self.assertIsNone(item.date_restitution)
+
+
+    def test__split_window(self):
+        months = self.importer._split_window("2022-01-15", "2022-12-31")
+        self.assertEqual(len(months), 12)
+        self.assertEqual(months[0], ("2022-01-15", "2022-01-31"))
+        self.assertEqual(months[1], ("2022-02-01", "2022-02-28"))
+        self.assertEqual(months[-1], ("2022-12-01", "2022-12-31"))
+
+        weeks = self.importer._split_window("2022-02-01", "2022-02-28")
+        self.assertEqual(weeks, [("2022-02-01", "2022-02-07"), ("2022-02-08", "2022-02-14"), ("2022-02-15", "2022-02-21"), ("2022-02-22", "2022-02-28")])
+
+        days = self.importer._split_window("2022-02-01", "2022-02-03")
+        self.assertEqual(days, [("2022-02-01", "2022-02-01"), ("2022-02-02", "2022-02-02"), ("2022-02-03", "2022-02-03")])
+        self.assertEqual(self.importer._split_window("2022-02-01", "2022-02-01"), [])
+
+    def test__import_windows_splits_truncated(self):
+        def fake_fetch(endpoint, closed=False, cache_key=None):
+            year_window = "2022-01-01+TO+2022-12-31" in endpoint
+            start = endpoint.split("%5B")[1][:10]
+            record = {'fields': {'date': start, 'gc_obo_type_c': 'SAC', 'gc_obo_gare_origine_r_name': 'Paris Est'}}
+            response = MagicMock()
+            response.json.return_value = {'nhits': 12 if year_window else 1, 'records': [record]}
+            return response
+
+        self.importer._fetch = MagicMock(side_effect=fake_fetch)
+        self.importer._import_windows([("Paris Est", "2022-01-01", "2022-12-31")])
+
+        # 1 truncated yearly request, then 12 monthly requests that fit
+        self.assertEqual(self.importer._fetch.call_count, 13)
+        self.assertEqual(self.session.query(LostItem).count(), 12)
+        self.assertEqual(self.importer._get_watermark(("Paris Est",)), "2022-12-31")
+
+    def test__store_window_replaces_rows(self):
+        record = {'fields': {'date': '2022-01-03', 'gc_obo_type_c': 'SAC', 'gc_obo_gare_origine_r_name': 'Paris Est'}}
+        self.importer._store_window(("Paris Est", "2022-01-01", "2022-01-05"), [record])
+        self.importer._store_window(("Paris Est", "2022-01-01", "2022-01-05"), [record, record])
+        self.assertEqual(self.session.query(LostItem).count(), 2)
+        self.assertEqual(self.importer._get_watermark(("Paris Est",)), "2022-01-05")
+
+    def test_rollup_follows_inserts_and_window_replacement(self):
+        sac = {'fields': {'date': '2022-01-03', 'gc_obo_type_c': 'SAC', 'gc_obo_gare_origine_r_name': 'Paris Est'}}
+        cle = {'fields': {'date': '2022-01-03', 'gc_obo_type_c': 'CLE', 'gc_obo_gare_origine_r_name': 'Paris Est'}}
+        self.importer._insert_records([sac, sac, cle])
+        self.importer._insert_records([sac])
+        counts = {row.type_objet: row.count for row in self.session.query(LostItemDaily)}
+        self.assertEqual(counts, {'SAC': 3, 'CLE': 1})
+
+        self.importer._store_window(("Paris Est", "2022-01-01", "2022-01-05"), [cle])
+        self.session.expire_all()
+        counts = {row.type_objet: row.count for row in self.session.query(LostItemDaily)}
+        self.assertEqual(counts, {'CLE': 1})
+
+        self.importer.rebuild_rollups()
+        self.session.expire_all()
+        self.assertEqual([(row.date, row.type_objet, row.saison, row.count) for row in self.session.query(LostItemDaily)], [('2022-01-03', 'CLE', 'Hiver', 1)])
+
+    def test_rollup_restitutions_match_rebuild(self):
+        def record(date, type_objet, restitution):
+            return {'fields': {'date': date, 'gc_obo_type_c': type_objet, 'gc_obo_gare_origine_r_name': 'Paris Est', 'gc_obo_date_heure_restitution_c': restitution}}
+
+        self.importer._insert_records([
+            record('2022-01-03T10:00:00+01:00', 'SAC', '2022-01-03T18:00:00+01:00'),
+            record('2022-01-03T10:00:00+01:00', 'SAC', '2022-01-08T09:00:00+01:00'),
+            record('2022-01-03T10:00:00+01:00', 'SAC', None),
+            record('2022-01-04T00:30:00+01:00', 'CLE', '2022-01-04T00:45:00+01:00'),
+        ])
+        self.importer._insert_records([record('2022-01-03T10:00:00+01:00', 'SAC', '2022-03-01T12:00:00+01:00')])
+        columns = ['type_objet', 'count', 'restitues', 'delai_jours', 'delai_0', 'delai_1_7', 'delai_8_30', 'delai_31']
+
+        def rollup():
+            self.session.expire_all()
+            return sorted(tuple(getattr(row, column) for column in columns) for row in self.session.query(LostItemDaily))
+
+        # Returned the same day, after 5 days, not returned, returned the same day (-1 day in UTC), after 57 days
+        expected = [('CLE', 1, 1, 0, 1, 0, 0, 0), ('SAC', 4, 3, 62, 1, 1, 0, 1)]
+        self.assertEqual(rollup(), expected)
+        self.importer.rebuild_rollups()
+        self.assertEqual(rollup(), expected)
+
+    def test_resume_skips_checkpointed_windows(self):
+        self.importer._save_checkpoint(("Paris Est",), "2021-03-01")
+        self.importer._save_checkpoint(("Paris Bercy",), "2023-01-01")
+        self.importer.session.commit()
+        self.importer.station_list = ["Paris Est", "Paris Bercy", "Paris Nord"]
+        self.importer._import_windows = MagicMock()
+        self.importer.resume("2020-01-01", "2022-12-31")
+
+        windows = self.importer._import_windows.call_args[0][0]
+        self.assertEqual([w for w in windows if w[0] == "Paris Est"], [("Paris Est", "2021-03-01", "2021-12-31"), ("Paris Est", "2022-01-01", "2022-12-31")])
+        self.assertEqual([w for w in windows if w[0] == "Paris Bercy"], [])
+        self.assertEqual(len([w for w in windows if w[0] == "Paris Nord"]), 3)
+
+    def test_update_uses_watermark_per_station(self):
+        self.importer._save_checkpoint(("Paris Est",), "2022-06-01")
+        self.importer.session.commit()
+        self.importer.station_list = ["Paris Est", "Paris Bercy"]
+        self.importer._get_last_date = MagicMock(return_value="2023-02-01")
+        self.importer._import_windows = MagicMock()
+        self.importer.update()
+
+        windows = self.importer._import_windows.call_args[0][0]
+        self.assertEqual(windows[0], ("Paris Est", "2022-06-01", "2022-12-31"))
+        self.assertEqual([w for w in windows if w[0] == "Paris Bercy"][0][1], "2023-02-01")
+
+    def test_update_starts_at_month_of_watermark(self):
+        self.importer._save_checkpoint(("Paris Est",), "2022-06-17")
+        self.importer.session.commit()
+        self.importer.station_list = ["Paris Est"]
+        self.importer._import_windows = MagicMock()
+        self.importer.update()
+        self.assertEqual(self.importer._import_windows.call_args[0][0][0], ("Paris Est", "2022-06-01", "2022-12-31"))
+
+
+class TestTemperatureImporter(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite:///:memory:')
+        create_tables(self.engine)
+        self.importer = TemperatureImporter(self.engine)
+
+    @staticmethod
+    def observations(day, hours, offset="+00:00"):
+        return [{'fields': {'date': f'{day}T{hour:02d}:00:00{offset}', 'tc': float(hour)}} for hour in hours]
+
+    def test_daily_statistics(self):
+        self.importer._store_window(("2022-01-03", "2022-01-03"), self.observations("2022-01-03", [0, 3, 6, 21]))
+        day = self.importer.session.get(Temperature, "2022-01-03")
+        self.assertEqual((day.temp_sum, day.temp_count, day.temp_min, day.temp_max), (30.0, 4, 0.0, 21.0))
+        self.assertEqual(day.temperature, 7.5)
+
+    def test_days_are_utc(self):
+        self.importer._insert_records(self.observations("2022-01-04", [0], offset="+01:00"))
+        self.assertEqual(self.importer.session.get(Temperature, "2022-01-03").temp_count, 1)
+
+    def test_update_merges_partial_day(self):
+        # A first run stops in the middle of the day, the update fetches the whole day again
+        self.importer._store_window(("2022-01-03", "2022-01-03"), self.observations("2022-01-03", [0, 3, 6]))
+        self.assertEqual(self.importer._get_watermark(()), "2022-01-03 06:00:00")
+        self.importer._store_window(("2022-01-03", "2022-01-04"), self.observations("2022-01-03", range(0, 24, 3)) + self.observations("2022-01-04", [0]))
+
+        day = self.importer.session.get(Temperature, "2022-01-03")
+        self.assertEqual((day.temp_sum, day.temp_count, day.temp_min, day.temp_max), (84.0, 8, 0.0, 21.0))
+        self.assertEqual(day.temperature, 10.5)
+        self.assertEqual(self.importer.session.get(Temperature, "2022-01-04").temp_count, 1)
+        self.assertEqual(self.importer._get_watermark(()), "2022-01-04 00:00:00")
+
+    def test_missing_temperature(self):
+        records = self.observations("2022-01-03", [3]) + [{'fields': {'date': '2022-01-03T06:00:00+00:00'}}]
+        self.importer._insert_records(records)
+        self.importer._insert_records([{'fields': {'date': '2022-01-05T06:00:00+00:00'}}])
+        day = self.importer.session.get(Temperature, "2022-01-03")
+        self.assertEqual((day.temp_sum, day.temp_count, day.temperature), (3.0, 1, 3.0))
+        empty = self.importer.session.get(Temperature, "2022-01-05")
+        self.assertEqual((empty.temp_count, empty.temperature, empty.temp_min), (0, None, None))
+
+
+class TestCatalogue(unittest.TestCase):
+
+    def test_default_catalogue(self):
+        station_list, alias = catalogue.load(catalogue.DEFAULT_PATH)
+        self.assertEqual(len(station_list), 7)
+        self.assertEqual(alias["Paris Bercy"], "Paris Bercy Bourgogne - Pays d'Auvergne")
+
+    def test_whole_network(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "stations.json")
+            with open(path, "w") as f:
+                json.dump({"stations": "*"}, f)
+            with patch.dict(os.environ, {catalogue.ENV_VAR: path}):
+                self.assertEqual(catalogue.load(), (["*"], {}))
+                self.assertEqual(LostItemImporter(create_engine('sqlite:///:memory:')).station_list, ["*"])
+        self.assertEqual(catalogue.restrict(["*"], ["Paris Est"]), ["Paris Est"])
+        self.assertEqual(catalogue.restrict(["Paris Est", "Paris Bercy"], ["Paris Bercy", "Lyon"]), ["Paris Bercy"])
+
+    def test_network_windows(self):
+        engine = create_engine('sqlite:///:memory:')
+        create_tables(engine)
+        importer = LostItemImporter(engine)
+        self.assertNotIn("refine.gc_obo_gare_origine_r_name", importer._create_endpoint("*", "2022-01-01", "2022-01-31"))
+        self.assertEqual(len(importer._date_windows(("*",), "2021-01-01", "2022-12-31")), 24)
+        self.assertEqual(importer._date_windows(("*",), "2022-12-20", "2022-12-31"), [("2022-12-20", "2022-12-31")])
+        self.assertEqual(len(importer._date_windows(("Paris Est",), "2021-01-01", "2022-12-31")), 2)
+
+        records = [{'fields': {'date': '2022-01-03', 'gc_obo_type_c': 'SAC', 'gc_obo_gare_origine_r_name': station}} for station in ("Paris Est", "Lyon Part Dieu")]
+        importer._insert_records(records)
+        importer._store_window(("*", "2022-01-01", "2022-01-31"), records[1:])
+        self.assertEqual([item.nom_gare for item in importer.session.query(LostItem)], ["Lyon Part Dieu"])
+        self.assertEqual(importer._get_watermark(("*",)), "2022-01-31")
+
+
+class TestGareImporter(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite:///:memory:')
+        create_tables(self.engine)
+        self.importer = GareImporter(self.engine)
+        self.importer.batch_size = 2
+        self.importer.station_list = ["Paris Est", "Paris Bercy", "Gare inconnue"]
+
+        def fake_fetch(endpoint, closed=False):
+            response = MagicMock()
+            if "facet=" in endpoint:
+                response.json.return_value = {"facet_groups": [{"name": "gc_obo_gare_origine_r_name", "facets": [{"name": "Paris Est"}, {"name": "Lyon Part Dieu"}]}]}
+                return response
+            geo = "referentiel-gares-voyageurs" in endpoint
+            field = "gare_alias_libelle_noncontraint" if geo else "nom_gare"
+            known = {"Paris Est": 1, "Paris Bercy Bourgogne - Pays d'Auvergne": 2, "Lyon Part Dieu": 3}
+            names = [name for name in known if quote(f'"{name}"') in endpoint]
+            # The full-text query also matches longer names
+            names = ["Paris Est Marne" for name in names if name == "Paris Est"] + names
+            fields = [{field: name, "latitude_entreeprincipale_wgs84": 47.0 + known.get(name, 9), "total_voyageurs_2022": 100 * known.get(name, 9)} for name in names]
+            response.json.return_value = {"records": [{"fields": f} for f in fields]}
+            return response
+
+        self.importer._fetch = MagicMock(side_effect=fake_fetch)
+
+    def test_batched_lookups(self):
+        self.importer.import_data()
+        # 2 batches of stations, each resolved with one request per dataset
+        self.assertEqual(self.importer._fetch.call_count, 4)
+        session = self.importer.session
+        self.assertEqual(session.get(Gare, "Paris Est").latitude, 48.0)
+        self.assertEqual(session.get(Gare, "Paris Bercy").latitude, 49.0)
+        self.assertIsNone(session.get(Gare, "Gare inconnue").latitude)
+        self.assertEqual({(row.nom_gare, row.voyageurs) for row in session.query(Frequentation)}, {("Paris Est", 100), ("Paris Bercy", 200)})
+
+    def test_discovered_stations(self):
+        self.importer.station_list = ["*"]
+        self.importer.import_data()
+        self.assertEqual(sorted(self.importer.session.scalars(select(Gare.nom_gare))), ["Lyon Part Dieu", "Paris Est"])
+        self.assertEqual(self.importer._fetch.call_count, 3)
+
+        self.importer.resume()
+        self.assertEqual(self.importer._fetch.call_count, 4)
+
+    def test_frequentation_every_year(self):
+        fields = {
+            "nom_gare": "Paris Est",
+            "total_voyageurs_2019": 100, "total_voyageurs_non_voyageurs_2019": 10,
+            "total_voyageurs_2022": 200, "total_voyageurs_non_voyageurs_2022": 20,
+            "total_voyageurs_2023": 300,
+        }
+        self.assertEqual(GareImporter._frequentation(fields), {"2019": 110, "2022": 220, "2023": 300})
+
+
+class StubApiHandler(BaseHTTPRequestHandler):
+    """Answers like the records API: one record per request, a 503 on the first hit of each URL."""
+
+    seen = set()
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with self.lock:
+            first_hit = self.path not in self.seen
+            self.seen.add(self.path)
+        if first_hit:
+            self.send_response(503)
+            self.end_headers()
+            return
+        query = parse_qs(urlparse(self.path).query)
+        station = query["refine.gc_obo_gare_origine_r_name"][0]
+        start = query["q"][0].split("[")[1][:10]
+        body = json.dumps({"records": [{"fields": {"date": start, "gc_obo_type_c": "SAC", "gc_obo_gare_origine_r_name": station}}]}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestFetchPipeline(unittest.TestCase):
+
+    def setUp(self):
+        StubApiHandler.seen = set()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubApiHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.engine = create_engine('sqlite:///:memory:')
+        create_tables(self.engine)
+        self.importer = LostItemImporter(self.engine, max_workers=3)
+        self.importer.retry_backoff = 0
+        self.importer.http = self.importer._create_http_session()
+        self.importer.api_url = f"http://127.0.0.1:{self.server.server_port}/"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_import_data_concurrent_with_retry(self):
+        self.importer.import_data("2020-01-01", "2022-06-30")
+        # 7 stations x 3 years, each answered after one retried 503
+        self.assertEqual(len(StubApiHandler.seen), 21)
+        self.assertEqual(self.importer.session.query(LostItem).count(), 21)
+
+    def test__fetch_pipeline_keeps_job_order(self):
+        jobs = [(i, self.importer._create_endpoint("Paris Est", f"{2000 + i}-01-01", f"{2000 + i}-12-31")) for i in range(10)]
+        keys = [key for key, _ in self.importer._fetch_pipeline(jobs)]
+        self.assertEqual(keys, list(range(10)))
+
+    def test_import_progress(self):
+        reports = []
+        self.importer.station_list = ["Paris Est", "Paris Bercy"]
+        self.importer.progress = lambda table, key, done, total: reports.append((table, key, done, total))
+        self.importer.import_data("2021-01-01", "2022-06-30")
+        self.assertEqual(reports[:2], [("LostItem", ("Paris Est",), 0, 2), ("LostItem", ("Paris Bercy",), 0, 2)])
+        self.assertEqual(sorted(reports[2:]), [("LostItem", (station,), done, 2) for station in ("Paris Bercy", "Paris Est") for done in (1, 2)])
+
+    def test_import_metrics(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "metrics.jsonl")
+            metrics.configure(path)
+            self.importer.station_list = ["Paris Est"]
+            try:
+                self.importer.import_data("2022-01-01", "2022-06-30")
+            finally:
+                metrics.configure(None)
+            with open(path) as f:
+                events = [json.loads(line) for line in f]
+        stages = [event["stage"] for event in events]
+        self.assertEqual(stages, ["requete", "lecture", "stockage"])
+        self.assertEqual(events[0]["cache"], "miss")
+        self.assertEqual(events[1]["records"], 1)
+        self.assertEqual(events[2]["rows"], 1)
+        self.assertIn("commit_seconds", events[2])
+
+
+class TestMetrics(unittest.TestCase):
+
+    def tearDown(self):
+        metrics.configure(None)
+
+    def test_disabled(self):
+        metrics.configure(None)
+        with metrics.timer("stockage") as measure:
+            measure["rows"] = 1
+            metrics.annotate(rows=2)
+        self.assertFalse(metrics.enabled())
+        self.assertFalse(any(event.get("rows") == 2 for event in metrics.recent()))
+
+    def test_annotate_innermost_timer(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "metrics.jsonl")
+            metrics.configure(path)
+            with metrics.timer("stockage", window="a") as outer:
+                with metrics.timer("requete"):
+                    metrics.annotate(status=200)
+                metrics.annotate(rows=3)
+            with self.assertRaises(ValueError):
+                with metrics.timer("lecture"):
+                    raise ValueError
+            with open(path) as f:
+                events = [json.loads(line) for line in f]
+        self.assertEqual([event["stage"] for event in events], ["requete", "stockage", "lecture"])
+        self.assertEqual(events[0]["status"], 200)
+        self.assertEqual((events[1]["window"], events[1]["rows"]), ("a", 3))
+        self.assertNotIn("status", outer)
+        self.assertEqual(events[2]["error"], "ValueError")
+        self.assertEqual(metrics.recent()[-3:], events)
+
+
+
+class TestUpdateWorker(unittest.TestCase):
+
+    def test_single_flight(self):
+        gate, calls, cleared = threading.Event(), [], []
+
+        def update(progress):
+            calls.append(1)
+            progress("LostItem", ("Paris Est",), 1, 3)
+            gate.wait(5)
+
+        job, started = worker.start(update, version_before=(1, 2), on_success=lambda: cleared.append(1))
+        self.assertTrue(started)
+        again, started_again = worker.start(update)
+        self.assertFalse(started_again)
+        self.assertEqual(again["id"], job["id"])
+        self.assertEqual(again["version_before"], (1, 2))
+        self.assertEqual(cleared, [])
+
+        gate.set()
+        status = worker.wait(5)
+        self.assertEqual((status["state"], status["progress"]), (worker.DONE, {"LostItem, Paris Est": [1, 3]}))
+        self.assertEqual((calls, cleared), ([1], [1]))
+
+    def test_failure(self):
+        def update(progress):
+            raise RuntimeError("API indisponible")
+
+        cleared = []
+        worker.start(update, on_success=lambda: cleared.append(1))
+        status = worker.wait(5)
+        self.assertEqual((status["state"], status["error"]), (worker.FAILED, "RuntimeError: API indisponible"))
+        self.assertEqual(cleared, [])
+        self.assertTrue(worker.start(lambda progress: None)[1])
+        worker.wait(5)
+
+
+class TestMigrate(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "db.sqlite")
+        # Schema written by the first version of db/model.py
+        conn = sqlite3.connect(self.path)
+        conn.executescript("""
+            CREATE TABLE "Gare" (nom_gare VARCHAR(30) PRIMARY KEY, longitude FLOAT, latitude FLOAT, freq_2019 INTEGER, freq_2020 INTEGER, freq_2021 INTEGER);
+            CREATE TABLE "Temperature" (date VARCHAR(30) PRIMARY KEY, temperature FLOAT);
+            CREATE TABLE "LostItem" (id INTEGER PRIMARY KEY, date VARCHAR NOT NULL REFERENCES "Temperature"(date), type_objet VARCHAR(30) NOT NULL,
+                nom_gare VARCHAR NOT NULL REFERENCES "Gare"(nom_gare), date_restitution VARCHAR(30));
+            INSERT INTO "LostItem" VALUES (1, '2022-01-03', 'SAC', 'Paris Est', '2022-01-05T17:44:44+01:00');
+            INSERT INTO "LostItem" VALUES (2, '2022-01-03', 'SAC', 'Paris Est', NULL);
+            INSERT INTO "LostItem" VALUES (3, '2022-07-01', 'CLE', 'Paris Est', NULL);
+            INSERT INTO "Gare" VALUES ('Paris Est', 2.35, 48.87, 30000000, NULL, 25000000);
+        """)
+        conn.close()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_upgrade(self):
+        self.assertEqual(upgrade(self.path), SCHEMA_VERSION)
+        engine = create_engine(f"sqlite:///{self.path}")
+        session = sessionmaker(bind=engine)()
+
+        self.assertEqual(sorted(t.libelle for t in session.query(TypeObjet)), ['CLE', 'SAC'])
+        item = session.get(LostItem, 1)
+        self.assertEqual(item.type_objet, 'SAC')
+        self.assertEqual(item.date_restitution, '2022-01-05 16:44:44')
+        daily = {(row.date, row.type_objet): (row.saison, row.count, row.restitues, row.delai_1_7) for row in session.query(LostItemDaily)}
+        self.assertEqual(daily, {('2022-01-03', 'SAC'): ('Hiver', 2, 1, 1), ('2022-07-01', 'CLE'): ('Été', 1, 0, 0)})
+        self.assertEqual({(row.annee, row.voyageurs) for row in session.query(Frequentation)}, {('2019', 30000000), ('2021', 25000000)})
+        self.assertEqual(session.get(Gare, 'Paris Est').latitude, 48.87)
+        with engine.connect() as conn:
+            indexes = {row[0] for row in conn.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'index'")}
+            self.assertIn("ix_LostItem_nom_gare_date", indexes)
+            self.assertIn("ix_LostItemDaily_type_objet_date", indexes)
+        engine.dispose()
+
+        # Running it again is a no-op
+        self.assertEqual(upgrade(self.path), SCHEMA_VERSION)
+
+    def test_upgraded_database_accepts_imports(self):
+        upgrade(self.path)
+        importer = LostItemImporter(create_engine(f"sqlite:///{self.path}"))
+        importer._insert_records([{'fields': {'date': '2022-01-03', 'gc_obo_type_c': 'SAC', 'gc_obo_gare_origine_r_name': 'Paris Est'}}])
+        self.assertEqual(importer.session.query(LostItem).count(), 4)
+        self.assertEqual(importer.session.get(LostItemDaily, ('2022-01-03', 'SAC', 'Paris Est')).count, 3)
+
+    def test_upgrade_temperature(self):
+        conn = sqlite3.connect(self.path)
+        conn.executescript("""
+            INSERT INTO "Temperature" VALUES ('2022-01-02', 4.5);
+            INSERT INTO "Temperature" VALUES ('2022-01-03', 6.0);
+            CREATE TABLE "ImportState" (source VARCHAR(30) NOT NULL, station VARCHAR(60) NOT NULL, last_date VARCHAR(30) NOT NULL, PRIMARY KEY (source, station));
+            INSERT INTO "ImportState" VALUES ('Temperature', '', '2022-01-03');
+        """)
+        conn.close()
+        upgrade(self.path)
+        importer = TemperatureImporter(create_engine(f"sqlite:///{self.path}"))
+
+        day = importer.session.get(Temperature, "2022-01-02")
+        self.assertEqual((day.temperature, day.temp_sum, day.temp_count, day.temp_min), (4.5, 4.5, 1, 4.5))
+        # The last day may have been partial: it is emptied and fetched again by the next update
+        self.assertEqual(importer.session.get(Temperature, "2022-01-03").temp_count, 0)
+        self.assertEqual(importer._get_watermark(()), "2022-01-02 23:59:59")
+        importer._store_window(("2022-01-02", "2022-01-03"), TestTemperatureImporter.observations("2022-01-03", [0, 12]))
+        self.assertEqual(importer.session.get(Temperature, "2022-01-03").temperature, 6.0)
+        self.assertEqual(importer.session.get(Temperature, "2022-01-02").temp_count, 1)
+
+
+
+class TestEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.engine = create_db_engine(os.path.join(self.tmpdir.name, "db.sqlite"))
+        create_tables(self.engine)
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.tmpdir.cleanup()
+
+    def test_pragmas(self):
+        with self.engine.connect() as conn:
+            self.assertEqual(conn.exec_driver_sql("PRAGMA journal_mode").scalar(), "wal")
+            self.assertEqual(conn.exec_driver_sql("PRAGMA synchronous").scalar(), 1)  # NORMAL
+            self.assertEqual(conn.exec_driver_sql("PRAGMA temp_store").scalar(), 2)  # MEMORY
+
+    def test_reader_not_blocked_by_writer(self):
+        importer = LostItemImporter(self.engine)
+        importer._insert_records([{'fields': {'date': '2022-01-03', 'gc_obo_type_c': 'SAC', 'gc_obo_gare_origine_r_name': 'Paris Est'}}])
+        writer = LostItemImporter(self.engine)
+        writer._delete_window(("Paris Est", "2022-01-01", "2022-01-31"))  # uncommitted write transaction
+        with self.engine.connect() as reader:
+            self.assertEqual(reader.execute(select(func.count()).select_from(LostItem)).scalar(), 1)
+        writer.session.commit()
+        with self.engine.connect() as reader:
+            self.assertEqual(reader.execute(select(func.count()).select_from(LostItem)).scalar(), 0)
+
+
+
+class EtagApiHandler(BaseHTTPRequestHandler):
+    """Answers every URL with the same body and ETag, or 304 when the client already has it."""
+
+    hits = []
+
+    def do_GET(self):
+        self.hits.append((self.path, self.headers.get("If-None-Match")))
+        if self.headers.get("If-None-Match") == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = json.dumps({"nhits": 1, "records": [{"fields": {"date": "2020-03-01", "gc_obo_type_c": "SAC", "gc_obo_gare_origine_r_name": "Paris Est"}}]}).encode()
+        self.send_response(200)
+        self.send_header("ETag", '"v1"')
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        EtagApiHandler.hits = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), EtagApiHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/?q=test"
+        self.engine = create_engine('sqlite:///:memory:')
+        create_tables(self.engine)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmpdir.cleanup()
+
+    def importer(self, replay=False):
+        return LostItemImporter(self.engine, cache=ResponseCache(self.tmpdir.name, replay=replay))
+
+    def test_closed_window_served_from_cache(self):
+        first = self.importer()._fetch(self.url, closed=True)
+        second = self.importer()._fetch(self.url, closed=True)
+        self.assertEqual(first.json(), second.json())
+        self.assertEqual(len(EtagApiHandler.hits), 1)
+
+    def test_open_window_revalidated(self):
+        self.importer()._fetch(self.url)
+        response = self.importer()._fetch(self.url)
+        self.assertEqual(response.json()["nhits"], 1)
+        self.assertEqual(EtagApiHandler.hits[1][1], '"v1"')
+
+    def test_replay(self):
+        with self.assertRaises(CacheMiss):
+            self.importer(replay=True)._fetch(self.url)
+        self.importer()._fetch(self.url)
+        self.importer(replay=True)._fetch(self.url)
+        self.assertEqual(len(EtagApiHandler.hits), 1)
+
+    def test_import_replays_offline(self):
+        importer = self.importer()
+        importer.api_url = f"http://127.0.0.1:{self.server.server_port}/"
+        importer.station_list = ["Paris Est"]
+        importer.import_data("2020-01-01", "2020-12-31")
+
+        replay = self.importer(replay=True)
+        replay.api_url = importer.api_url
+        replay.station_list = ["Paris Est"]
+        replay.import_data("2020-01-01", "2020-12-31")
+        self.assertEqual(len(EtagApiHandler.hits), 1)
+        self.assertEqual(replay.session.query(LostItem).count(), 1)
+
+    def test_open_window_replayed_on_a_later_day(self):
+        # The open window of the year ends today: its URL changes every day, its cache entry does not
+        class Clock(datetime):
+            today = datetime(2026, 10, 18, 12)
+
+            @classmethod
+            def now(cls, tz=None):
+                return cls.today
+
+        with patch("db.import_classes.datetime", Clock):
+            importer = self.importer()
+            importer.api_url = f"http://127.0.0.1:{self.server.server_port}/"
+            importer.station_list = ["Paris Est"]
+            importer.import_data("2026-01-01", "now")
+
+            Clock.today = datetime(2026, 10, 25, 12)
+            engine = create_engine('sqlite:///:memory:')
+            create_tables(engine)
+            replay = LostItemImporter(engine, cache=ResponseCache(self.tmpdir.name, replay=True))
+            replay.api_url = importer.api_url
+            replay.station_list = ["Paris Est"]
+            replay.import_data("2026-01-01", "now")
+            self.assertEqual(len(EtagApiHandler.hits), 1)
+            self.assertEqual(replay.session.query(LostItem).count(), 1)
+
+            # Online, the entry is revalidated and replaced instead of adding one entry per day
+            importer.import_data("2026-01-01", "now")
+        self.assertEqual(EtagApiHandler.hits[-1], ("/?dataset=objets-trouves-restitution&q=date%3A%5B2026-01-01+TO+2026-10-25%5D&rows=10000&refine.gc_obo_gare_origine_r_name=Paris+Est", '"v1"'))
+        self.assertEqual(len([name for name in os.listdir(self.tmpdir.name) if name.endswith(".gz")]), 1)
+
+
+
+class TestOrchestrator(unittest.TestCase):
+
+    def setUp(self):
+        self.events = []
+        self.lock = threading.Lock()
+
+    def fake_run_source(self, fail=()):
+        def run_source(source, engine, since, until, resume, **options):
+            with self.lock:
+                self.events.append(("start", source))
+            if source in fail:
+                raise RuntimeError(source)
+            with self.lock:
+                self.events.append(("end", source))
+        return run_source
+
+    def test_lostitem_waits_for_its_dependencies(self):
+        with patch.object(orchestrator, "run_source", self.fake_run_source()):
+            status = orchestrator.run(None, list(orchestrator.SOURCES), "2020-01-01", "now", jobs=2)
+        self.assertEqual(status, {"gare": "ok", "temperature": "ok", "lostitem": "ok"})
+        start_lostitem = self.events.index(("start", "lostitem"))
+        self.assertLess(self.events.index(("end", "gare")), start_lostitem)
+        self.assertLess(self.events.index(("end", "temperature")), start_lostitem)
+
+    def test_failed_dependency_skips_dependents(self):
+        with patch.object(orchestrator, "run_source", self.fake_run_source(fail=("temperature",))):
+            status = orchestrator.run(None, list(orchestrator.SOURCES), "2020-01-01", "now")
+        self.assertEqual(status, {"gare": "ok", "temperature": "failed", "lostitem": "skipped"})
+
+    def test_unselected_dependencies_are_not_waited_for(self):
+        with patch.object(orchestrator, "run_source", self.fake_run_source()):
+            status = orchestrator.run(None, ["lostitem"], "2020-01-01", "now")
+        self.assertEqual(status, {"lostitem": "ok"})
+
+    def test_stations_only_replace_their_rows(self):
+        engine = create_engine('sqlite:///:memory:')
+        create_tables(engine)
+        importer = LostItemImporter(engine)
+        for station in ("Paris Austerlitz", "Paris Est"):
+            record = {'fields': {'date': '2022-01-03', 'gc_obo_type_c': 'SAC', 'gc_obo_gare_origine_r_name': station}}
+            importer._store_window((station, "2022-01-01", "2022-01-31"), [record] * 5)
+
+        with patch.object(LostItemImporter, "import_data") as import_data:
+            orchestrator.run_source("lostitem", engine, "2022-01-01", "2022-01-31", False, stations=["Paris Est"])
+        import_data.assert_called_once()
+        session = LostItemImporter(engine).session
+        self.assertEqual(session.query(LostItem.nom_gare, func.count()).group_by(LostItem.nom_gare).all(), [("Paris Austerlitz", 5)])
+        self.assertEqual([row.nom_gare for row in session.query(LostItemDaily)], ["Paris Austerlitz"])
+        self.assertEqual([state.station for state in session.query(ImportState)], ["Paris Austerlitz"])
+
+
+
+class TestShadowRebuild(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "db.sqlite")
+        self.live = create_db_engine(self.path)
+        create_tables(self.live)
+        self.record = {'fields': {'date': '2022-01-03', 'gc_obo_type_c': 'SAC', 'gc_obo_gare_origine_r_name': 'Paris Est'}}
+        LostItemImporter(self.live)._store_window(("Paris Est", "2022-01-01", "2022-01-31"), [self.record])
+
+    def tearDown(self):
+        self.live.dispose()
+        self.tmpdir.cleanup()
+
+    def count(self, conn):
+        return conn.execute(select(func.count()).select_from(LostItem)).scalar()
+
+    def test_swap_is_atomic_for_readers(self):
+        shadow_engine = create_db_engine(shadow.prepare(self.path))
+        LostItemImporter(shadow_engine)._store_window(("Paris Est", "2022-01-01", "2022-01-31"), [self.record] * 3)
+        shadow_engine.dispose()
+
+        with self.live.connect() as reader:
+            reader.exec_driver_sql("BEGIN")
+            self.assertEqual(self.count(reader), 1)
+            shadow.swap(self.path, orchestrator.TABLES["lostitem"])
+            # A read transaction started before the swap keeps the old snapshot
+            self.assertEqual(self.count(reader), 1)
+            reader.rollback()
+            self.assertEqual(self.count(reader), 3)
+            self.assertEqual(reader.execute(select(func.sum(LostItemDaily.count))).scalar(), 3)
+        self.assertFalse(os.path.exists(shadow.shadow_path(self.path)))
+
+    def test_failed_swap_leaves_live_data(self):
+        shadow_engine = create_db_engine(shadow.prepare(self.path))
+        with shadow_engine.begin() as conn:
+            conn.exec_driver_sql('DROP TABLE "LostItemDaily"')
+        shadow_engine.dispose()
+
+        with self.assertRaises(sqlite3.OperationalError):
+            shadow.swap(self.path, orchestrator.TABLES["lostitem"])
+        with self.live.connect() as conn:
+            self.assertEqual(self.count(conn), 1)
+            self.assertEqual(conn.execute(select(func.sum(LostItemDaily.count))).scalar(), 1)
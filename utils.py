@@ -1,30 +1,133 @@
+import functools
+import logging
+import os
+import time
+from typing import Callable
 import plotly.express as px
+import plotly.graph_objects as go
 import pandas as pd
-from db.import_classes import LostItemImporter, TemperatureImporter
-from sqlalchemy import create_engine
+from db.saisons import SAISONS, saisons
+from db.restitution import TRANCHES, TRANCHE_COLUMNS
+from db.engine import get_db_path, get_engine
+from db import metrics, queries, snapshot
+
+# Figures are sent to the browser as JSON: scatters keep at most SCATTER_MAX_POINTS markers and switch to
+# WebGL above WEBGL_MIN_POINTS, and a figure heavier than MAX_FIGURE_KB is reported.
+SCATTER_MAX_POINTS = 5000
+WEBGL_MIN_POINTS = 1000
+MAX_FIGURE_KB = int(os.environ.get("LOST_ITEMS_MAX_FIGURE_KB", 1024))
+
+# The ingestion stack (db.import_classes with requests, urllib3 and dateparser) is only imported when an
+# update is started, so the dashboard does not load it on every cold start.
 
 def get_importers() -> tuple:
-    engine = create_engine('sqlite:///db.sqlite')
+    from db.import_classes import LostItemImporter, TemperatureImporter
+    engine = get_engine()
     temperature_importer: TemperatureImporter = TemperatureImporter(engine)
     lostitem_importer: LostItemImporter = LostItemImporter(engine)
     return temperature_importer, lostitem_importer
     
 
 def last_update() -> tuple:
-    temperature_importer, lostitem_importer = get_importers()
-    return temperature_importer._get_last_date(), lostitem_importer._get_last_date()
+    with get_engine().connect() as conn:
+        return queries.last_dates(conn)
 
 
-def update() -> None:
+def update(progress: Callable = None) -> None:
+    # progress receives (table, key, windows stored, windows planned) from each importer, see db/worker.py
     temperature_importer, lostitem_importer = get_importers()
+    temperature_importer.progress = lostitem_importer.progress = progress
 
     temperature_importer.update()
     lostitem_importer.update()
-
-
-def histogramme(df: pd.DataFrame) -> px.histogram:
-    fig: px.histogram = px.histogram(df.groupby(['type_objet', 'date']).size().reset_index(name='count'), x="date", y="count", color="type_objet", histfunc="sum")
-    fig.update_traces(xbins_size=604800000) # on regroupe par semaine
+    snapshot.publish(get_engine(), get_db_path())
+
+
+def _count_by(df: pd.DataFrame, keys: list) -> pd.DataFrame:
+    # df is either raw LostItem rows or LostItemDaily rows, which already carry a count per (date, type, station).
+    # Keys may be categorical (db.snapshot frames): only the combinations present are kept.
+    if "count" in df.columns:
+        return df.groupby(keys, observed=True)["count"].sum().reset_index(name="count")
+    return df.groupby(keys, observed=True).size().reset_index(name="count")
+
+
+def _count_by_week(df: pd.DataFrame, keys: list) -> pd.DataFrame:
+    # Weeks start on Monday, like the /weekly endpoint of api.py
+    df_count = _count_by(df, ["date"] + keys)
+    dates = df_count["date"]
+    if not pd.api.types.is_datetime64_any_dtype(dates):
+        dates = pd.to_datetime(dates.astype(str))
+    df_count["week"] = (dates - pd.to_timedelta(dates.dt.weekday, unit="D")).dt.strftime("%Y-%m-%d")
+    return df_count.groupby(["week"] + keys, observed=True)["count"].sum().reset_index()
+
+
+def _downsample(df: pd.DataFrame, max_points: int, by: str = None) -> pd.DataFrame:
+    # A uniform random sample keeps the density of the cloud; sampling each group at the same rate keeps their sizes comparable
+    if len(df) <= max_points:
+        return df
+    if by is None:
+        return df.sample(n=max_points, random_state=0).sort_index()
+    return df.groupby(by, observed=True).sample(frac=max_points / len(df), random_state=0).sort_index()
+
+
+def _render_mode(df: pd.DataFrame) -> str:
+    return "webgl" if len(df) > WEBGL_MIN_POINTS else "svg"
+
+
+def data_mb(data: dict) -> float:
+    """
+    Returns the memory held by the frames of the dashboard data, strings included, in MB.
+    """
+    return sum(df.memory_usage(deep=True).sum() for df in data.values() if isinstance(df, pd.DataFrame)) / 2**20
+
+
+def figure_kb(fig: go.Figure) -> float:
+    """
+    Returns the size of the JSON a figure is sent to the browser as, in KB.
+    """
+    return len(fig.to_json().encode()) / 1024
+
+
+def check_figure_size(name: str, fig: go.Figure, max_kb: float = None) -> float:
+    """
+    Measures the payload of a figure and logs a warning when it exceeds the limit.
+
+    Args:
+        name (str): The name of the figure, for the log.
+        fig (go.Figure): The figure.
+        max_kb (float, optional): The limit in KB. Defaults to MAX_FIGURE_KB.
+
+    Returns:
+        float: The payload size in KB.
+    """
+    size = figure_kb(fig)
+    if size > (max_kb or MAX_FIGURE_KB):
+        logging.warning(f"FIGURE: {name} pèse {size:.0f} KB (limite {max_kb or MAX_FIGURE_KB} KB)")
+    return size
+
+
+def _instrumented(chart):
+    """
+    Records the time a chart takes to build, its input rows and its payload as a "figure" measure,
+    when the metrics are on (see db.metrics).
+    """
+    @functools.wraps(chart)
+    def build(*args, **kwargs):
+        if not metrics.enabled():
+            return chart(*args, **kwargs)
+        rows = sum(len(arg) for arg in list(args) + list(kwargs.values()) if isinstance(arg, pd.DataFrame))
+        start = time.perf_counter()
+        fig = chart(*args, **kwargs)
+        seconds = round(time.perf_counter() - start, 6)
+        metrics.record("figure", chart=chart.__name__, rows=rows, seconds=seconds, kb=round(figure_kb(fig), 1))
+        return fig
+    return build
+
+
+@_instrumented
+def histogramme(df: pd.DataFrame) -> px.bar:
+    # Weeks are counted here rather than by plotly in the browser, so the figure holds one bar per week and type
+    fig: px.bar = px.bar(_count_by_week(df, ['type_objet']), x="week", y="count", color="type_objet")
     fig.update_layout(width=1000)
     fig.update_layout(bargap=0.1)
     fig.update_xaxes(title="Date où l'objet a été trouvé")
@@ -32,67 +135,56 @@ def histogramme(df: pd.DataFrame) -> px.histogram:
     return fig
 
 
-def paris_map(year: str, type_object: str, df_lostitem: pd.DataFrame, df_gare: pd.DataFrame) -> px.scatter_mapbox:
-    # Extract year from date and add it to the DataFrame
-    df_lostitem['year'] = df_lostitem['date'].str[:4]
-
-    # Filter the DataFrame based on year and object type
-    if type_object == "Tous les types":
-        df_lostitem_group_year = df_lostitem.groupby(['year', 'nom_gare']).size().reset_index(name='count')
-        df_lostitem_filtered = df_lostitem_group_year[(df_lostitem_group_year['year'] == year)]
-    else:
-        df_lostitem_group_year_type = df_lostitem.groupby(['type_objet', 'year', 'nom_gare']).size().reset_index(name='count')
-        df_lostitem_filtered = df_lostitem_group_year_type[(df_lostitem_group_year_type['year'] == year) & (df_lostitem_group_year_type['type_objet'] == type_object)]
-
-    # Merge the two DataFrames
-    df = pd.merge(df_gare, df_lostitem_filtered, on='nom_gare', how='inner')
-
-    # Calculate the lost items per million people and round to the nearest integer
-    if year in ["2019", "2020", "2021"]:
-        year_freq = year
-    else:
-        year_freq = "2021"
-    df["lost_pour_million"] = df["count"] / (df[f'freq_{year_freq}'] / 1000000)
-    df["lost_pour_million"] = df["lost_pour_million"].apply(round)
+@_instrumented
+def paris_map(year: str, type_object: str, df_cube: pd.DataFrame) -> px.scatter_mapbox:
+    # df_cube comes from queries.station_year_cube: counts per million travellers are already computed,
+    # the map only selects the year and the type of object (TOUS_LES_TYPES for all of them)
+    df = df_cube[(df_cube['year'] == year) & (df_cube['type_objet'] == type_object)]
     df = df[["nom_gare", "longitude", "latitude", "lost_pour_million"]]
 
     # Create a scatter mapbox plot
     fig = px.scatter_mapbox(df, lat="latitude", lon="longitude", size="lost_pour_million", color="lost_pour_million", hover_name="nom_gare", center=dict(lat=48.8566, lon=2.3522), zoom=10, mapbox_style="carto-positron")
     return fig
 
-def scatter_par_type(df_lostitem: pd.DataFrame, df_temp: pd.DataFrame) -> px.scatter:
+def _merge_temperature(df_count: pd.DataFrame, df_lostitem: pd.DataFrame, df_temp: pd.DataFrame) -> pd.DataFrame:
+    # Counts from queries.daily_counts_with_temperature are already joined with the temperature in SQL
+    if 'temperature' in df_lostitem.columns:
+        return df_count.merge(df_lostitem[['date', 'temperature']].drop_duplicates('date'), on='date', how='inner')
+    return pd.merge(df_count, df_temp, on='date', how='inner')
+
+@_instrumented
+def scatter_par_type(df_lostitem: pd.DataFrame, df_temp: pd.DataFrame = None) -> px.scatter:
     # Group the lost items by date and object type and merge with the temperature DataFrame
-    df_lostitem_group = df_lostitem[["date", "type_objet"]].groupby(["date", "type_objet"]).size().reset_index(name="count")
-    df_merge = pd.merge(df_lostitem_group, df_temp, on='date', how='inner')
+    df_merge = _merge_temperature(_count_by(df_lostitem, ["date", "type_objet"]), df_lostitem, df_temp)
+    df_merge = _downsample(df_merge, SCATTER_MAX_POINTS, by="type_objet")
 
     # Create a scatter plot
-    fig = px.scatter(df_merge, x="temperature", y="count", color="type_objet", hover_data=['type_objet'], size_max=1)
+    fig = px.scatter(df_merge, x="temperature", y="count", color="type_objet", hover_data=['type_objet'], size_max=1, render_mode=_render_mode(df_merge))
     fig.update_layout(width=1000)
     fig.update_layout(xaxis_title='Temperature in Celsius', yaxis_title="Number of lost items in a day")
     return fig
 
-def scatter_tous_types(df_lostitem: pd.DataFrame, df_temp: pd.DataFrame) -> px.scatter:
-    df_lostitem_group = df_lostitem[["date"]].groupby(["date"]).size().reset_index(name="count")
-    df_merge = pd.merge(df_lostitem_group, df_temp, on='date', how='inner')
-    fig = px.scatter(df_merge, x="temperature", y="count", size_max=1)
+@_instrumented
+def scatter_tous_types(df_lostitem: pd.DataFrame, df_temp: pd.DataFrame = None) -> px.scatter:
+    df_merge = _merge_temperature(_count_by(df_lostitem, ["date"]), df_lostitem, df_temp)
+    df_merge = _downsample(df_merge, SCATTER_MAX_POINTS)
+    fig = px.scatter(df_merge, x="temperature", y="count", size_max=1, render_mode=_render_mode(df_merge))
     fig.update_layout(xaxis_title='Température en Celsius', yaxis_title="Nombre d'objets perdus sur une journée ")
     return fig
 
-def saison(date_str: str) -> str:
-    mois_jour = date_str[5:]  # extraire le mois et le jour de la date au format string
-    
-    if mois_jour >= '03-20' and mois_jour <= '06-20':
-        return "Printemps"
-    elif mois_jour >= '06-21' and mois_jour <= '09-21':
-        return "Été"
-    elif mois_jour >= '09-22' and mois_jour <= '12-20':
-        return "Automne"
+def _count_by_day(df: pd.DataFrame, keys: list) -> pd.DataFrame:
+    # Rollup rows carry the season computed at import time, raw rows get it from the vectorized classifier
+    if "saison" in df.columns:
+        df_count = _count_by(df, keys + ["saison"])
+        df_count["saison"] = pd.Categorical(df_count["saison"], categories=SAISONS)
     else:
-        return "Hiver"
+        df_count = _count_by(df, keys)
+        df_count["saison"] = saisons(df_count["date"])
+    return df_count.rename(columns={"saison": "season"})
 
+@_instrumented
 def boxplot(df_lostitem: pd.DataFrame) -> px.box:
-    df_lostitem_date = df_lostitem[["date"]].groupby(["date"]).size().reset_index(name="count")
-    df_lostitem_date['season'] = df_lostitem_date['date'].apply(saison)
+    df_lostitem_date = _count_by_day(df_lostitem, ["date"])
 
     fig = px.box(data_frame=df_lostitem_date, x="season", y="count")
 
@@ -104,13 +196,13 @@ def boxplot(df_lostitem: pd.DataFrame) -> px.box:
     return fig
 
 
+@_instrumented
 def heatmap(df_lostitem: pd.DataFrame) -> px.imshow:
-    df_lostitem_group = df_lostitem[["date","type_objet"]].groupby(["date","type_objet"]).size().reset_index(name="count")
-    
-    df_lostitem_group['season'] = df_lostitem_group['date'].apply(saison)
+    df_lostitem_group = _count_by_day(df_lostitem, ["date", "type_objet"])
 
-    df_med = df_lostitem_group[["season","type_objet","count"]].groupby(["season","type_objet"]).median().reset_index()
-    new_df = df_med.pivot(index='type_objet', columns='season')['count'].fillna(0)
+    df_med = df_lostitem_group[["season","type_objet","count"]].groupby(["season","type_objet"], observed=True).median().reset_index()
+    # An empty database has no season to pivot: the heatmap is drawn empty
+    new_df = df_med.pivot(index='type_objet', columns='season')['count'].fillna(0) if len(df_med) else pd.DataFrame(dtype=float)
     fig = px.imshow(new_df, x=new_df.columns, y=new_df.index, color_continuous_scale="Reds")
     # fig = px.imshow(img = df_lostitem_group[["season","type_objet","count"]], x="season", y="type_objet", color_continuous_scale="Reds")
     # Customize plot
@@ -118,4 +210,37 @@ def heatmap(df_lostitem: pd.DataFrame) -> px.imshow:
         xaxis_title= "Saison",
         yaxis_title=  "Type d'objets trouvés",
     )
-    return fig
\ No newline at end of file
+    return fig
+
+# Axes of the restitution charts, by column of queries.restitution_counts
+RESTITUTION_AXES = {"nom_gare": "Gare", "type_objet": "Type d'objet", "saison": "Saison"}
+
+
+def _restitution_by(df_restitution: pd.DataFrame, by: str) -> pd.DataFrame:
+    # The frame already holds sums over the whole history: only a few hundred rows are regrouped here
+    df = df_restitution.assign(**{by: df_restitution[by].astype(str)})
+    if by == "saison":
+        df[by] = pd.Categorical(df[by], categories=SAISONS)
+    df = df.groupby(by, observed=True)[["count", "restitues", "delai_jours"] + TRANCHE_COLUMNS].sum().reset_index()
+    df["taux"] = (100 * df["restitues"] / df["count"]).round(1)
+    df["delai_moyen"] = (df["delai_jours"] / df["restitues"].where(df["restitues"] > 0)).round(1)
+    return df if by == "saison" else df.sort_values("taux", ascending=False, ignore_index=True)
+
+
+@_instrumented
+def taux_restitution(df_restitution: pd.DataFrame, by: str = "nom_gare") -> px.bar:
+    df = _restitution_by(df_restitution, by)
+    fig = px.bar(df, x=by, y="taux", hover_data=["count", "restitues", "delai_moyen"])
+    fig.update_layout(xaxis_title=RESTITUTION_AXES[by], yaxis_title="Part des objets restitués (%)")
+    return fig
+
+
+@_instrumented
+def delais_restitution(df_restitution: pd.DataFrame, by: str = "nom_gare") -> px.bar:
+    df = _restitution_by(df_restitution, by)
+    shares = df[TRANCHE_COLUMNS].div(df["restitues"].where(df["restitues"] > 0), axis=0).mul(100).round(1)
+    shares.columns = TRANCHES
+    df_long = pd.concat([df[[by]], shares], axis=1).melt(id_vars=by, var_name="delai", value_name="part")
+    fig = px.bar(df_long, x="part", y=by, color="delai", orientation="h", category_orders={"delai": TRANCHES})
+    fig.update_layout(xaxis_title="Part des objets restitués (%)", yaxis_title=RESTITUTION_AXES[by], legend_title="Délai de restitution")
+    return fig